@@ -37,36 +37,110 @@ def create_app(testing=False):
     app.config['MAIL_USE_SSL'] = os.getenv('MAIL_USE_SSL', 'False') == 'True'
     app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
     app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
+    # Mensagens por conexão SMTP antes de reconectar (limite comum dos provedores)
+    app.config['MAIL_MAX_EMAILS'] = int(os.getenv('MAIL_MAX_EMAILS', 100))
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
     app.config['MODE'] = os.getenv('MODE')
     app.config['FRONTEND_DEV_URL'] = os.getenv('FRONTEND_DEV_URL')
     app.config['FRONTEND_PROD_URL'] = os.getenv('FRONTEND_PROD_URL')
     app.config['FRONTEND_URL'] = app.config['FRONTEND_DEV_URL'] if app.config['MODE'] == 'development' else app.config['FRONTEND_PROD_URL']
+    # Endereço público da API, usado em links enviados por e-mail (em produção o front é servido pela própria API)
+    app.config['API_URL'] = os.getenv('API_URL', f"{app.config['FRONTEND_URL']}/api")
+    # Anexos maiores que isso seguem como link assinado, válido por MAIL_LINK_MAX_AGE segundos
+    app.config['MAIL_ATTACHMENT_MAX_BYTES'] = int(os.getenv('MAIL_ATTACHMENT_MAX_BYTES', 5 * 1024 * 1024))
+    app.config['MAIL_LINK_MAX_AGE'] = int(os.getenv('MAIL_LINK_MAX_AGE', 7 * 24 * 3600))
+    # URLs assinadas de imagens: validade e janela de arredondamento (mesma URL dentro da janela)
+    app.config['MEDIA_URL_MAX_AGE'] = int(os.getenv('MEDIA_URL_MAX_AGE', 24 * 3600))
+    app.config['MEDIA_URL_BUCKET'] = int(os.getenv('MEDIA_URL_BUCKET', 3600))
     app.config['SQLALCHEMY_POOL_SIZE'] = 100  # Aumente para um valor maior
+    app.config['JWT_CACHE_SIZE'] = int(os.getenv('JWT_CACHE_SIZE', 1024))
+    # 'thread' envia pela thread do próprio processo; 'external' deixa a fila para o `flask mail-worker`
+    app.config['MAIL_QUEUE_WORKER'] = os.getenv('MAIL_QUEUE_WORKER', 'thread')
     if testing:
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('TEST_DATABASE_URL')
         app.config['SECRET_KEY'] = 'chave_teste'
+        app.config['MAIL_QUEUE_WORKER'] = 'external'
     else:
         app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
     mail.init_app(app)
 
+    # Latência, status, uploads e caches em /metrics (formato do Prometheus)
+    from app.metricas import init_metricas
+    init_metricas(app)
+
+    # Consultas SQL por requisição (Server-Timing em desenvolvimento, log em produção)
+    from app.consultas import init_consultas
+    init_consultas(app)
+
+    # Consultas acima de SLOW_QUERY_MS guardadas com o plano do banco
+    from app.consultas_lentas import init_consultas_lentas
+    init_consultas_lentas(app)
+
+    # Autenticação centralizada: claims em cache e principal carregado sob demanda
+    from app.auth import init_auth
+    init_auth(app)
+
+    # Fila persistente de e-mails enviada em segundo plano
+    from app.mail_queue import init_mail_queue
+    init_mail_queue(app)
+
+    # Tarefas longas executadas fora da requisição, com progresso consultável
+    from app.jobs import init_jobs
+    init_jobs(app)
+
     # Configuração do diretório de upload de imagens
     UPLOAD_FOLDER = 'uploads'
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, UPLOAD_FOLDER)
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)  # Crie o diretório se não existir
 
+    # Metadados das imagens indexados no banco (flask indexar-imagens faz o backfill)
+    from app.imagens import init_imagens
+    init_imagens(app)
+
+    # Uploads distribuídos em subdiretórios (flask migrar-uploads move os arquivos antigos)
+    from app.armazenamento import init_armazenamento
+    init_armazenamento(app)
+
+    # Conteúdo gravado uma vez por SHA-256 e compartilhado entre as imagens
+    from app.blobs import init_blobs
+    init_blobs(app)
+
+    # Miniaturas e prévias geradas em um pool de processos, fora da requisição
+    from app.derivados import init_derivados
+    init_derivados(app)
+
+    # Remoção de metadados e recompressão das fotos depois do upload (opcional)
+    from app.otimizacao import init_otimizacao
+    init_otimizacao(app)
+
+    # Contadores de armazenamento por empresa e exame, com cotas opcionais
+    from app.consumo import init_consumo
+    init_consumo(app)
+
+    # Coleta de arquivos órfãos da pasta de upload (flask coletar-orfaos)
+    from app.limpeza import init_limpeza
+    init_limpeza(app)
+
+    # Dados sintéticos para desenvolvimento e benchmarks (flask seed)
+    from app.povoamento import init_povoamento
+    init_povoamento(app)
+
     # Importar modelos após a criação do app para evitar importação circular
     from app.routes.user_routes import user_bp
     from app.routes.company_routes import company_bp
     from app.routes.exam_routes import exam_bp
     from app.routes.image_routes import image_bp
     from app.routes.login import auth_bp
+    from app.routes.job_routes import job_bp
+    from app.routes.diagnostico_routes import diagnostico_bp
     app.register_blueprint(auth_bp, url_prefix='/api', name='auth')
     app.register_blueprint(user_bp, url_prefix='/api', name='user_blueprint')
     app.register_blueprint(company_bp, url_prefix='/api', name='company_blueprint')
     app.register_blueprint(exam_bp, url_prefix='/api', name='exam_blueprint')
     app.register_blueprint(image_bp, url_prefix='/api')
+    app.register_blueprint(job_bp, url_prefix='/api')
+    app.register_blueprint(diagnostico_bp, url_prefix='/api')
 
     return app
 
@@ -80,6 +154,12 @@ def init_db(testing=False):
     from app.models.user import Base
     from app.models.company import Base
     from app.models.exam import Base
+    from app.models.outbox import Base
+    from app.models.job import Base
+    from app.models.blob import Base
+    from app.models.exam_image import Base
+    from app.models.upload_session import Base
+    from app.models.storage_usage import Base
     
     if testing:
         Base.metadata.create_all(bind=test_engine)
@@ -90,4 +170,10 @@ def drop_test_db():
     from app.models.user import Base
     from app.models.company import Base
     from app.models.exam import Base
+    from app.models.outbox import Base
+    from app.models.job import Base
+    from app.models.blob import Base
+    from app.models.exam_image import Base
+    from app.models.upload_session import Base
+    from app.models.storage_usage import Base
     Base.metadata.drop_all(bind=test_engine)
\ No newline at end of file
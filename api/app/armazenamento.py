@@ -0,0 +1,346 @@
+# app/armazenamento.py
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import click
+from flask import current_app, redirect, request, send_file
+from werkzeug.utils import send_file as werkzeug_send_file
+
+from app.models.exam_image import ExamImage
+
+TAMANHO_BLOCO = 1024 * 1024
+
+
+class ArquivoMuitoGrande(Exception):
+    """O arquivo enviado ultrapassou UPLOAD_MAX_FILE_BYTES."""
+
+
+class ArquivoRecebido:
+    """Upload gravado em um temporário, ainda fora do lugar definitivo."""
+
+    def __init__(self, temporario, tamanho, checksum):
+        self.temporario = temporario
+        self.tamanho = tamanho
+        self.checksum = checksum
+
+
+def pasta_upload():
+    return current_app.config['UPLOAD_FOLDER']
+
+
+def prefixo(nome):
+    """Dois níveis de diretório derivados do hash do nome (ex.: 'a3/f0')."""
+    resumo = hashlib.sha256(nome.encode('utf-8')).hexdigest()
+    return f"{resumo[0:2]}/{resumo[2:4]}"
+
+
+def caminho_relativo(nome):
+    """Caminho de um arquivo novo dentro da pasta de upload: '<aa>/<bb>/<nome>'."""
+    return f"{prefixo(nome)}/{nome}"
+
+
+def caminho_absoluto(relativo):
+    return os.path.join(pasta_upload(), relativo)
+
+
+def local():
+    """Driver do disco deste nó: arquivos antigos, derivados, exportações e temporários."""
+    from app.drivers import DriverLocal
+    return DriverLocal(pasta_upload())
+
+
+def driver():
+    """
+    Driver dos blobs, definido por STORAGE_BACKEND ('local' ou 's3').
+    O cliente S3 é criado sob demanda no processo que atende a requisição (compatível com pre-fork).
+    """
+    app = current_app
+    if app.config['STORAGE_BACKEND'] != 's3':
+        return local()
+    if 'armazenamento' not in app.extensions:
+        from app.drivers import DriverS3
+        opcoes = {chave: valor for chave, valor in (('endpoint_url', app.config['S3_ENDPOINT_URL']),
+                                                     ('region_name', app.config['S3_REGION'])) if valor}
+        app.extensions['armazenamento'] = DriverS3(app.config['S3_BUCKET'], app.config['S3_PREFIX'], **opcoes)
+    return app.extensions['armazenamento']
+
+
+def localizar(caminho):
+    """
+    Caminho absoluto existente do arquivo no disco local, aceitando caminho relativo ou absoluto.
+    Durante a migração o arquivo pode estar no formato plano ou fragmentado: tenta os dois.
+    """
+    return local().caminho(caminho)
+
+
+def remoto(caminho):
+    """Driver remoto que guarda o arquivo, quando ele não está no disco local (None caso contrário)."""
+    atual = driver()
+    if atual.remoto and not os.path.isabs(caminho) and localizar(caminho) is None:
+        return atual
+    return None
+
+
+def abrir(caminho):
+    """Fluxo de leitura do arquivo, esteja ele no disco local ou no driver remoto."""
+    absoluto = localizar(caminho)
+    if absoluto:
+        return open(absoluto, 'rb')
+    atual = remoto(caminho)
+    if atual is None:
+        raise FileNotFoundError(caminho)
+    return atual.abrir(caminho)
+
+
+def existe(caminho):
+    if localizar(caminho):
+        return True
+    atual = remoto(caminho)
+    return atual is not None and atual.tamanho(caminho) is not None
+
+
+class ArquivoRemoto:
+    """Arquivo do driver remoto entregue a quem lê em fluxo (ZIP), com o tamanho já conhecido."""
+
+    def __init__(self, driver, chave, tamanho):
+        self.driver = driver
+        self.chave = chave
+        self.tamanho = tamanho
+
+    def abrir(self):
+        return self.driver.abrir(self.chave)
+
+
+def origem(caminho, tamanho):
+    """Caminho local do arquivo ou, se ele está no bucket, um ArquivoRemoto (None se não existe)."""
+    absoluto = localizar(caminho)
+    if absoluto:
+        return absoluto
+    atual = remoto(caminho)
+    return ArquivoRemoto(atual, caminho, tamanho) if atual else None
+
+
+@contextmanager
+def copia_local(caminho):
+    """
+    Caminho local para quem precisa do arquivo em disco (Pillow, PDFium). Arquivos do driver
+    remoto são baixados para um temporário, apagado ao sair do bloco. None se não existe.
+    """
+    absoluto = localizar(caminho)
+    atual = None if absoluto else remoto(caminho)
+    if atual is None:
+        yield absoluto
+        return
+    descritor, temporario = tempfile.mkstemp(dir=pasta_temporaria())
+    try:
+        try:
+            with os.fdopen(descritor, 'wb') as destino, atual.abrir(caminho) as fluxo:
+                shutil.copyfileobj(fluxo, destino, TAMANHO_BLOCO)
+        except FileNotFoundError:
+            yield None
+            return
+        yield temporario
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+
+def url_assinada(caminho, mime_type, nome='', validade=None):
+    """
+    URL temporária do arquivo para o navegador: pré-assinada do bucket para os blobs
+    no driver remoto, ou da rota /arquivos desta API para o disco local.
+    """
+    atual = driver()
+    if atual.remoto and caminho.startswith('blobs/'):
+        return atual.url_assinada(caminho, mime_type, nome, validade)
+    return local().url_assinada(caminho, mime_type, nome, validade)
+
+
+def pasta_temporaria():
+    # Dentro da pasta de upload para que o rename final seja atômico (mesmo sistema de arquivos)
+    pasta = os.path.join(pasta_upload(), '.tmp')
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
+
+
+def receber(arquivo, limite):
+    """
+    Copia o upload em blocos de tamanho fixo para um temporário, calculando o SHA-256
+    durante a escrita. Ultrapassar `limite` interrompe a cópia e apaga o temporário.
+    """
+    sha256 = hashlib.sha256()
+    tamanho = 0
+    descritor, temporario = tempfile.mkstemp(dir=pasta_temporaria(), suffix='.part')
+    try:
+        with os.fdopen(descritor, 'wb') as destino:
+            for bloco in iter(lambda: arquivo.stream.read(TAMANHO_BLOCO), b''):
+                tamanho += len(bloco)
+                if tamanho > limite:
+                    raise ArquivoMuitoGrande(arquivo.filename)
+                sha256.update(bloco)
+                destino.write(bloco)
+    except BaseException:
+        os.remove(temporario)
+        raise
+    return ArquivoRecebido(temporario, tamanho, sha256.hexdigest())
+
+
+def descartar(recebidos):
+    """Apaga os temporários que não chegaram a ser confirmados."""
+    for recebido in recebidos:
+        if os.path.exists(recebido.temporario):
+            os.remove(recebido.temporario)
+
+
+def remover(caminho):
+    """Remove o arquivo onde quer que esteja (disco ou driver remoto); retorna False se já não existia."""
+    absoluto = localizar(caminho)
+    if absoluto is None:
+        atual = remoto(caminho)
+        return atual.apagar(caminho) if atual else False
+    os.remove(absoluto)
+    return True
+
+
+def redirecionar(caminho, mime_type=None, nome='', validade=None):
+    """Redirecionamento para a URL pré-assinada quando o arquivo está no driver remoto (None se está no disco)."""
+    atual = remoto(caminho)
+    if atual is None:
+        return None
+    return redirect(atual.url_assinada(caminho, mime_type, nome, validade))
+
+
+def enviar_arquivo(absoluto, mimetype=None, as_attachment=False, download_name=None, etag=None, max_age=None):
+    """
+    Resposta para um arquivo da pasta de upload.
+    Com FILE_SERVING_MODE 'x-accel' (nginx) ou 'x-sendfile' (Apache/lighttpd) o Flask só monta os
+    cabeçalhos e o proxy transmite os bytes, atendendo Range por conta própria. No modo 'flask'
+    o send_file responde a Range com 206 e usa o wsgi.file_wrapper (sendfile) do servidor.
+    """
+    modo = current_app.config['FILE_SERVING_MODE']
+    if modo == 'flask':
+        return send_file(absoluto, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+                         conditional=True, etag=etag if etag is not None else True, max_age=max_age)
+
+    # Range fica com o proxy: aqui só valem as validações de cache (ETag/Last-Modified)
+    environ = {chave: valor for chave, valor in request.environ.items() if chave != 'HTTP_RANGE'}
+    resposta = werkzeug_send_file(
+        absoluto, environ, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+        conditional=True, etag=etag if etag is not None else True, max_age=max_age,
+        use_x_sendfile=True, response_class=current_app.response_class
+    )
+    resposta.headers['Accept-Ranges'] = 'bytes'
+    # Numa revalidação atendida com 304 o werkzeug não inclui X-Sendfile: não há corpo a delegar
+    caminho = resposta.headers.pop('X-Sendfile', None) if modo == 'x-accel' else None
+    if caminho is not None:
+        relativo = os.path.relpath(caminho, pasta_upload()).replace(os.sep, '/')
+        resposta.headers['X-Accel-Redirect'] = current_app.config['X_ACCEL_PREFIX'].rstrip('/') + '/' + quote(relativo)
+        del resposta.headers['Content-Length']  # O corpo virá do nginx
+    return resposta
+
+
+def migrar_para_fragmentado(db, lote=500, pausa=0.0, logger=None):
+    """
+    Move os arquivos do formato plano para o fragmentado, um lote por vez.
+    Pode ser interrompida e executada de novo: o arquivo é movido antes do registro ser
+    atualizado e `localizar` encontra o arquivo nos dois formatos enquanto isso.
+    """
+    resultado = {"migrados": 0, "ja_movidos": 0, "ausentes": 0}
+    ultimo_id = ''
+    while True:
+        imagens = db.query(ExamImage)\
+                    .filter(~ExamImage.path.contains('/'), ExamImage.id > ultimo_id)\
+                    .order_by(ExamImage.id)\
+                    .limit(lote)\
+                    .all()
+        if not imagens:
+            break
+
+        for imagem in imagens:
+            ultimo_id = imagem.id
+            novo = caminho_relativo(imagem.path)
+            origem, destino = caminho_absoluto(imagem.path), caminho_absoluto(novo)
+            if os.path.exists(origem):
+                os.makedirs(os.path.dirname(destino), exist_ok=True)
+                os.replace(origem, destino)  # Atômico dentro do mesmo sistema de arquivos
+                resultado["migrados"] += 1
+            elif os.path.exists(destino):
+                resultado["ja_movidos"] += 1  # Execução anterior interrompida após mover
+            else:
+                resultado["ausentes"] += 1
+                if logger:
+                    logger.warning(f"Arquivo não encontrado para migrar: {imagem.path}")
+                continue
+            imagem.path = novo
+        db.commit()
+
+        if logger:
+            logger.info(f"Migração de uploads: {resultado}")
+        if pausa:
+            time.sleep(pausa)  # Alivia o disco enquanto a aplicação continua atendendo
+    return resultado
+
+
+def enviar_blobs_locais(logger=None):
+    """
+    Move os blobs gravados no disco local para o driver remoto. Pode ser interrompida e executada
+    de novo: cada arquivo só sai do disco depois de enviado, e até lá é lido do disco local.
+    """
+    resultado = {"enviados": 0, "bytes": 0}
+    destino = driver()
+    if not destino.remoto:
+        return resultado
+    origem = local()
+    for chave, tamanho, _ in origem.listar('blobs/'):
+        destino.gravar(chave, origem.caminho(chave))
+        resultado["enviados"] += 1
+        resultado["bytes"] += tamanho
+        if logger and resultado["enviados"] % 500 == 0:
+            logger.info(f"Envio de blobs: {resultado}")
+    return resultado
+
+
+def init_armazenamento(app):
+    app.config.setdefault('UPLOAD_MAX_FILE_BYTES', int(os.getenv('UPLOAD_MAX_FILE_BYTES', 50 * 1024 * 1024)))
+    # Corpo inteiro da requisição: o Werkzeug recusa com 413 antes de ler as partes
+    if app.config.get('MAX_CONTENT_LENGTH') is None:
+        app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 200 * 1024 * 1024))
+    # Quem transmite os arquivos: 'flask', 'x-accel' (nginx) ou 'x-sendfile' (Apache/lighttpd)
+    app.config.setdefault('FILE_SERVING_MODE', os.getenv('FILE_SERVING_MODE', 'flask'))
+    # Location interna do nginx apontando para UPLOAD_FOLDER (com a diretiva `internal`)
+    app.config.setdefault('X_ACCEL_PREFIX', os.getenv('X_ACCEL_PREFIX', '/protegido/'))
+    # Upload retomável: tamanho de cada bloco e validade da sessão
+    app.config.setdefault('UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024)
+    app.config.setdefault('UPLOAD_SESSION_TTL', 24 * 3600)
+    # Onde ficam os blobs: 'local' (UPLOAD_FOLDER) ou 's3' (bucket compartilhado entre os nós).
+    # Credenciais do S3 vêm das variáveis padrão do boto3 (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+    app.config.setdefault('STORAGE_BACKEND', os.getenv('STORAGE_BACKEND', 'local'))
+    app.config.setdefault('S3_BUCKET', os.getenv('S3_BUCKET'))
+    app.config.setdefault('S3_PREFIX', os.getenv('S3_PREFIX', ''))
+    app.config.setdefault('S3_ENDPOINT_URL', os.getenv('S3_ENDPOINT_URL'))  # MinIO ou outro compatível
+    app.config.setdefault('S3_REGION', os.getenv('S3_REGION'))
+
+    @app.cli.command('migrar-uploads')
+    @click.option('--lote', default=500, help='Arquivos movidos por transação.')
+    @click.option('--pausa', default=0.0, help='Segundos de espera entre os lotes.')
+    def migrar_uploads_command(lote, pausa):
+        """Move os uploads para o layout fragmentado (pode ser interrompido e retomado)."""
+        from app import get_db
+        db = get_db()
+        try:
+            resultado = migrar_para_fragmentado(db, lote=lote, pausa=pausa, logger=app.logger)
+        finally:
+            db.close()
+        print(f"Migração concluída: {resultado}")
+
+    @app.cli.command('migrar-armazenamento')
+    def migrar_armazenamento_command():
+        """Envia os blobs do disco local para o driver configurado (STORAGE_BACKEND)."""
+        resultado = enviar_blobs_locais(logger=app.logger)
+        print(f"Envio concluído: {resultado}")
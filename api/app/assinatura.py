@@ -0,0 +1,50 @@
+# app/assinatura.py
+import base64
+import hashlib
+import hmac
+import math
+import time
+from urllib.parse import quote, urlencode
+
+from flask import current_app
+from itsdangerous import BadSignature, SignatureExpired
+
+
+def _assinar(relativo, expira, mime_type, nome):
+    chave = (current_app.config.get('MEDIA_URL_KEY') or current_app.config['SECRET_KEY']).encode('utf-8')
+    mensagem = f"{relativo}\n{expira}\n{mime_type}\n{nome}".encode('utf-8')
+    digest = hmac.new(chave, mensagem, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def gerar_url_arquivo(relativo, mime_type, nome='', validade=None):
+    """
+    URL assinada (HMAC-SHA256) e com prazo para um arquivo da pasta de upload.
+    O prazo é arredondado para MEDIA_URL_BUCKET: a mesma imagem gera a mesma URL dentro da janela,
+    então navegadores e caches reaproveitam a resposta.
+    """
+    config = current_app.config
+    validade = config['MEDIA_URL_MAX_AGE'] if validade is None else validade
+    janela = config['MEDIA_URL_BUCKET']
+    expira = math.ceil((time.time() + validade) / janela) * janela
+    parametros = {'e': expira, 't': mime_type, 'n': nome, 's': _assinar(relativo, expira, mime_type, nome)}
+    return f"{config['API_URL']}/arquivos/{quote(relativo)}?{urlencode(parametros)}"
+
+
+def verificar_url_arquivo(relativo, parametros):
+    """
+    Confere assinatura e prazo sem consultar o banco. Retorna (mime_type, nome, expira);
+    lança BadSignature (ou SignatureExpired) se a URL foi alterada ou venceu.
+    """
+    try:
+        expira = int(parametros.get('e', ''))
+    except ValueError:
+        raise BadSignature('URL sem prazo válido')
+    mime_type, nome = parametros.get('t', ''), parametros.get('n', '')
+    esperada = _assinar(relativo, expira, mime_type, nome)
+    if not hmac.compare_digest(esperada, parametros.get('s', '')):
+        raise BadSignature('Assinatura inválida')
+    if expira < time.time():
+        raise SignatureExpired('URL expirada')
+    return mime_type, nome, expira
+
@@ -0,0 +1,184 @@
+# app/auth.py
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import jwt
+from flask import current_app, g, jsonify, request
+from flask.ctx import _AppCtxGlobals
+
+from app import get_db
+from app.models.user import User, UserRole
+from app.models.company import Company
+
+
+class TokenCache:
+    """Cache LRU dos claims já verificados, indexado pelo token até o seu 'exp'."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            item = self._itens.get(token)
+            if item is None:
+                self.misses += 1
+                return None
+            claims, exp = item
+            if exp <= time.time():
+                # Token expirado: descarta e obriga uma nova verificação
+                del self._itens[token]
+                self.misses += 1
+                return None
+            self._itens.move_to_end(token)
+            self.hits += 1
+            return claims
+
+    def set(self, token, claims):
+        exp = claims.get('exp')
+        if exp is None:
+            return
+        with self._lock:
+            self._itens[token] = (claims, exp)
+            self._itens.move_to_end(token)
+            while len(self._itens) > self.maxsize:
+                self._itens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._itens.clear()
+
+    def __len__(self):
+        return len(self._itens)
+
+
+def get_token_cache():
+    return current_app.extensions['token_cache']
+
+
+def decodificar_token(token):
+    """
+    Decodifica e verifica um JWT, reaproveitando o resultado do cache quando possível.
+    Lança jwt.InvalidTokenError se o token for inválido ou estiver expirado.
+    """
+    cache = get_token_cache()
+    claims = cache.get(token)
+    if claims is not None:
+        return claims
+
+    claims = jwt.decode(
+        token,
+        current_app.config['SECRET_KEY'],
+        algorithms=['HS256'],
+        options={"require": ["exp"]}  # Exige validação de expiração
+    )
+    cache.set(token, claims)
+    return claims
+
+
+def _token_da_requisicao():
+    cabecalho = request.headers.get('Authorization', '')
+    tipo, _, token = cabecalho.partition(' ')
+    if tipo.lower() != 'bearer' or not token:
+        return None
+    return token.strip()
+
+
+def _claims_da_requisicao():
+    token = _token_da_requisicao()
+    if not token:
+        return None
+    try:
+        claims = decodificar_token(token)
+    except jwt.ExpiredSignatureError:
+        return None  # Token expirado
+    except jwt.InvalidTokenError as e:
+        current_app.logger.info(f"Token recusado: {str(e)}")
+        return None
+    # Só tokens de login autenticam: os de to_jwt() (confirmação de e-mail, nova senha)
+    # são assinados com a mesma chave, mas não trazem 'sub' nem 'role'
+    if 'sub' not in claims or 'role' not in claims:
+        current_app.logger.info("Token recusado: não é um token de login")
+        return None
+    return claims
+
+
+def _carregar_principal(claims):
+    """Carrega o usuário ou a empresa correspondente aos claims do token."""
+    if not claims:
+        return None
+
+    db = get_db()
+
+    # Tokens de login trazem 'sub' e 'role' (role 4 identifica empresas)
+    if claims['role'] == UserRole.COMPANY:
+        return db.query(Company).get(claims['sub'])
+    return db.query(User).get(claims['sub'])
+
+
+class AuthGlobals(_AppCtxGlobals):
+    """
+    Namespace do `g` com claims e principal carregados sob demanda:
+    o token é decodificado no primeiro acesso a `g.claims` e o banco só é
+    consultado no primeiro acesso a `g.principal`.
+    """
+
+    @property
+    def claims(self):
+        if '_claims' not in self.__dict__:
+            self.__dict__['_claims'] = _claims_da_requisicao()
+        return self.__dict__['_claims']
+
+    @property
+    def principal(self):
+        if '_principal' not in self.__dict__:
+            self.__dict__['_principal'] = _carregar_principal(self.claims)
+        return self.__dict__['_principal']
+
+
+def papel_atual():
+    """Retorna o papel da requisição atual a partir do token, sem consultar o banco."""
+    claims = g.claims
+    if not claims:
+        return None
+    return claims['role']
+
+
+def login_obrigatorio(f):
+    @wraps(f)
+    def decorado(*args, **kwargs):
+        if not g.claims:
+            return jsonify({"erro": "Token ausente ou inválido"}), 401
+        if g.principal is None:
+            return jsonify({"erro": "Conta não encontrada"}), 401
+        return f(*args, **kwargs)
+    return decorado
+
+
+def requer_papel(*papeis):
+    def decorador(f):
+        @wraps(f)
+        def decorado(*args, **kwargs):
+            if not g.claims:
+                return jsonify({"erro": "Token ausente ou inválido"}), 401
+            if papel_atual() not in papeis:
+                return jsonify({"erro": "Acesso não autorizado"}), 403
+            return f(*args, **kwargs)
+        return decorado
+    return decorador
+
+
+def init_auth(app):
+    app.app_ctx_globals_class = AuthGlobals
+    app.extensions['token_cache'] = TokenCache(app.config.get('JWT_CACHE_SIZE', 1024))
+
+    @app.before_request
+    def _reiniciar_autenticacao():
+        # O contexto da aplicação pode ser compartilhado entre requisições (ex.: testes)
+        g.__dict__.pop('_claims', None)
+        g.__dict__.pop('_principal', None)
@@ -0,0 +1,221 @@
+# app/blobs.py
+import os
+
+from flask import current_app
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import armazenamento
+from app.consumo import bytes_da_imagem, registrar_consumo
+from app.derivados import caminhos_dos_derivados
+from app.models.blob import Blob
+from app.models.exam_image import ExamImage
+
+
+def caminho_blob(checksum):
+    """'blobs/<aa>/<bb>/<sha256>': o conteúdo define o caminho, sem extensão."""
+    return f"blobs/{checksum[0:2]}/{checksum[2:4]}/{checksum}"
+
+
+def armazenar(db, recebido):
+    """
+    Guarda o upload recebido como blob e já conta a referência da nova imagem.
+    Se o conteúdo já existe o temporário é descartado: a duplicata não ocupa disco.
+    Retorna (blob, criado).
+    """
+    for _ in range(2):
+        atualizados = db.query(Blob)\
+            .filter(Blob.checksum == recebido.checksum)\
+            .update({"refcount": Blob.refcount + 1}, synchronize_session=False)
+        if atualizados:
+            return db.query(Blob).get(recebido.checksum), False
+
+        relativo = caminho_blob(recebido.checksum)
+        armazenamento.driver().gravar(relativo, recebido.temporario)
+        try:
+            # Savepoint: outro upload do mesmo conteúdo pode ter criado o blob ao mesmo tempo
+            with db.begin_nested():
+                blob = Blob(checksum=recebido.checksum, path=relativo, size=recebido.tamanho, refcount=1)
+                db.add(blob)
+            return blob, True
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"Não foi possível registrar o blob {recebido.checksum}")
+
+
+def liberar(db, checksum):
+    """
+    Retira uma referência do blob. Ao chegar a zero o registro é apagado e o arquivo
+    é removido depois do commit. Retorna os bytes liberados (0 se ainda há referências).
+    """
+    blob = db.query(Blob).get(checksum)
+    if blob is None:
+        return 0
+    db.query(Blob).filter(Blob.checksum == checksum)\
+      .update({"refcount": Blob.refcount - 1}, synchronize_session=False)
+    removidos = db.query(Blob).filter(Blob.checksum == checksum, Blob.refcount <= 0)\
+                  .delete(synchronize_session=False)
+    if not removidos:
+        return 0
+    db.expunge(blob)
+    remover_apos_commit(db, blob.path, checksum)
+    for derivado in caminhos_dos_derivados(checksum, current_app.config['DERIVATIVE_WIDTHS']):
+        remover_apos_commit(db, derivado, checksum)
+    return blob.size
+
+
+def remover_apos_commit(db, caminho, checksum=None):
+    """
+    Agenda a remoção do arquivo para depois do commit. Com o `checksum` do blob, a remoção
+    é desistida se outro envio do mesmo conteúdo tiver recriado o blob nesse meio tempo.
+    """
+    # O driver é resolvido agora: o commit pode acontecer fora do contexto da aplicação
+    absoluto = armazenamento.localizar(caminho)
+    if absoluto:
+        db.info.setdefault('arquivos_liberados', []).append((armazenamento.local(), absoluto, checksum))
+        return
+    remoto = armazenamento.remoto(caminho)
+    if remoto:
+        db.info.setdefault('arquivos_liberados', []).append((remoto, caminho, checksum))
+
+
+def _blobs_recriados(session, checksums):
+    if not checksums:
+        return set()
+    # Depois do commit a sessão não executa mais SQL: a consulta vai numa conexão à parte
+    with session.get_bind().connect() as conexao:
+        return set(conexao.execute(select(Blob.checksum).where(Blob.checksum.in_(checksums))).scalars())
+
+
+@event.listens_for(Session, 'after_commit')
+def _remover_arquivos_liberados(session):
+    # Só apaga o arquivo depois que o banco confirmou que ninguém mais o referencia
+    liberados = session.info.pop('arquivos_liberados', [])
+    # Um envio do mesmo conteúdo depois do DELETE grava o arquivo de novo e cria outro registro:
+    # o arquivo passou a ser dele e não pode ser apagado
+    recriados = _blobs_recriados(session, {checksum for _, _, checksum in liberados if checksum})
+    for driver, caminho, checksum in liberados:
+        if checksum not in recriados:
+            driver.apagar(caminho)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _cancelar_arquivos_liberados(session):
+    session.info.pop('arquivos_liberados', None)
+
+
+def liberar_imagem(db, imagem):
+    """Solta o conteúdo da imagem; arquivos anteriores aos blobs não são compartilhados."""
+    if imagem.blob_checksum:
+        liberados = liberar(db, imagem.blob_checksum)
+        if imagem.original_checksum:
+            liberados += liberar(db, imagem.original_checksum)  # Original mantido depois da otimização
+        return liberados
+    remover_apos_commit(db, imagem.path)
+    for derivado in caminhos_dos_derivados(imagem.checksum, current_app.config['DERIVATIVE_WIDTHS']):
+        remover_apos_commit(db, derivado)
+    return imagem.size
+
+
+def remover_imagem(db, imagem, company_id=None):
+    """Apaga o registro da imagem, desconta-a do consumo da empresa e devolve os bytes liberados em disco."""
+    registrar_consumo(db, imagem.exam_id, -bytes_da_imagem(imagem), -1, company_id)
+    db.delete(imagem)
+    return liberar_imagem(db, imagem)
+
+
+def relatorio(db):
+    """Espaço ocupado pelos blobs e quanto a deduplicação economizou."""
+    blobs, referencias, armazenados, logicos = db.query(
+        func.count(Blob.checksum),
+        func.coalesce(func.sum(Blob.refcount), 0),
+        func.coalesce(func.sum(Blob.size), 0),
+        func.coalesce(func.sum(Blob.size * Blob.refcount), 0)
+    ).one()
+    return {
+        "blobs": blobs,
+        "referencias": int(referencias),
+        "bytes_armazenados": int(armazenados),
+        "bytes_referenciados": int(logicos),
+        "bytes_economizados": int(logicos) - int(armazenados)
+    }
+
+
+def deduplicar_existentes(db, lote=500, logger=None):
+    """
+    Converte as imagens gravadas antes dos blobs: o primeiro arquivo de cada conteúdo
+    vira o blob e as cópias são apagadas. Pode ser interrompida e executada de novo.
+    """
+    resultado = {"convertidas": 0, "duplicadas_removidas": 0, "bytes_recuperados": 0, "ausentes": 0}
+    ultimo_id = ''
+    while True:
+        imagens = db.query(ExamImage)\
+                    .filter(ExamImage.blob_checksum.is_(None), ExamImage.id > ultimo_id)\
+                    .order_by(ExamImage.id)\
+                    .limit(lote)\
+                    .all()
+        if not imagens:
+            break
+
+        removidos = []
+        for imagem in imagens:
+            ultimo_id = imagem.id
+            origem = armazenamento.localizar(imagem.path)
+            relativo = caminho_blob(imagem.checksum)
+            destino = armazenamento.caminho_absoluto(relativo)
+            blob = db.query(Blob).get(imagem.checksum)
+
+            if blob is not None:
+                blob.refcount += 1
+                if origem and origem != destino:
+                    removidos.append(origem)
+                    resultado["duplicadas_removidas"] += 1
+                    resultado["bytes_recuperados"] += imagem.size
+            elif origem or armazenamento.existe(relativo):
+                if origem and origem != destino:
+                    armazenamento.driver().gravar(relativo, origem)
+                db.add(Blob(checksum=imagem.checksum, path=relativo, size=imagem.size, refcount=1))
+                db.flush()
+            else:
+                resultado["ausentes"] += 1
+                if logger:
+                    logger.warning(f"Arquivo não encontrado para deduplicar: {imagem.path}")
+                continue
+
+            imagem.path = relativo
+            imagem.blob_checksum = imagem.checksum
+            resultado["convertidas"] += 1
+        db.commit()
+
+        # Cópias só são apagadas depois que os registros passaram a apontar para o blob
+        for caminho in removidos:
+            if os.path.exists(caminho):
+                os.remove(caminho)
+        if logger:
+            logger.info(f"Deduplicação: {resultado}")
+    return resultado
+
+
+def init_blobs(app):
+    @app.cli.command('deduplicar-imagens')
+    def deduplicar_imagens_command():
+        """Move as imagens antigas para o armazenamento por conteúdo e mostra o espaço recuperado."""
+        from app import get_db
+        db = get_db()
+        try:
+            resultado = deduplicar_existentes(db, logger=app.logger)
+            print(f"Deduplicação concluída: {resultado}")
+            print(f"Armazenamento: {relatorio(db)}")
+        finally:
+            db.close()
+
+    @app.cli.command('relatorio-blobs')
+    def relatorio_blobs_command():
+        """Mostra o espaço ocupado pelos blobs e a economia da deduplicação."""
+        from app import get_db
+        db = get_db()
+        try:
+            print(f"Armazenamento: {relatorio(db)}")
+        finally:
+            db.close()
@@ -0,0 +1,69 @@
+# app/compactacao.py
+import io
+import os
+import time
+import zipfile
+
+from app.armazenamento import TAMANHO_BLOCO
+
+# Formatos já comprimidos: comprimir de novo só gasta CPU
+TIPOS_COMPRIMIDOS = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'application/pdf', 'application/zip'}
+
+# Acima disso a entrada precisa de ZIP64 (o tamanho não é reescrito depois num fluxo sem seek)
+LIMITE_ZIP64 = 0xFFFFFFFF
+
+
+class _SaidaSemSeek(io.RawIOBase):
+    """Destino do ZipFile que só acumula os bytes escritos até o gerador entregá-los."""
+
+    def __init__(self):
+        self.partes = []
+
+    def writable(self):
+        return True
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        return len(dados)
+
+    def coletar(self):
+        dados = b''.join(self.partes)
+        self.partes.clear()
+        return dados
+
+
+def gerar_zip(arquivos):
+    """
+    Gera o ZIP em pedaços conforme os arquivos são lidos, sem arquivo temporário.
+    `arquivos` é um iterável de (caminho_absoluto, nome_no_zip, mime_type); memória constante
+    por entrada (um bloco de leitura) e os primeiros bytes saem imediatamente.
+    Conteúdos pequenos gerados na hora (ex.: manifesto) podem vir como bytes no lugar do caminho,
+    e arquivos de um driver remoto como ArquivoRemoto (lidos do bucket em fluxo).
+    """
+    saida = _SaidaSemSeek()
+    with zipfile.ZipFile(saida, 'w') as zipf:
+        for caminho, nome, mime_type in arquivos:
+            if isinstance(caminho, bytes):
+                info = zipfile.ZipInfo(nome, time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zipf.writestr(info, caminho)
+                yield saida.coletar()
+                continue
+            if isinstance(caminho, str):
+                info = zipfile.ZipInfo.from_file(caminho, nome)
+                tamanho = os.path.getsize(caminho)
+                abrir = lambda: open(caminho, 'rb')
+            else:
+                info = zipfile.ZipInfo(nome, time.localtime()[:6])
+                tamanho = caminho.tamanho
+                abrir = caminho.abrir
+            info.compress_type = zipfile.ZIP_STORED if mime_type in TIPOS_COMPRIMIDOS else zipfile.ZIP_DEFLATED
+            with abrir() as origem, zipf.open(info, 'w', force_zip64=tamanho > LIMITE_ZIP64) as destino:
+                for bloco in iter(lambda: origem.read(TAMANHO_BLOCO), b''):
+                    destino.write(bloco)
+                    dados = saida.coletar()
+                    if dados:
+                        yield dados
+            yield saida.coletar()
+    # Diretório central, escrito ao fechar o ZipFile
+    yield saida.coletar()
@@ -0,0 +1,167 @@
+# app/consultas.py
+"""
+Consultas SQL por requisição: quantidade, tempo total no banco e a instrução mais lenta,
+medidos pelos eventos do engine. Em desenvolvimento saem no cabeçalho Server-Timing; em
+produção, numa linha de log estruturada. A mesma instrução repetida muitas vezes na
+requisição é sinalizada como N+1, e nos testes um orçamento de consultas estourado falha.
+"""
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_ESPACOS = re.compile(r'\s+')
+# Listas de parâmetros (IN (?, ?, ?)) viram um só marcador: o tamanho da lista não muda a forma
+_LISTA_DE_PARAMETROS = re.compile(r'\(\s*(\?|%s|%\(\w+\)s|:\w+)(\s*,\s*(\?|%s|%\(\w+\)s|:\w+))+\s*\)')
+
+# Logger próprio das linhas estruturadas: o app.logger fica em WARNING fora do modo debug
+logger = logging.getLogger('app.sql')
+
+
+class OrcamentoDeConsultasExcedido(AssertionError):
+    def __init__(self, mensagem, **dados):
+        super().__init__(mensagem)
+        self.mensagem = mensagem
+        self.dados = dados
+
+
+def forma_da_instrucao(statement):
+    """Instrução normalizada: duas consultas com a mesma forma só diferem nos parâmetros."""
+    return _LISTA_DE_PARAMETROS.sub('(?)', _ESPACOS.sub(' ', statement).strip())
+
+
+class EstatisticasDeConsultas:
+    def __init__(self):
+        self.consultas = 0
+        self.tempo = 0.0
+        self.mais_lenta = None
+        self.tempo_mais_lenta = 0.0
+        self.formas = Counter()
+
+    def registrar(self, statement, duracao):
+        self.consultas += 1
+        self.tempo += duracao
+        if duracao >= self.tempo_mais_lenta:
+            self.mais_lenta, self.tempo_mais_lenta = statement, duracao
+        self.formas[forma_da_instrucao(statement)] += 1
+
+    def repetidas(self, limite):
+        """Formas executadas `limite` vezes ou mais, da mais repetida para a menos."""
+        return [(forma, vezes) for forma, vezes in self.formas.most_common() if vezes >= limite]
+
+
+def estatisticas_atuais():
+    if not has_request_context():
+        return None  # Threads de fundo e comandos de linha de comando não são medidos
+    return g.__dict__.get('_consultas')
+
+
+def _antes_de_executar(conn, cursor, statement, parameters, context, executemany):
+    if estatisticas_atuais() is not None:
+        conn.info.setdefault('_inicio_consultas', []).append(time.perf_counter())
+
+
+def _depois_de_executar(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get('_inicio_consultas')
+    estatisticas = estatisticas_atuais()
+    if inicios and estatisticas is not None:
+        estatisticas.registrar(statement, time.perf_counter() - inicios.pop())
+
+
+def _erro_ao_executar(contexto):
+    # A instrução que falhou não chega ao after_cursor_execute: o início dela é descartado
+    inicios = contexto.connection.info.get('_inicio_consultas') if contexto.connection is not None else None
+    if inicios:
+        inicios.pop()
+
+
+def _registrar_eventos():
+    # No Engine (e não numa instância): vale para o banco principal, o de testes e os dos benchmarks
+    if not event.contains(Engine, 'before_cursor_execute', _antes_de_executar):
+        event.listen(Engine, 'before_cursor_execute', _antes_de_executar)
+        event.listen(Engine, 'after_cursor_execute', _depois_de_executar)
+        event.listen(Engine, 'handle_error', _erro_ao_executar)
+
+
+def _resumir(instrucao, limite=200):
+    instrucao = _ESPACOS.sub(' ', instrucao).strip()
+    return instrucao if len(instrucao) <= limite else instrucao[:limite] + '...'
+
+
+def _server_timing(estatisticas, repetidas):
+    metricas = [f'db;dur={estatisticas.tempo * 1000:.1f};desc="{estatisticas.consultas} consultas"']
+    if estatisticas.mais_lenta is not None:
+        metricas.append(f'db-lenta;dur={estatisticas.tempo_mais_lenta * 1000:.1f}')
+    if repetidas:
+        metricas.append(f'db-n-mais-um;desc="{repetidas[0][1]}x {len(repetidas)} forma(s)"')
+    return ', '.join(metricas)
+
+
+def _relatar(resposta, estatisticas):
+    config = current_app.config
+    repetidas = estatisticas.repetidas(config['SQL_N_PLUS_ONE_THRESHOLD'])
+    registro = {
+        "rota": request.endpoint,
+        "metodo": request.method,
+        "caminho": request.path,
+        "status": resposta.status_code,
+        "consultas": estatisticas.consultas,
+        "tempo_db_ms": round(estatisticas.tempo * 1000, 2),
+        "mais_lenta_ms": round(estatisticas.tempo_mais_lenta * 1000, 2),
+        "mais_lenta": _resumir(estatisticas.mais_lenta) if estatisticas.mais_lenta else None,
+        "n_mais_um": [{"forma": _resumir(forma), "vezes": vezes} for forma, vezes in repetidas],
+    }
+    if config['SQL_STATS'] == 'header':
+        resposta.headers['Server-Timing'] = _server_timing(estatisticas, repetidas)
+    else:
+        logger.info(f"sql {json.dumps(registro, ensure_ascii=False)}")
+    if repetidas:
+        current_app.logger.warning(
+            f"Possível N+1 em {request.endpoint}: " +
+            "; ".join(f"{vezes}x {_resumir(forma, 120)}" for forma, vezes in repetidas))
+
+    orcamento = config['SQL_QUERY_BUDGET']
+    if orcamento is not None and estatisticas.consultas > orcamento:
+        mensagem = f"{request.method} {request.path} executou {estatisticas.consultas} consultas " \
+                   f"(orçamento: {orcamento})"
+        if current_app.testing:
+            raise OrcamentoDeConsultasExcedido(mensagem, **registro)
+        current_app.logger.warning(mensagem)
+
+
+def init_consultas(app):
+    # 'header' (Server-Timing, padrão em desenvolvimento e testes), 'log' (padrão em produção) ou 'off'
+    padrao = 'header' if app.config.get('MODE') == 'development' or app.testing else 'log'
+    app.config.setdefault('SQL_STATS', os.getenv('SQL_STATS', padrao))
+    # Execuções da mesma forma de instrução numa requisição a partir das quais ela é sinalizada como N+1
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', int(os.getenv('SQL_N_PLUS_ONE_THRESHOLD', 10)))
+    # Máximo de consultas por requisição: nos testes a requisição que passar dele falha, fora deles só é logada
+    orcamento = os.getenv('SQL_QUERY_BUDGET')
+    app.config.setdefault('SQL_QUERY_BUDGET', int(orcamento) if orcamento else (50 if app.testing else None))
+    if app.config['SQL_STATS'] == 'off':
+        return
+    _registrar_eventos()
+    if not logger.handlers:
+        # Uma linha JSON por requisição, sem depender do nível e dos handlers do app.logger
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    @app.before_request
+    def _iniciar_contagem():
+        g._consultas = EstatisticasDeConsultas()
+
+    @app.after_request
+    def _relatar_consultas(resposta):
+        estatisticas = g.__dict__.pop('_consultas', None)
+        if estatisticas is not None:
+            _relatar(resposta, estatisticas)
+        return resposta
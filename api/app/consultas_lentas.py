@@ -0,0 +1,172 @@
+# app/consultas_lentas.py
+"""
+Registro de consultas lentas: toda instrução que passa de SLOW_QUERY_MS é guardada com o SQL,
+os parâmetros mascarados, a rota que a executou e o plano do banco (EXPLAIN QUERY PLAN no SQLite,
+EXPLAIN nos demais). Os registros ficam num buffer circular por processo, consultável em
+/api/diagnostico/consultas_lentas, e opcionalmente em SLOW_QUERY_FILE (uma linha JSON por consulta),
+que reúne os processos de um servidor pre-fork.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_ESPACOS = re.compile(r'\s+')
+# Planos que leem a tabela inteira: candidatos a um índice
+_VARREDURA = re.compile(r'^SCAN (?:TABLE )?(\w+)$|Seq Scan on (\w+)')
+
+_gravador = None
+logger = logging.getLogger('app')  # O mesmo logger de app.logger, também fora de uma requisição
+
+
+def mascarar(parametros):
+    """Mantém números, booleanos e nulos; os demais valores (nomes, e-mails, CPFs, ids) viram o tipo."""
+    def mascarar_valor(valor):
+        if valor is None or isinstance(valor, (bool, int, float)):
+            return valor
+        if isinstance(valor, (str, bytes)):
+            return f"<{type(valor).__name__}:{len(valor)}>"
+        return f"<{type(valor).__name__}>"
+
+    if isinstance(parametros, dict):
+        return {nome: mascarar_valor(valor) for nome, valor in parametros.items()}
+    if isinstance(parametros, (list, tuple)):
+        return [mascarar_valor(valor) for valor in parametros]
+    return None
+
+
+def explicar(conn, statement, parameters):
+    """Plano da instrução, executado num cursor à parte (não passa pelos eventos do engine)."""
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None  # Só leituras: o plano de uma escrita não ajuda a achar índices faltando
+    sqlite = conn.dialect.name == 'sqlite'
+    cursor = conn.connection.cursor()
+    try:
+        if sqlite:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            linhas = cursor.fetchall()
+        else:
+            # Num savepoint, para que uma falha do EXPLAIN não invalide a transação da requisição
+            cursor.execute('SAVEPOINT explicar_consulta_lenta')
+            try:
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                linhas = cursor.fetchall()
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT explicar_consulta_lenta')
+                raise
+            cursor.execute('RELEASE SAVEPOINT explicar_consulta_lenta')
+    finally:
+        cursor.close()
+    if sqlite:
+        return [str(linha[-1]) for linha in linhas]  # A coluna 'detail'
+    return [' | '.join(str(coluna) for coluna in linha if coluna is not None) for linha in linhas]
+
+
+def tabelas_varridas(plano):
+    tabelas = []
+    for linha in plano or []:
+        encontrado = _VARREDURA.search(linha.strip())
+        if encontrado:
+            tabelas.append(encontrado.group(1) or encontrado.group(2) or linha.strip())
+    return tabelas
+
+
+class GravadorDeConsultasLentas:
+    def __init__(self, limite_ms=500, capacidade=200, arquivo=None, explicar=True):
+        self.limite_ms = limite_ms
+        self.arquivo = arquivo
+        self.explicar = explicar
+        self.registros = deque(maxlen=capacidade)
+        self._lock = threading.Lock()
+
+    def registrar(self, registro):
+        with self._lock:
+            self.registros.append(registro)
+            if self.arquivo:
+                try:
+                    with open(self.arquivo, 'a') as saida:
+                        saida.write(json.dumps(registro, ensure_ascii=False, default=str) + '\n')
+                except OSError as e:
+                    # Chamado de dentro da execução da consulta: uma falha aqui não pode derrubá-la
+                    logger.warning(f"Não foi possível gravar a consulta lenta em {self.arquivo}: {str(e)}")
+
+    def listar(self, limite=None):
+        """Registros do mais recente para o mais antigo."""
+        with self._lock:
+            registros = list(reversed(self.registros))
+        return registros[:limite] if limite else registros
+
+    def limpar(self):
+        with self._lock:
+            self.registros.clear()
+
+
+def _antes_de_executar(conn, cursor, statement, parameters, context, executemany):
+    if _gravador is not None and context is not None:
+        context._inicio_consulta_lenta = time.perf_counter()
+
+
+def _depois_de_executar(conn, cursor, statement, parameters, context, executemany):
+    gravador = _gravador
+    inicio = getattr(context, '_inicio_consulta_lenta', None)
+    if gravador is None or inicio is None:
+        return
+    duracao_ms = (time.perf_counter() - inicio) * 1000
+    if duracao_ms < gravador.limite_ms:
+        return
+
+    plano, erro_plano = None, None
+    if gravador.explicar and not executemany:
+        try:
+            plano = explicar(conn, statement, parameters)
+        except Exception as e:
+            erro_plano = str(e)
+    registro = {
+        "em": datetime.now().isoformat(timespec='seconds'),
+        "duracao_ms": round(duracao_ms, 2),
+        "sql": _ESPACOS.sub(' ', statement).strip(),
+        "parametros": mascarar(parameters[0] if executemany and parameters else parameters),
+        "execucoes": len(parameters) if executemany else 1,
+        "rota": request.endpoint if has_request_context() else None,
+        "metodo": request.method if has_request_context() else None,
+        # O molde da rota: o caminho da requisição pode trazer e-mails, CPFs e ids
+        "caminho": request.url_rule.rule if has_request_context() and request.url_rule else None,
+        "plano": plano,
+        "tabelas_varridas": tabelas_varridas(plano),
+        "pid": os.getpid(),
+    }
+    if erro_plano:
+        registro["erro_plano"] = erro_plano
+    gravador.registrar(registro)
+
+
+def _registrar_eventos():
+    if not event.contains(Engine, 'before_cursor_execute', _antes_de_executar):
+        event.listen(Engine, 'before_cursor_execute', _antes_de_executar)
+        event.listen(Engine, 'after_cursor_execute', _depois_de_executar)
+
+
+def init_consultas_lentas(app):
+    global _gravador
+    # Instruções a partir dessa duração são registradas; vazio desliga o registro
+    limite = os.getenv('SLOW_QUERY_MS', '500')
+    app.config.setdefault('SLOW_QUERY_MS', float(limite) if limite else None)
+    app.config.setdefault('SLOW_QUERY_BUFFER', int(os.getenv('SLOW_QUERY_BUFFER', 200)))
+    app.config.setdefault('SLOW_QUERY_FILE', os.getenv('SLOW_QUERY_FILE'))
+    app.config.setdefault('SLOW_QUERY_EXPLAIN', os.getenv('SLOW_QUERY_EXPLAIN', 'True') == 'True')
+    if app.config['SLOW_QUERY_MS'] is None:
+        _gravador = None
+        return
+    # Os eventos valem para todos os engines: o gravador é o da aplicação criada por último
+    _gravador = GravadorDeConsultasLentas(app.config['SLOW_QUERY_MS'], app.config['SLOW_QUERY_BUFFER'],
+                                          app.config['SLOW_QUERY_FILE'], app.config['SLOW_QUERY_EXPLAIN'])
+    app.extensions['consultas_lentas'] = _gravador
+    _registrar_eventos()
@@ -0,0 +1,280 @@
+# app/consumo.py
+import os
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import case, func
+from sqlalchemy.exc import IntegrityError
+
+from app.models.company import Company
+from app.models.exam import Exam
+from app.models.exam_image import ExamImage
+from app.models.storage_usage import CompanyQuota, StorageUsage, UsageScope
+from app.models.upload_session import UploadSession, UploadStatus
+
+
+class CotaExcedida(Exception):
+    """O envio levaria a empresa além da cota rígida de armazenamento."""
+
+    def __init__(self, mensagem, **dados):
+        super().__init__(mensagem)
+        self.mensagem = mensagem
+        self.dados = dados
+
+
+def bytes_da_imagem(imagem):
+    """Bytes atribuídos à imagem: o conteúdo atual e, se mantido, o original antes da otimização."""
+    total = imagem.size or 0
+    if imagem.original_checksum and imagem.original_size:
+        total += imagem.original_size
+    return total
+
+
+def _incrementar(db, escopo, dono, company_id, bytes, arquivos, limite=None):
+    """
+    Soma ao contador com um UPDATE relativo, sem ler antes: uploads simultâneos não se sobrescrevem.
+    A linha é criada no primeiro uso; contadores ausentes nunca começam negativos
+    (o `flask recalcular-consumo` inicializa uma base que já tinha imagens).
+    Com `limite` o UPDATE só acontece se o total continuar dentro dele; senão lança CotaExcedida.
+    """
+    for _ in range(2):
+        consulta = db.query(StorageUsage)\
+            .filter(StorageUsage.scope == escopo, StorageUsage.owner_id == dono)
+        if limite is not None:
+            consulta = consulta.filter(StorageUsage.bytes + bytes <= limite)
+        atualizados = consulta.update({"bytes": StorageUsage.bytes + bytes, "files": StorageUsage.files + arquivos},
+                                      synchronize_session=False)
+        if atualizados:
+            return
+        if limite is not None:
+            usados, _ = _contador(db, escopo, dono)
+            if usados or bytes > limite:
+                # Outro envio concluído depois da verificação prévia ocupou o espaço
+                raise CotaExcedida('Cota de armazenamento da empresa excedida', bytes_usados=usados,
+                                   bytes_enviados=bytes, cota=limite)
+        try:
+            # Savepoint: outra requisição pode criar o mesmo contador ao mesmo tempo
+            with db.begin_nested():
+                db.add(StorageUsage(scope=escopo, owner_id=dono, company_id=company_id,
+                                    bytes=max(bytes, 0), files=max(arquivos, 0)))
+            return
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"Não foi possível atualizar o consumo de {escopo} {dono}")
+
+
+def empresa_do_exame(db, exam_id):
+    """Empresa do exame; se ele já foi apagado, a registrada no contador do exame."""
+    company_id = db.query(Exam.company_id).filter(Exam.id == exam_id).scalar()
+    if company_id is None:
+        company_id = db.query(StorageUsage.company_id)\
+            .filter(StorageUsage.scope == UsageScope.EXAM, StorageUsage.owner_id == exam_id).scalar()
+    return company_id
+
+
+def registrar_consumo(db, exam_id, bytes, arquivos, company_id=None, respeitar_cota=False):
+    """
+    Aplica a variação aos contadores do exame e da empresa, na mesma transação da imagem.
+    Com `respeitar_cota` (uploads) o acréscimo à empresa é condicionado à cota rígida no próprio
+    UPDATE: envios simultâneos que passaram juntos pela verificação prévia não a ultrapassam.
+    """
+    if not bytes and not arquivos:
+        return
+    if company_id is None:
+        company_id = empresa_do_exame(db, exam_id)
+    if company_id is None:
+        return  # Imagem sem exame nem contador: não há a quem atribuir
+    limite = cotas(db, company_id)[1] if respeitar_cota and bytes > 0 else None
+    _incrementar(db, UsageScope.COMPANY, company_id, company_id, bytes, arquivos, limite)
+    _incrementar(db, UsageScope.EXAM, exam_id, company_id, bytes, arquivos)
+
+
+def remover_exame(db, exam_id):
+    """Descarta o contador do exame apagado (as imagens já foram descontadas da empresa)."""
+    db.query(StorageUsage)\
+      .filter(StorageUsage.scope == UsageScope.EXAM, StorageUsage.owner_id == exam_id)\
+      .delete(synchronize_session=False)
+
+
+def transferir_exame(db, exam_id, anterior, nova):
+    """Exame movido para outra empresa: o que ele ocupa passa a contar para a nova."""
+    bytes, arquivos = _contador(db, UsageScope.EXAM, exam_id)
+    if anterior == nova or not (bytes or arquivos):
+        return
+    db.query(StorageUsage)\
+      .filter(StorageUsage.scope == UsageScope.EXAM, StorageUsage.owner_id == exam_id)\
+      .update({"company_id": nova}, synchronize_session=False)
+    _incrementar(db, UsageScope.COMPANY, anterior, anterior, -bytes, -arquivos)
+    _incrementar(db, UsageScope.COMPANY, nova, nova, bytes, arquivos)
+
+
+def cotas(db, company_id):
+    """(suave, rígida) da empresa, caindo nos padrões da configuração quando não definidas."""
+    suave, rigida = db.query(CompanyQuota.soft_quota, CompanyQuota.hard_quota)\
+                      .filter(CompanyQuota.company_id == company_id).first() or (None, None)
+    config = current_app.config
+    return (suave if suave is not None else config['STORAGE_SOFT_QUOTA_BYTES'],
+            rigida if rigida is not None else config['STORAGE_HARD_QUOTA_BYTES'])
+
+
+def _contador(db, escopo, dono):
+    return db.query(StorageUsage.bytes, StorageUsage.files)\
+             .filter(StorageUsage.scope == escopo, StorageUsage.owner_id == dono).first() or (0, 0)
+
+
+def bytes_reservados(db, company_id, exceto_sessao=None):
+    """Tamanho declarado dos uploads retomáveis ainda abertos (ou em finalização) da empresa, que já contam contra a cota."""
+    consulta = db.query(func.coalesce(func.sum(UploadSession.size), 0))\
+                 .join(Exam, Exam.id == UploadSession.exam_id)\
+                 .filter(Exam.company_id == company_id,
+                         UploadSession.status.in_([UploadStatus.OPEN, UploadStatus.FINALIZING]),
+                         UploadSession.expires_at >= datetime.now())
+    if exceto_sessao is not None:
+        consulta = consulta.filter(UploadSession.id != exceto_sessao)
+    return int(consulta.scalar())
+
+
+def verificar_cota(db, company_id, bytes_novos, exceto_sessao=None):
+    """
+    Chamada antes de gravar qualquer byte: lança CotaExcedida se o envio ultrapassa a cota rígida.
+    Acima da cota suave o envio segue e o aviso devolvido acompanha a resposta (None se dentro das cotas).
+    Os uploads retomáveis abertos reservam o seu tamanho: sessões simultâneas não passam juntas da cota.
+    """
+    suave, rigida = cotas(db, company_id)
+    if suave is None and rigida is None:
+        return None
+    usados, _ = _contador(db, UsageScope.COMPANY, company_id)
+    reservados = bytes_reservados(db, company_id, exceto_sessao)
+    previsto = usados + reservados + bytes_novos
+    if rigida is not None and previsto > rigida:
+        raise CotaExcedida('Cota de armazenamento da empresa excedida', bytes_usados=usados,
+                           bytes_reservados=reservados, bytes_enviados=bytes_novos, cota=rigida)
+    if suave is not None and previsto > suave:
+        return {'mensagem': 'Armazenamento da empresa acima da cota recomendada',
+                'bytes_usados': previsto, 'cota': suave}
+    return None
+
+
+def situacao(bytes, suave, rigida):
+    if rigida is not None and bytes >= rigida:
+        return 'cota_rigida'
+    if suave is not None and bytes > suave:
+        return 'cota_suave'
+    return 'ok'
+
+
+def uso(db, company_id, exames=10):
+    """Consumo da empresa com as cotas vigentes e os exames que mais ocupam espaço."""
+    bytes, arquivos = _contador(db, UsageScope.COMPANY, company_id)
+    suave, rigida = cotas(db, company_id)
+    maiores = db.query(StorageUsage)\
+                .filter(StorageUsage.scope == UsageScope.EXAM, StorageUsage.company_id == company_id)\
+                .order_by(StorageUsage.bytes.desc())\
+                .limit(exames)\
+                .all()
+    return {
+        "company_id": company_id,
+        "bytes": bytes,
+        "arquivos": arquivos,
+        "cota_suave": suave,
+        "cota_rigida": rigida,
+        "situacao": situacao(bytes, suave, rigida),
+        "exames": [{"exam_id": contador.owner_id, "bytes": contador.bytes, "arquivos": contador.files}
+                   for contador in maiores]
+    }
+
+
+def uso_do_exame(db, exam_id):
+    bytes, arquivos = _contador(db, UsageScope.EXAM, exam_id)
+    return {"exam_id": exam_id, "bytes": bytes, "arquivos": arquivos}
+
+
+def relatorio_consumo(db, limite=None):
+    """Empresas ordenadas pelo espaço ocupado, lidas só dos contadores (sem somar as imagens)."""
+    config = current_app.config
+    consulta = db.query(StorageUsage, Company.name, CompanyQuota.soft_quota, CompanyQuota.hard_quota)\
+                 .outerjoin(Company, Company.id == StorageUsage.owner_id)\
+                 .outerjoin(CompanyQuota, CompanyQuota.company_id == StorageUsage.owner_id)\
+                 .filter(StorageUsage.scope == UsageScope.COMPANY)\
+                 .order_by(StorageUsage.bytes.desc())
+    if limite:
+        consulta = consulta.limit(limite)
+    empresas = []
+    for contador, nome, suave, rigida in consulta:
+        suave = suave if suave is not None else config['STORAGE_SOFT_QUOTA_BYTES']
+        rigida = rigida if rigida is not None else config['STORAGE_HARD_QUOTA_BYTES']
+        empresas.append({
+            "company_id": contador.owner_id,
+            "nome": nome,
+            "bytes": contador.bytes,
+            "arquivos": contador.files,
+            "cota_suave": suave,
+            "cota_rigida": rigida,
+            "situacao": situacao(contador.bytes, suave, rigida)
+        })
+    bytes, arquivos = db.query(func.coalesce(func.sum(StorageUsage.bytes), 0),
+                               func.coalesce(func.sum(StorageUsage.files), 0))\
+                        .filter(StorageUsage.scope == UsageScope.COMPANY).one()
+    return {"bytes": int(bytes), "arquivos": int(arquivos), "empresas": empresas}
+
+
+def recalcular(db):
+    """
+    Reconstrói todos os contadores a partir das imagens com GROUP BY. Usado para inicializar
+    uma base existente e para corrigir divergências; as atualizações incrementais seguem valendo.
+    """
+    originais = func.sum(case((ExamImage.original_checksum.isnot(None), ExamImage.original_size), else_=0))
+    linhas = db.query(Exam.company_id, ExamImage.exam_id,
+                      func.coalesce(func.sum(ExamImage.size), 0) + func.coalesce(originais, 0),
+                      func.count(ExamImage.id))\
+               .join(Exam, Exam.id == ExamImage.exam_id)\
+               .group_by(Exam.company_id, ExamImage.exam_id)\
+               .all()
+
+    db.query(StorageUsage).delete(synchronize_session=False)
+    empresas = {}
+    for company_id, exam_id, bytes, arquivos in linhas:
+        db.add(StorageUsage(scope=UsageScope.EXAM, owner_id=exam_id, company_id=company_id,
+                            bytes=int(bytes), files=arquivos))
+        total = empresas.setdefault(company_id, [0, 0])
+        total[0] += int(bytes)
+        total[1] += arquivos
+    for company_id, (bytes, arquivos) in empresas.items():
+        db.add(StorageUsage(scope=UsageScope.COMPANY, owner_id=company_id, company_id=company_id,
+                            bytes=bytes, files=arquivos))
+    db.commit()
+    return {"empresas": len(empresas), "exames": len(linhas)}
+
+
+def _bytes_opcional(valor):
+    return int(valor) if valor else None
+
+
+def init_consumo(app):
+    # Cotas padrão por empresa, em bytes; vazias desligam a verificação
+    app.config.setdefault('STORAGE_SOFT_QUOTA_BYTES', _bytes_opcional(os.getenv('STORAGE_SOFT_QUOTA_BYTES')))
+    app.config.setdefault('STORAGE_HARD_QUOTA_BYTES', _bytes_opcional(os.getenv('STORAGE_HARD_QUOTA_BYTES')))
+
+    @app.cli.command('recalcular-consumo')
+    def recalcular_consumo_command():
+        """Reconstrói os contadores de armazenamento a partir das imagens (executar uma vez na implantação)."""
+        from app import get_db
+        db = get_db()
+        try:
+            print(f"Contadores recalculados: {recalcular(db)}")
+        finally:
+            db.close()
+
+    @app.cli.command('relatorio-armazenamento')
+    def relatorio_armazenamento_command():
+        """Mostra o espaço ocupado por empresa e a situação das cotas."""
+        from app import get_db
+        db = get_db()
+        try:
+            relatorio = relatorio_consumo(db)
+            print(f"Total: {relatorio['bytes']} bytes em {relatorio['arquivos']} arquivos")
+            for empresa in relatorio['empresas']:
+                print(f"{empresa['company_id']}  {empresa['bytes']:>14}  {empresa['arquivos']:>8}  "
+                      f"{empresa['situacao']:<11}  {empresa['nome'] or ''}")
+        finally:
+            db.close()
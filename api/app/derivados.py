@@ -0,0 +1,188 @@
+# app/derivados.py
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+from app import armazenamento
+from app.metricas import contar_cache
+
+# Formato pedido pelo navegador -> (extensão, formato do Pillow, mimetype)
+FORMATOS = {
+    'webp': ('webp', 'WEBP', 'image/webp'),
+    'jpeg': ('jpg', 'JPEG', 'image/jpeg'),
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _descartar_pool_herdado():
+    # Num fork depois do pool criado, o filho herdaria um executor cujas threads ficaram no pai
+    global _pool, _pool_lock
+    _pool, _pool_lock = None, threading.Lock()
+
+
+os.register_at_fork(after_in_child=_descartar_pool_herdado)
+
+
+def caminho_derivado(checksum, largura, formato):
+    """'derivados/<aa>/<bb>/<sha256>_<largura>.<ext>': derivados valem para todas as duplicatas."""
+    extensao = FORMATOS[formato][0]
+    return f"derivados/{checksum[0:2]}/{checksum[2:4]}/{checksum}_{largura}.{extensao}"
+
+
+def _abrir(origem, mime_type, largura_maxima):
+    from PIL import Image
+
+    if mime_type == 'application/pdf':
+        import pypdfium2
+        pdf = pypdfium2.PdfDocument(origem)
+        try:
+            pagina = pdf[0]
+            # Renderiza a primeira página já perto da maior largura pedida
+            escala = max(largura_maxima / pagina.get_width(), 0.1)
+            return pagina.render(scale=escala).to_pil()
+        finally:
+            pdf.close()
+
+    imagem = Image.open(origem)
+    imagem.draft('RGB', (largura_maxima, largura_maxima))  # JPEG: decodifica já reduzido
+    return imagem
+
+
+def gerar_derivados(origem, pasta, checksum, mime_type, larguras, formatos):
+    """
+    Executado no pool de processos: gera as miniaturas de cada largura e formato.
+    Cada arquivo é gravado num temporário e renomeado, então leitores nunca veem um derivado pela metade.
+    """
+    from PIL import Image, ImageOps
+
+    imagem = _abrir(origem, mime_type, max(larguras))
+    imagem = ImageOps.exif_transpose(imagem)
+    if imagem.mode not in ('RGB', 'RGBA'):
+        imagem = imagem.convert('RGBA' if 'transparency' in imagem.info else 'RGB')
+
+    gerados = []
+    for largura in sorted(larguras, reverse=True):
+        copia = imagem.copy()
+        copia.thumbnail((largura, largura * 4), Image.LANCZOS)  # Nunca amplia o original
+        for formato in formatos:
+            relativo = caminho_derivado(checksum, largura, formato)
+            destino = os.path.join(pasta, relativo)
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            temporario = f"{destino}.{os.getpid()}.tmp"
+            saida = copia.convert('RGB') if formato == 'jpeg' and copia.mode != 'RGB' else copia
+            saida.save(temporario, FORMATOS[formato][1], quality=80)
+            os.replace(temporario, destino)
+            gerados.append(relativo)
+    return gerados
+
+
+def _get_pool(app):
+    global _pool
+    with _pool_lock:
+        # Criado sob demanda no processo que atende a requisição (compatível com pre-fork)
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=app.config['DERIVATIVES_WORKERS'])
+    return _pool
+
+
+def suporta_derivados(mime_type):
+    return mime_type.startswith('image/') or mime_type == 'application/pdf'
+
+
+def agendar(imagens):
+    """Gera os derivados das imagens recém-enviadas fora da requisição."""
+    app = current_app._get_current_object()
+    larguras = app.config['DERIVATIVE_WIDTHS']
+    pasta = app.config['UPLOAD_FOLDER']
+    pendentes = {}
+    for imagem in imagens:
+        # Conteúdo duplicado já tem derivados: o nome do arquivo é o hash
+        if not suporta_derivados(imagem.mime_type) or \
+                os.path.exists(os.path.join(pasta, caminho_derivado(imagem.checksum, larguras[0], 'webp'))):
+            continue
+        # Blobs num driver remoto não são baixados aqui: o derivado é gerado na primeira leitura
+        origem = armazenamento.localizar(imagem.path)
+        if origem:
+            pendentes[imagem.checksum] = (origem, imagem.mime_type)
+
+    for checksum, (origem, mime_type) in pendentes.items():
+        argumentos = (origem, pasta, checksum, mime_type, larguras, list(FORMATOS))
+        if app.config['DERIVATIVES_SYNC']:
+            try:
+                gerar_derivados(*argumentos)
+            except Exception as e:
+                app.logger.error(f"Erro ao gerar derivados de {checksum}: {str(e)}")
+            continue
+        futuro = _get_pool(app).submit(gerar_derivados, *argumentos)
+        futuro.add_done_callback(_registrar_falha(app, checksum))
+
+
+def _registrar_falha(app, checksum):
+    def callback(futuro):
+        # Sem retentativa: o endpoint regenera o derivado que faltar na primeira leitura
+        if futuro.exception() is not None:
+            app.logger.error(f"Erro ao gerar derivados de {checksum}: {str(futuro.exception())}")
+    return callback
+
+
+def escolher_largura(pedida, larguras):
+    """Menor largura configurada que atende ao pedido (ou a maior disponível)."""
+    for largura in sorted(larguras):
+        if largura >= pedida:
+            return largura
+    return max(larguras)
+
+
+def obter_derivado(imagem, largura, formato):
+    """
+    Caminho absoluto do derivado, gerando-o na hora se ainda não existir
+    (upload anterior aos derivados ou tarefa que falhou).
+    """
+    relativo = caminho_derivado(imagem.checksum, largura, formato)
+    absoluto = armazenamento.caminho_absoluto(relativo)
+    existe = os.path.exists(absoluto)
+    contar_cache('derivados', existe)
+    if not existe:
+        with armazenamento.copia_local(imagem.path) as origem:
+            if origem is None:
+                return None
+            gerar_derivados(origem, current_app.config['UPLOAD_FOLDER'], imagem.checksum, imagem.mime_type,
+                            [largura], [formato])
+    return absoluto
+
+
+def regenerar_por_caminho(relativo):
+    """
+    Recria um derivado a partir do próprio caminho ('derivados/aa/bb/<sha256>_<largura>.<ext>'),
+    sem consultar o banco: o original é o blob com o mesmo hash.
+    Derivados ficam sempre no disco local, como cache de cada nó.
+    """
+    from app.blobs import caminho_blob
+
+    nome, extensao = os.path.splitext(os.path.basename(relativo))
+    checksum, _, largura = nome.rpartition('_')
+    formato = next((chave for chave, (ext, _, _) in FORMATOS.items() if f".{ext}" == extensao), None)
+    if formato is None or not largura.isdigit() or not checksum:
+        return None
+    with armazenamento.copia_local(caminho_blob(checksum)) as origem:
+        if origem is None:
+            return None
+        with open(origem, 'rb') as arquivo:
+            mime_type = 'application/pdf' if arquivo.read(5) == b'%PDF-' else 'image/*'
+        gerar_derivados(origem, current_app.config['UPLOAD_FOLDER'], checksum, mime_type, [int(largura)], [formato])
+    return armazenamento.caminho_absoluto(relativo)
+
+
+def caminhos_dos_derivados(checksum, larguras):
+    return [caminho_derivado(checksum, largura, formato) for largura in larguras for formato in FORMATOS]
+
+
+def init_derivados(app):
+    app.config.setdefault('DERIVATIVE_WIDTHS', [160, 480, 1280])
+    app.config.setdefault('DERIVATIVES_WORKERS', 2)
+    # Nos testes os derivados são gerados na própria requisição, de forma determinística
+    app.config.setdefault('DERIVATIVES_SYNC', app.config.get('TESTING', False))
@@ -0,0 +1,150 @@
+# app/drivers.py
+import os
+from urllib.parse import quote
+
+from app.armazenamento import caminho_relativo
+
+
+class DriverLocal:
+    """Arquivos no disco do próprio nó, dentro da pasta de upload."""
+
+    remoto = False
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+
+    def caminho(self, chave):
+        """
+        Caminho absoluto existente, aceitando chave relativa ou caminho absoluto.
+        Durante a migração o arquivo pode estar no formato plano ou fragmentado: tenta os dois.
+        """
+        absoluto = chave if os.path.isabs(chave) else os.path.join(self.pasta, chave)
+        if os.path.exists(absoluto):
+            return absoluto
+        nome = os.path.basename(chave)
+        for alternativo in (os.path.join(self.pasta, caminho_relativo(nome)), os.path.join(self.pasta, nome)):
+            if os.path.exists(alternativo):
+                return alternativo
+        return None
+
+    def gravar(self, chave, origem):
+        """Move o arquivo local `origem` para a chave (rename atômico no mesmo sistema de arquivos)."""
+        destino = os.path.join(self.pasta, chave)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(origem, destino)
+
+    def abrir(self, chave):
+        caminho = self.caminho(chave)
+        if caminho is None:
+            raise FileNotFoundError(chave)
+        return open(caminho, 'rb')
+
+    def tamanho(self, chave):
+        caminho = self.caminho(chave)
+        return os.path.getsize(caminho) if caminho else None
+
+    def apagar(self, chave):
+        caminho = self.caminho(chave)
+        if caminho is None:
+            return False
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def listar(self, prefixo):
+        """(chave, tamanho, modificado) de cada arquivo sob o prefixo, lidos com os.scandir."""
+        pendentes = [prefixo.rstrip('/')]
+        while pendentes:
+            atual = pendentes.pop()
+            try:
+                entradas = os.scandir(os.path.join(self.pasta, atual))
+            except FileNotFoundError:
+                continue
+            with entradas:
+                for entrada in entradas:
+                    chave = f"{atual}/{entrada.name}" if atual else entrada.name
+                    if entrada.is_dir(follow_symlinks=False):
+                        pendentes.append(chave)
+                    elif entrada.is_file(follow_symlinks=False):
+                        estado = entrada.stat()
+                        yield chave, estado.st_size, estado.st_mtime
+
+    def url_assinada(self, chave, mime_type, nome='', validade=None):
+        # A própria API serve o arquivo, conferindo a assinatura HMAC
+        from app.assinatura import gerar_url_arquivo
+        return gerar_url_arquivo(chave, mime_type, nome, validade)
+
+
+class DriverS3:
+    """
+    Bucket S3 ou compatível (MinIO, moto): todos os nós da aplicação enxergam os mesmos arquivos.
+    O boto3 só é necessário quando este driver está configurado.
+    """
+
+    remoto = True
+
+    def __init__(self, bucket, prefixo='', cliente=None, **opcoes):
+        if cliente is None:
+            import boto3
+            from botocore.config import Config
+            # SigV4 é o que o MinIO e as regiões novas da AWS aceitam nas URLs pré-assinadas
+            cliente = boto3.client('s3', config=Config(signature_version='s3v4'), **opcoes)
+        self.cliente = cliente
+        self.bucket = bucket
+        self.prefixo = f"{prefixo.strip('/')}/" if prefixo.strip('/') else ''
+
+    def _chave(self, chave):
+        return self.prefixo + chave
+
+    def _ausente(self, erro):
+        return erro.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def gravar(self, chave, origem):
+        """Envia o arquivo local (multipart acima de 8 MB) e apaga a cópia local."""
+        self.cliente.upload_file(origem, self.bucket, self._chave(chave))
+        os.remove(origem)
+
+    def abrir(self, chave):
+        """Corpo da resposta do GET: lido em blocos, sem baixar o objeto inteiro."""
+        from botocore.exceptions import ClientError
+        try:
+            return self.cliente.get_object(Bucket=self.bucket, Key=self._chave(chave))['Body']
+        except ClientError as e:
+            if self._ausente(e):
+                raise FileNotFoundError(chave) from e
+            raise
+
+    def tamanho(self, chave):
+        from botocore.exceptions import ClientError
+        try:
+            return self.cliente.head_object(Bucket=self.bucket, Key=self._chave(chave))['ContentLength']
+        except ClientError as e:
+            if self._ausente(e):
+                return None
+            raise
+
+    def apagar(self, chave):
+        self.cliente.delete_object(Bucket=self.bucket, Key=self._chave(chave))
+        return True
+
+    def listar(self, prefixo):
+        paginador = self.cliente.get_paginator('list_objects_v2')
+        for pagina in paginador.paginate(Bucket=self.bucket, Prefix=self._chave(prefixo)):
+            for objeto in pagina.get('Contents', []):
+                yield objeto['Key'][len(self.prefixo):], objeto['Size'], objeto['LastModified'].timestamp()
+
+    def url_assinada(self, chave, mime_type, nome='', validade=None):
+        """URL pré-assinada do GET: o navegador baixa direto do bucket, sem passar pela API."""
+        from flask import current_app
+        parametros = {'Bucket': self.bucket, 'Key': self._chave(chave)}
+        if mime_type:
+            parametros['ResponseContentType'] = mime_type
+        if nome:
+            parametros['ResponseContentDisposition'] = f"inline; filename*=UTF-8''{quote(nome)}"
+        if validade is None:
+            validade = current_app.config['MEDIA_URL_MAX_AGE']
+        # SigV4 aceita no máximo 7 dias
+        return self.cliente.generate_presigned_url('get_object', Params=parametros,
+                                                   ExpiresIn=max(1, min(int(validade), 7 * 24 * 3600)))
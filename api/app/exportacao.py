@@ -0,0 +1,123 @@
+# app/exportacao.py
+import csv
+import hashlib
+import io
+import os
+import tempfile
+from datetime import datetime
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from app import armazenamento
+from app.compactacao import gerar_zip
+from app.models.exam import Exam
+from app.models.exam_image import ExamImage
+from app.models.user import User
+
+COLUNAS_MANIFESTO = ['trabalhador', 'cpf', 'exame_id', 'data_exame', 'descricao', 'arquivo', 'tamanho', 'sha256']
+
+
+def pasta_exportacoes():
+    pasta = os.path.join(current_app.config['UPLOAD_FOLDER'], 'exportacoes')
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
+
+
+def selecionar_imagens(db, company_id, data_inicial, data_final):
+    """Imagens dos exames entregues da empresa no período, numa única consulta."""
+    return db.query(User, Exam, ExamImage)\
+             .join(Exam, Exam.user_id == User.id)\
+             .join(ExamImage, ExamImage.exam_id == Exam.id)\
+             .filter(Exam.company_id == company_id,
+                     Exam.image_uploaded == True,
+                     Exam.exam_date >= datetime.strptime(data_inicial, '%Y-%m-%d').date(),
+                     Exam.exam_date <= datetime.strptime(data_final, '%Y-%m-%d').date())\
+             .order_by(User.name, Exam.exam_date, Exam.id, ExamImage.position)\
+             .all()
+
+
+def nome_no_zip(usuario, exame, imagem):
+    """'<trabalhador>_<cpf>/<data>/<arquivo>': uma pasta por trabalhador e por data."""
+    pasta = secure_filename(f"{usuario.name}_{usuario.cpf}") or usuario.id
+    data = exame.exam_date.isoformat() if exame.exam_date else 'sem_data'
+    return f"{pasta}/{data}/{imagem.name}"
+
+
+def montar_manifesto(linhas):
+    saida = io.StringIO()
+    escritor = csv.writer(saida)
+    escritor.writerow(COLUNAS_MANIFESTO)
+    for usuario, exame, imagem in linhas:
+        escritor.writerow([
+            usuario.name, usuario.cpf, exame.id,
+            exame.exam_date.isoformat() if exame.exam_date else '',
+            exame.description or '', nome_no_zip(usuario, exame, imagem), imagem.size, imagem.checksum
+        ])
+    return saida.getvalue().encode('utf-8')
+
+
+def preparar(db, company_id, data_inicial, data_final):
+    """
+    Seleciona as imagens e monta o manifesto. A chave do cache é o hash do manifesto,
+    que lista cada arquivo com o seu SHA-256: muda sempre que o conjunto de imagens muda.
+    """
+    linhas = selecionar_imagens(db, company_id, data_inicial, data_final)
+    manifesto = montar_manifesto(linhas)
+    chave = hashlib.sha256(company_id.encode('utf-8') + manifesto).hexdigest()
+    return linhas, manifesto, chave
+
+
+def caminho_em_cache(chave):
+    return os.path.join(pasta_exportacoes(), f"{chave}.zip")
+
+
+def url_download(chave):
+    return f"/api/exames/exportacoes/{chave}"
+
+
+def url_fluxo(company_id, data_inicial, data_final):
+    return f"/api/exames/exportar/{company_id}?data_inicial={data_inicial}&data_final={data_final}"
+
+
+def entradas(linhas, manifesto, ao_incluir=None):
+    """Itens para `gerar_zip`: o manifesto primeiro e depois cada imagem encontrada em disco."""
+    yield manifesto, 'manifesto.csv', 'text/csv'
+    for usuario, exame, imagem in linhas:
+        caminho = armazenamento.origem(imagem.path, imagem.size)
+        if caminho is None:
+            current_app.logger.warning(f"Arquivo da imagem {imagem.name} não encontrado na exportação")
+        else:
+            yield caminho, nome_no_zip(usuario, exame, imagem), imagem.mime_type
+        if ao_incluir:
+            ao_incluir()
+
+
+def exportar_para_cache(db, progresso, company_id, data_inicial, data_final):
+    """Tarefa em segundo plano: grava o ZIP no cache, de forma atômica, e devolve o link."""
+    linhas, manifesto, chave = preparar(db, company_id, data_inicial, data_final)
+    progresso.definir_total(len(linhas))
+    destino = caminho_em_cache(chave)
+
+    if not os.path.exists(destino):
+        # Nome único por chamada: duas tarefas da mesma exportação podem rodar em threads do mesmo processo
+        descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(destino),
+                                                 prefix=f"{os.path.basename(destino)}.", suffix='.tmp')
+        try:
+            with os.fdopen(descritor, 'wb') as arquivo:
+                for dados in gerar_zip(entradas(linhas, manifesto, progresso.avancar)):
+                    arquivo.write(dados)
+            os.replace(temporario, destino)
+        except BaseException:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+            raise
+    else:
+        progresso.avancar(len(linhas))  # Mesmo conjunto de imagens já exportado antes
+
+    return {
+        "chave": chave,
+        "imagens": len(linhas),
+        "bytes": os.path.getsize(destino),
+        "download_url": url_download(chave)
+    }
@@ -0,0 +1,135 @@
+# app/imagens.py
+import hashlib
+import mimetypes
+import os
+from datetime import datetime
+
+from sqlalchemy import func
+
+from app.armazenamento import TAMANHO_BLOCO
+from app.blobs import liberar_imagem
+from app.consumo import bytes_da_imagem, recalcular, registrar_consumo
+from app.models.exam import Exam
+from app.models.exam_image import ExamImage
+
+# Gravado na pasta de upload ao fim do backfill: antes dele, arquivo de imagem sem registro não é órfão
+MARCADOR_INDEXACAO = '.imagens_indexadas'
+
+
+def calcular_checksum(caminho):
+    sha256 = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(TAMANHO_BLOCO), b''):
+            sha256.update(bloco)
+    return sha256.hexdigest()
+
+
+def tipo_mime(nome, padrao='application/octet-stream'):
+    return mimetypes.guess_type(nome)[0] or padrao
+
+
+def proxima_posicao(db, exam_id):
+    ultima = db.query(func.max(ExamImage.position)).filter(ExamImage.exam_id == exam_id).scalar()
+    return 0 if ultima is None else ultima + 1
+
+
+def registrar_imagem(db, exam_id, nome, blob, mime_type, position=None, respeitar_cota=False):
+    """
+    Cria ou atualiza (reenvio com o mesmo nome para o mesmo exame) o registro de uma imagem apontando
+    para o blob. A referência ao blob já foi contada em `blobs.armazenar`; a do conteúdo substituído é solta.
+    Com `respeitar_cota` lança consumo.CotaExcedida se o acréscimo passa da cota rígida da empresa.
+    """
+    imagem = db.query(ExamImage).filter(ExamImage.exam_id == exam_id, ExamImage.name == nome).first()
+    nova, anteriores = imagem is None, 0
+    if nova:
+        imagem = ExamImage(
+            exam_id=exam_id,
+            name=nome,
+            position=proxima_posicao(db, exam_id) if position is None else position,
+            created_at=datetime.now()
+        )
+        db.add(imagem)
+    else:
+        # Solta o conteúdo anterior; se for o mesmo blob a referência não fica contada duas vezes
+        liberar_imagem(db, imagem)
+        anteriores = bytes_da_imagem(imagem)
+    imagem.path = blob.path
+    imagem.blob_checksum = blob.checksum
+    imagem.size = blob.size
+    imagem.mime_type = mime_type
+    imagem.checksum = blob.checksum
+    imagem.original_size = None
+    imagem.original_checksum = None
+    registrar_consumo(db, imagem.exam_id, blob.size - anteriores, 1 if nova else 0, respeitar_cota=respeitar_cota)
+    db.flush()
+    return imagem
+
+
+def imagens_do_exame(db, exam_id):
+    return db.query(ExamImage)\
+             .filter(ExamImage.exam_id == exam_id)\
+             .order_by(ExamImage.position)\
+             .all()
+
+
+def indexar_imagens_existentes(db, upload_folder, lote=500):
+    """
+    Backfill único: cria registros ExamImage para os arquivos já presentes na pasta de upload.
+    Arquivos seguem o padrão '<exam_id>_<nnn>.<ext>'; os demais são ignorados.
+    """
+    ja_indexados = {(exam_id, nome) for exam_id, nome in db.query(ExamImage.exam_id, ExamImage.name)}
+    pendentes = {}
+    for entrada in os.scandir(upload_folder):
+        if not entrada.is_file() or (entrada.name[:26], entrada.name) in ja_indexados:
+            continue
+        if len(entrada.name) > 27 and entrada.name[26] == '_':
+            pendentes.setdefault(entrada.name[:26], []).append(entrada.name)
+
+    exames_existentes = set()
+    ids = list(pendentes)
+    for i in range(0, len(ids), lote):
+        exames_existentes.update(
+            exam_id for (exam_id,) in db.query(Exam.id).filter(Exam.id.in_(ids[i:i + lote]))
+        )
+
+    criados = 0
+    for exam_id in sorted(exames_existentes):
+        posicao = proxima_posicao(db, exam_id)
+        for nome in sorted(pendentes[exam_id]):
+            caminho = os.path.join(upload_folder, nome)
+            db.add(ExamImage(
+                exam_id=exam_id,
+                name=nome,
+                path=nome,
+                size=os.path.getsize(caminho),
+                mime_type=tipo_mime(nome),
+                checksum=calcular_checksum(caminho),
+                position=posicao,
+                created_at=datetime.now()
+            ))
+            posicao += 1
+            criados += 1
+            if criados % lote == 0:
+                db.commit()
+    db.commit()
+    with open(os.path.join(upload_folder, MARCADOR_INDEXACAO), 'w') as marcador:
+        marcador.write(datetime.now().isoformat())
+
+    ignorados = sum(len(nomes) for exam_id, nomes in pendentes.items() if exam_id not in exames_existentes)
+    return {"indexados": criados, "sem_exame": ignorados}
+
+
+def indexacao_concluida(upload_folder):
+    return os.path.exists(os.path.join(upload_folder, MARCADOR_INDEXACAO))
+
+
+def init_imagens(app):
+    @app.cli.command('indexar-imagens')
+    def indexar_imagens_command():
+        """Cria os registros de imagens a partir dos arquivos já enviados (executar uma vez)."""
+        from app import get_db
+        db = get_db()
+        resultado = indexar_imagens_existentes(db, app.config['UPLOAD_FOLDER'])
+        print(f"Imagens indexadas: {resultado}")
+        # As imagens indexadas passam a contar no consumo das empresas
+        print(f"Contadores de armazenamento: {recalcular(db)}")
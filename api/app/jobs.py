@@ -0,0 +1,90 @@
+# app/jobs.py
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+
+from flask import current_app
+
+from app.models.job import BackgroundJob, JobStatus
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(app):
+    global _executor
+    with _executor_lock:
+        # Criado sob demanda no processo que atende a requisição (compatível com pre-fork)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config['JOBS_MAX_WORKERS'], thread_name_prefix='job')
+    return _executor
+
+
+class Progresso:
+    """Atualiza o andamento da tarefa no banco sem gravar a cada item."""
+
+    def __init__(self, db, job, intervalo=25):
+        self.db = db
+        self.job = job
+        self.intervalo = intervalo
+
+    def definir_total(self, total):
+        self.job.total = total
+        self.db.commit()
+
+    def avancar(self, quantidade=1):
+        self.job.processed += quantidade
+        if self.job.processed % self.intervalo == 0 or self.job.processed >= self.job.total:
+            self.db.commit()
+
+
+def _executar(app, db_factory, job_id, funcao, kwargs):
+    with app.app_context():
+        db = db_factory()
+        try:
+            job = db.query(BackgroundJob).get(job_id)
+            job.status = JobStatus.RUNNING
+            db.commit()
+            try:
+                resultado = funcao(db, Progresso(db, job), **kwargs)
+                job.status = JobStatus.DONE
+                job.result = resultado
+            except Exception as e:
+                db.rollback()
+                app.logger.error(f"Erro na tarefa {job.kind} ({job.id}): {str(e)}")
+                job.status = JobStatus.FAILED
+                job.error = str(e)
+            job.finished_at = datetime.now()
+            db.commit()
+        finally:
+            db.close()
+
+
+def iniciar_job(db, tipo, funcao, **kwargs):
+    """
+    Registra a tarefa e a executa em segundo plano.
+    `funcao(db, progresso, **kwargs)` recebe uma sessão própria e devolve o resultado (JSON).
+    """
+    app = current_app._get_current_object()
+    job = BackgroundJob(kind=tipo, status=JobStatus.PENDING, created_at=datetime.now(), updated_at=datetime.now())
+    db.add(job)
+    db.commit()
+    job_id = job.id
+
+    from app import get_db
+    testing = app.config.get('TESTING', False)
+    db_factory = lambda: get_db(testing)
+
+    if app.config['JOBS_SYNC']:
+        _executar(app, db_factory, job_id, funcao, kwargs)
+    else:
+        _get_executor(app).submit(_executar, app, db_factory, job_id, funcao, kwargs)
+    return job_id
+
+
+def init_jobs(app):
+    app.config.setdefault('JOBS_MAX_WORKERS', 2)
+    # Nos testes as tarefas rodam na própria requisição, de forma determinística
+    app.config.setdefault('JOBS_SYNC', app.config.get('TESTING', False))
+    # Exportações com mais imagens que isso são montadas em segundo plano e ficam em cache
+    app.config.setdefault('EXPORT_STREAM_MAX_IMAGES', 200)
@@ -0,0 +1,352 @@
+# app/limpeza.py
+import os
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import and_, exists, or_
+
+from app import armazenamento
+from app.blobs import remover_imagem, remover_apos_commit
+from app.derivados import caminhos_dos_derivados
+from app.imagens import indexacao_concluida
+from app.models.blob import Blob
+from app.models.exam import Exam
+from app.models.exam_image import ExamImage
+from app.models.upload_session import UploadSession, UploadStatus
+
+# Quantos arquivos são conferidos no banco por consulta
+LOTE = 500
+# Quantos órfãos aparecem como exemplo no relatório
+AMOSTRA = 20
+
+
+class Limitador:
+    """Espaça as remoções para não disputar o disco com os uploads (`taxa` em arquivos por segundo)."""
+
+    def __init__(self, taxa):
+        self.intervalo = 1.0 / taxa if taxa else 0.0
+        self.proximo = time.monotonic()
+
+    def aguardar(self, quantidade=1):
+        if not self.intervalo:
+            return
+        agora = time.monotonic()
+        if self.proximo > agora:
+            time.sleep(self.proximo - agora)
+        self.proximo = max(self.proximo, agora) + self.intervalo * quantidade
+
+
+class Relatorio:
+    """
+    Órfãos encontrados por categoria; na simulação nada é apagado, só contado.
+    Com `indexacao_pendente` as imagens também são só contadas: o backfill ainda não criou seus registros.
+    """
+
+    def __init__(self, simular, indexacao_pendente=False):
+        self.simular = simular
+        self.indexacao_pendente = indexacao_pendente
+        self.verificados = 0
+        self.categorias = {}
+        self.amostra = []
+        self.removidos = 0
+        self.bytes_removidos = 0
+        self.registros = {"sessoes_expiradas": 0, "imagens_sem_exame": 0, "blobs_sem_referencia": 0}
+
+    def orfao(self, categoria, relativo, tamanho):
+        totais = self.categorias.setdefault(categoria, {"arquivos": 0, "bytes": 0})
+        totais["arquivos"] += 1
+        totais["bytes"] += tamanho
+        if len(self.amostra) < AMOSTRA:
+            self.amostra.append(relativo)
+
+    def to_dict(self):
+        return {
+            "simulacao": self.simular,
+            "indexacao_pendente": self.indexacao_pendente,
+            "arquivos_verificados": self.verificados,
+            "orfaos": self.categorias,
+            "arquivos_removidos": self.removidos,
+            "bytes_removidos": self.bytes_removidos,
+            "registros": self.registros,
+            "amostra": self.amostra
+        }
+
+
+def percorrer(pasta, relativo=''):
+    """Arquivos da pasta, recursivamente, lidos com os.scandir: a listagem nunca fica inteira na memória."""
+    with os.scandir(pasta) as entradas:
+        for entrada in entradas:
+            caminho = f"{relativo}/{entrada.name}" if relativo else entrada.name
+            if entrada.is_dir(follow_symlinks=False):
+                yield from percorrer(entrada.path, caminho)
+            elif entrada.is_file(follow_symlinks=False):
+                yield caminho, entrada
+
+
+def categoria(relativo):
+    """Regra que decide se o arquivo ainda é usado, pela pasta onde ele está."""
+    if relativo.endswith('.tmp'):
+        return 'temporario'  # Derivado ou exportação interrompidos antes do rename
+    raiz = relativo.split('/', 1)[0]
+    if raiz == '.tmp':
+        return 'temporario'
+    if raiz.startswith('.'):
+        return None  # Arquivos ocultos (.gitkeep e afins) não são da aplicação
+    if raiz in ('blobs', 'derivados', 'exportacoes'):
+        return raiz
+    # Formato plano ou fragmentado: imagens antigas, ZIPs e cópias deixados por versões anteriores
+    return 'imagens'
+
+
+def _checksum_derivado(relativo):
+    return os.path.basename(relativo).rpartition('_')[0]
+
+
+def _referenciados(db, nome, itens):
+    """Caminhos relativos do lote que ainda têm registro no banco."""
+    relativos = [relativo for relativo, _ in itens]
+
+    if nome == 'blobs':
+        # Também vale o checksum de uma imagem antiga: a deduplicação move o arquivo antes do commit
+        checksums = [os.path.basename(relativo) for relativo in relativos]
+        conhecidos = {c for (c,) in db.query(Blob.checksum).filter(Blob.checksum.in_(checksums))}
+        conhecidos |= {c for (c,) in db.query(ExamImage.checksum).filter(ExamImage.checksum.in_(checksums))}
+        return {relativo for relativo in relativos if os.path.basename(relativo) in conhecidos}
+
+    if nome == 'derivados':
+        # Imagens anteriores aos blobs também têm derivados pelo checksum
+        checksums = [_checksum_derivado(relativo) for relativo in relativos]
+        conhecidos = {c for (c,) in db.query(Blob.checksum).filter(Blob.checksum.in_(checksums))}
+        conhecidos |= {c for (c,) in db.query(ExamImage.checksum).filter(ExamImage.checksum.in_(checksums))}
+        return {relativo for relativo in relativos if _checksum_derivado(relativo) in conhecidos}
+
+    if nome == 'temporario':
+        # Só o arquivo parcial de um upload retomável ainda aberto (ou sendo finalizado) continua em uso
+        sessoes = [os.path.basename(relativo)[:-len('.part')] for relativo in relativos if relativo.endswith('.part')]
+        abertas = {s for (s,) in db.query(UploadSession.id)
+                                   .filter(UploadSession.id.in_(sessoes),
+                                           or_(UploadSession.status == UploadStatus.FINALIZING,
+                                               and_(UploadSession.status == UploadStatus.OPEN,
+                                                    UploadSession.expires_at >= datetime.now())))}
+        return {relativo for relativo in relativos if os.path.basename(relativo)[:-len('.part')] in abertas}
+
+    if nome == 'exportacoes':
+        # Cache sem registro no banco: vale enquanto for recente
+        limite = time.time() - current_app.config['EXPORT_CACHE_MAX_AGE']
+        return {relativo for relativo, entrada in itens if entrada.stat().st_mtime >= limite}
+
+    # Durante a migração o registro pode estar no formato plano e o arquivo no fragmentado (e vice-versa)
+    candidatos = set(relativos)
+    for relativo in relativos:
+        nome_arquivo = os.path.basename(relativo)
+        candidatos.add(nome_arquivo)
+        candidatos.add(armazenamento.caminho_relativo(nome_arquivo))
+    caminhos = {c for (c,) in db.query(ExamImage.path).filter(ExamImage.path.in_(list(candidatos)))}
+    return {
+        relativo for relativo in relativos
+        if relativo in caminhos or os.path.basename(relativo) in caminhos
+        or armazenamento.caminho_relativo(os.path.basename(relativo)) in caminhos
+    }
+
+
+def _conferir_lote(db, nome, itens, relatorio, limitador):
+    usados = _referenciados(db, nome, itens)
+    manter = relatorio.simular or (nome == 'imagens' and relatorio.indexacao_pendente)
+    for relativo, entrada in itens:
+        if relativo in usados:
+            continue
+        tamanho = entrada.stat().st_size
+        relatorio.orfao(nome, relativo, tamanho)
+        if manter:
+            continue
+        limitador.aguardar()
+        try:
+            os.remove(entrada.path)
+        except FileNotFoundError:
+            continue  # Removido por outro processo nesse meio tempo
+        relatorio.removidos += 1
+        relatorio.bytes_removidos += tamanho
+
+
+def _conferir_lote_remoto(db, driver, itens, relatorio, limitador):
+    usados = _referenciados(db, 'blobs', [(chave, None) for chave, _ in itens])
+    for chave, tamanho in itens:
+        if chave in usados:
+            continue
+        relatorio.orfao('blobs', chave, tamanho)
+        if relatorio.simular:
+            continue
+        limitador.aguardar()
+        driver.apagar(chave)
+        relatorio.removidos += 1
+        relatorio.bytes_removidos += tamanho
+
+
+def coletar_remoto(db, driver, relatorio, limitador, limite):
+    """Blobs do bucket sem registro, listados por prefixo em páginas."""
+    lote = []
+    for chave, tamanho, modificado in driver.listar('blobs/'):
+        relatorio.verificados += 1
+        if modificado > limite:
+            continue
+        lote.append((chave, tamanho))
+        if len(lote) >= LOTE:
+            _conferir_lote_remoto(db, driver, lote, relatorio, limitador)
+            lote = []
+    if lote:
+        _conferir_lote_remoto(db, driver, lote, relatorio, limitador)
+
+
+def expirar_sessoes(db, relatorio):
+    """Uploads retomáveis abandonados ou que falharam: o registro sai e o arquivo parcial vira órfão."""
+    expiradas = db.query(UploadSession)\
+                  .filter(UploadSession.status.in_([UploadStatus.OPEN, UploadStatus.FAILED]),
+                          UploadSession.expires_at < datetime.now())\
+                  .all()
+    relatorio.registros["sessoes_expiradas"] = len(expiradas)
+    if relatorio.simular:
+        return
+    for sessao in expiradas:
+        db.delete(sessao)
+    db.commit()
+
+
+def liberar_imagens_sem_exame(db, relatorio, limitador):
+    """Imagens cujo exame foi apagado antes de `deletar` liberar os arquivos."""
+    sem_exame = db.query(ExamImage).filter(~exists().where(Exam.id == ExamImage.exam_id))
+    if relatorio.simular:
+        relatorio.registros["imagens_sem_exame"] = sem_exame.count()
+        return
+    while True:
+        imagens = sem_exame.limit(LOTE).all()
+        if not imagens:
+            return
+        limitador.aguardar(len(imagens))
+        for imagem in imagens:
+            remover_imagem(db, imagem)
+        db.commit()
+        relatorio.registros["imagens_sem_exame"] += len(imagens)
+
+
+def liberar_blobs_sem_referencia(db, relatorio, limitador, carencia):
+    """
+    Blobs que nenhuma imagem usa mais (ex.: exame apagado com as imagens em cascata).
+    A exclusão exige o mesmo refcount lido: um upload simultâneo que acabou de somar
+    uma referência faz a condição falhar e o blob é mantido.
+    """
+    criado_antes = datetime.now() - timedelta(seconds=carencia)
+    ultimo = ''
+    while True:
+        candidatos = db.query(Blob)\
+                       .filter(Blob.checksum > ultimo,
+                               Blob.created_at < criado_antes,
+                               ~exists().where(ExamImage.blob_checksum == Blob.checksum),
+                               ~exists().where(ExamImage.original_checksum == Blob.checksum))\
+                       .order_by(Blob.checksum)\
+                       .limit(LOTE)\
+                       .all()
+        if not candidatos:
+            return
+        ultimo = candidatos[-1].checksum
+        if relatorio.simular:
+            relatorio.registros["blobs_sem_referencia"] += len(candidatos)
+            continue
+
+        limitador.aguardar(len(candidatos))
+        larguras = current_app.config['DERIVATIVE_WIDTHS']
+        for blob in candidatos:
+            removidos = db.query(Blob)\
+                          .filter(Blob.checksum == blob.checksum, Blob.refcount == blob.refcount,
+                                  ~exists().where(ExamImage.blob_checksum == Blob.checksum),
+                                  ~exists().where(ExamImage.original_checksum == Blob.checksum))\
+                          .delete(synchronize_session=False)
+            if not removidos:
+                continue
+            db.expunge(blob)
+            remover_apos_commit(db, blob.path, blob.checksum)
+            for derivado in caminhos_dos_derivados(blob.checksum, larguras):
+                remover_apos_commit(db, derivado, blob.checksum)
+            relatorio.registros["blobs_sem_referencia"] += 1
+            relatorio.bytes_removidos += blob.size
+        db.commit()
+
+
+def coletar_orfaos(db, simular=False, taxa=None):
+    """
+    Confere a pasta de upload contra os registros e apaga o que nada mais referencia.
+    Primeiro acerta o banco (uploads expirados, imagens sem exame, blobs sem referência) e depois
+    percorre os arquivos em lotes, no disco e no bucket quando o driver é remoto. Arquivos mais novos que GC_GRACE_SECONDS são ignorados: podem
+    ser de um upload cujo registro ainda não foi confirmado. Imagens antigas só são apagadas depois
+    do backfill (flask indexar-imagens), que cria os registros delas.
+    """
+    config = current_app.config
+    carencia = config['GC_GRACE_SECONDS']
+    relatorio = Relatorio(simular, indexacao_pendente=not indexacao_concluida(config['UPLOAD_FOLDER']))
+    if relatorio.indexacao_pendente:
+        current_app.logger.warning("Imagens sem registro não serão apagadas: execute 'flask indexar-imagens' antes")
+    limitador = Limitador(config['GC_DELETES_PER_SECOND'] if taxa is None else taxa)
+
+    expirar_sessoes(db, relatorio)
+    liberar_imagens_sem_exame(db, relatorio, limitador)
+    liberar_blobs_sem_referencia(db, relatorio, limitador, carencia)
+
+    limite = time.time() - carencia
+    pendentes = {}
+    for relativo, entrada in percorrer(config['UPLOAD_FOLDER']):
+        relatorio.verificados += 1
+        if entrada.stat().st_mtime > limite:
+            continue
+        nome = categoria(relativo)
+        if nome is None:
+            continue
+        lote = pendentes.setdefault(nome, [])
+        lote.append((relativo, entrada))
+        if len(lote) >= LOTE:
+            _conferir_lote(db, nome, lote, relatorio, limitador)
+            pendentes[nome] = []
+    for nome, lote in pendentes.items():
+        if lote:
+            _conferir_lote(db, nome, lote, relatorio, limitador)
+
+    driver = armazenamento.driver()
+    if driver.remoto:
+        coletar_remoto(db, driver, relatorio, limitador, limite)
+
+    return relatorio.to_dict()
+
+
+def init_limpeza(app):
+    # Idade mínima para um arquivo sem registro ser considerado órfão
+    app.config.setdefault('GC_GRACE_SECONDS', int(os.getenv('GC_GRACE_SECONDS', 3600)))
+    app.config.setdefault('GC_DELETES_PER_SECOND', float(os.getenv('GC_DELETES_PER_SECOND', 50)))
+    # 0 executa uma vez (para o cron); acima disso o comando repete a coleta nesse intervalo
+    app.config.setdefault('GC_INTERVAL_SECONDS', int(os.getenv('GC_INTERVAL_SECONDS', 0)))
+    # ZIPs de exportação em cache são apagados depois dessa idade
+    app.config.setdefault('EXPORT_CACHE_MAX_AGE', int(os.getenv('EXPORT_CACHE_MAX_AGE', 7 * 24 * 3600)))
+
+    @app.cli.command('coletar-orfaos')
+    @click.option('--simular', is_flag=True, help='Só relata os órfãos, sem apagar nada.')
+    @click.option('--taxa', default=None, type=float, help='Máximo de arquivos apagados por segundo.')
+    @click.option('--intervalo', default=None, type=int, help='Repete a coleta a cada N segundos.')
+    def coletar_orfaos_command(simular, taxa, intervalo):
+        """Apaga arquivos da pasta de upload que nenhum registro referencia."""
+        from app import get_db
+        intervalo = app.config['GC_INTERVAL_SECONDS'] if intervalo is None else intervalo
+        while True:
+            db = get_db()
+            try:
+                resultado = coletar_orfaos(db, simular=simular, taxa=taxa)
+                app.logger.info(f"Coleta de órfãos: {resultado}")
+                print(f"Coleta concluída: {resultado}")
+            except Exception as e:
+                db.rollback()
+                app.logger.error(f"Erro na coleta de órfãos: {str(e)}")
+                if not intervalo:
+                    raise
+            finally:
+                db.close()
+            if not intervalo:
+                break
+            time.sleep(intervalo)
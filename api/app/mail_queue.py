@@ -0,0 +1,330 @@
+# app/mail_queue.py
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import current_app
+from flask_mail import Message
+
+from app import mail
+from app import armazenamento
+from app.models.outbox import OutboxEmail, OutboxStatus
+
+
+def enfileirar_email(db, assunto, destinatarios, html, anexos=None, remetente=None, commit=True):
+    """
+    Grava a mensagem na fila de saída e acorda o worker de envio.
+    `anexos` é uma lista de dicionários com 'path', 'filename' e 'content_type'.
+    """
+    mensagem = OutboxEmail(
+        subject=assunto,
+        recipients=list(destinatarios),
+        html=html,
+        sender=remetente or current_app.config['MAIL_USERNAME'],
+        attachments=anexos or [],
+        status=OutboxStatus.PENDING,
+        attempts=0,
+        next_attempt_at=datetime.now(),
+        created_at=datetime.now()
+    )
+    db.add(mensagem)
+    if commit:
+        db.commit()
+        notificar_worker()
+    return mensagem
+
+
+def ler_anexo(caminho, conteudos):
+    """Lê o arquivo uma única vez por lote; mensagens com o mesmo anexo compartilham os bytes."""
+    if caminho not in conteudos:
+        # O arquivo pode ter sido movido para o layout fragmentado (ou para o bucket) depois de enfileirado
+        with armazenamento.abrir(caminho) as arquivo:
+            conteudos[caminho] = arquivo.read()
+    return conteudos[caminho]
+
+
+def montar_mensagem(item, conteudos=None):
+    """
+    Converte um registro da fila em uma Message do Flask-Mail.
+    Anexos com 'url' (arquivos grandes) viram links no corpo em vez de anexos.
+    """
+    conteudos = {} if conteudos is None else conteudos
+    anexos = item.attachments or []
+    links = [anexo for anexo in anexos if anexo.get('url')]
+
+    html = item.html
+    if links:
+        itens = "".join(f'<li><a href="{anexo["url"]}">{anexo["filename"]}</a></li>' for anexo in links)
+        html = f"{html or ''}<p>Arquivos disponíveis para download:</p><ul>{itens}</ul>"
+
+    msg = Message(
+        item.subject,
+        recipients=item.recipients,
+        html=html,
+        sender=item.sender
+    )
+    for anexo in anexos:
+        if anexo.get('url'):
+            continue
+        msg.attach(anexo['filename'], anexo['content_type'], ler_anexo(anexo['path'], conteudos))
+    return msg
+
+
+def calcular_espera(tentativas, config):
+    """Backoff exponencial limitado entre as tentativas de envio."""
+    base = config['MAIL_RETRY_BASE_SECONDS']
+    maximo = config['MAIL_RETRY_MAX_SECONDS']
+    return timedelta(seconds=min(base * (2 ** (tentativas - 1)), maximo))
+
+
+# Erros que não comprometem a conexão: o servidor recusou apenas esta mensagem
+ERROS_DA_MENSAGEM = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class ConexaoSMTP:
+    """Conexão do Flask-Mail mantida aberta entre envios e reaberta quando cai."""
+
+    def __init__(self):
+        self.conexao = None
+        self.ultimo_uso = time.monotonic()
+
+    def enviar(self, msg):
+        if self.conexao is None:
+            self.conexao = mail.connect().__enter__()
+        try:
+            # Connection.send reconecta sozinha ao atingir MAIL_MAX_EMAILS
+            self.conexao.send(msg)
+        except ERROS_DA_MENSAGEM:
+            raise
+        except Exception:
+            self.fechar()
+            raise
+        finally:
+            self.ultimo_uso = time.monotonic()
+
+    def ociosa(self, limite):
+        return time.monotonic() - self.ultimo_uso > limite
+
+    def fechar(self):
+        if self.conexao is not None and self.conexao.host is not None:
+            try:
+                self.conexao.host.quit()
+            except Exception:
+                self.conexao.host.close()
+        self.conexao = None
+
+
+class PoolSMTP:
+    """Pool de conexões SMTP reutilizáveis, evitando um handshake TLS por mensagem."""
+
+    def __init__(self, tamanho=1, ocioso=30):
+        self.ocioso = ocioso
+        self._livres = []
+        self._lock = threading.Lock()
+        self._vagas = threading.BoundedSemaphore(tamanho)
+
+    @contextmanager
+    def conexao(self):
+        self._vagas.acquire()
+        with self._lock:
+            conexao = self._livres.pop() if self._livres else ConexaoSMTP()
+        try:
+            # O servidor costuma derrubar conexões paradas há muito tempo
+            if conexao.ociosa(self.ocioso):
+                conexao.fechar()
+            yield conexao
+        finally:
+            with self._lock:
+                self._livres.append(conexao)
+            self._vagas.release()
+
+    def fechar_ociosas(self):
+        with self._lock:
+            for conexao in self._livres:
+                if conexao.ociosa(self.ocioso):
+                    conexao.fechar()
+
+    def fechar_todas(self):
+        with self._lock:
+            for conexao in self._livres:
+                conexao.fechar()
+
+
+class EstatisticasEnvio:
+    """Totais acumulados do worker, usados para medir a vazão de envio."""
+
+    def __init__(self):
+        self.enviados = 0
+        self.falhas = 0
+        self.segundos = 0.0
+
+    def registrar(self, enviados, falhas, segundos):
+        self.enviados += enviados
+        self.falhas += falhas
+        self.segundos += segundos
+
+    @property
+    def mensagens_por_segundo(self):
+        return self.enviados / self.segundos if self.segundos else 0.0
+
+    def to_dict(self):
+        return {
+            "enviados": self.enviados,
+            "falhas": self.falhas,
+            "segundos": round(self.segundos, 3),
+            "mensagens_por_segundo": round(self.mensagens_por_segundo, 2)
+        }
+
+
+class MailWorker(threading.Thread):
+    """Thread que drena a fila de saída, com novas tentativas e backoff."""
+
+    def __init__(self, app, db_factory):
+        super().__init__(name='mail-worker', daemon=True)
+        self.app = app
+        self.db_factory = db_factory
+        self.acordar = threading.Event()
+        self.parar = threading.Event()
+        self.pool = PoolSMTP(app.config['MAIL_POOL_SIZE'], app.config['MAIL_POOL_IDLE_SECONDS'])
+        self.estatisticas = EstatisticasEnvio()
+
+    def reservar_lote(self, db):
+        """Reserva mensagens vencidas; o UPDATE condicional evita envio duplicado entre processos."""
+        config = self.app.config
+        agora = datetime.now()
+        candidatos = db.query(OutboxEmail.id)\
+            .filter(OutboxEmail.status.in_([OutboxStatus.PENDING, OutboxStatus.SENDING]),
+                    OutboxEmail.next_attempt_at <= agora)\
+            .order_by(OutboxEmail.next_attempt_at)\
+            .limit(config['MAIL_QUEUE_BATCH_SIZE'])\
+            .all()
+
+        # Mensagens em 'sending' cujo prazo venceu pertenciam a um worker que caiu
+        prazo = agora + timedelta(seconds=config['MAIL_QUEUE_LEASE_SECONDS'])
+        reservados = []
+        for (id_mensagem,) in candidatos:
+            atualizados = db.query(OutboxEmail)\
+                .filter(OutboxEmail.id == id_mensagem,
+                        OutboxEmail.status.in_([OutboxStatus.PENDING, OutboxStatus.SENDING]),
+                        OutboxEmail.next_attempt_at <= agora)\
+                .update({"status": OutboxStatus.SENDING, "next_attempt_at": prazo},
+                        synchronize_session=False)
+            if atualizados:
+                reservados.append(id_mensagem)
+        db.commit()
+
+        if not reservados:
+            return []
+        return db.query(OutboxEmail).filter(OutboxEmail.id.in_(reservados)).all()
+
+    def registrar_falha(self, item, erro):
+        config = self.app.config
+        item.attempts += 1
+        item.last_error = str(erro)
+        if item.attempts >= config['MAIL_MAX_ATTEMPTS']:
+            item.status = OutboxStatus.FAILED
+            self.app.logger.error(f"E-mail '{item.subject}' descartado após {item.attempts} tentativas: {str(erro)}")
+        else:
+            item.status = OutboxStatus.PENDING
+            item.next_attempt_at = datetime.now() + calcular_espera(item.attempts, config)
+            self.app.logger.warning(f"Falha ao enviar e-mail '{item.subject}' (tentativa {item.attempts}): {str(erro)}")
+
+    def processar_lote(self):
+        """Envia um lote de mensagens por uma única conexão e retorna quantas foram entregues."""
+        with self.app.app_context():
+            db = self.db_factory()
+            try:
+                lote = self.reservar_lote(db)
+                if not lote:
+                    return 0
+
+                inicio = time.perf_counter()
+                enviados = 0
+                conteudos = {}  # Bytes dos anexos compartilhados entre as mensagens do lote
+                with self.pool.conexao() as conexao:
+                    for item in lote:
+                        try:
+                            conexao.enviar(montar_mensagem(item, conteudos))
+                            item.status = OutboxStatus.SENT
+                            item.sent_at = datetime.now()
+                            item.last_error = None
+                            enviados += 1
+                        except Exception as e:
+                            self.registrar_falha(item, e)
+                        db.commit()
+
+                duracao = time.perf_counter() - inicio
+                self.estatisticas.registrar(enviados, len(lote) - enviados, duracao)
+                self.app.logger.info(
+                    f"Lote de e-mails: {enviados}/{len(lote)} enviados em {duracao:.2f}s "
+                    f"({enviados / duracao if duracao else 0:.1f} msg/s)"
+                )
+                return enviados
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def run(self):
+        intervalo = self.app.config['MAIL_QUEUE_POLL_SECONDS']
+        while not self.parar.is_set():
+            try:
+                if self.processar_lote():
+                    continue  # Ainda pode haver mensagens na fila
+            except Exception as e:
+                self.app.logger.error(f"Erro no worker de e-mails: {str(e)}")
+            self.pool.fechar_ociosas()
+            self.acordar.wait(intervalo)
+            self.acordar.clear()
+        self.pool.fechar_todas()
+
+    def encerrar(self):
+        self.parar.set()
+        self.acordar.set()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def notificar_worker():
+    """Acorda o worker do processo, iniciando-o sob demanda."""
+    app = current_app._get_current_object()
+    if app.config['MAIL_QUEUE_WORKER'] != 'thread':
+        return  # Fila drenada por um processo dedicado (flask mail-worker)
+
+    global _worker
+    with _worker_lock:
+        # Iniciado só na primeira mensagem: threads não sobrevivem ao fork dos servidores pre-fork
+        if _worker is None or not _worker.is_alive():
+            from app import get_db
+            testing = app.config.get('TESTING', False)
+            _worker = MailWorker(app, lambda: get_db(testing))
+            _worker.start()
+    _worker.acordar.set()
+
+
+def init_mail_queue(app):
+    app.config.setdefault('MAIL_QUEUE_BATCH_SIZE', 50)
+    app.config.setdefault('MAIL_QUEUE_POLL_SECONDS', 5)
+    app.config.setdefault('MAIL_QUEUE_LEASE_SECONDS', 300)
+    app.config.setdefault('MAIL_MAX_ATTEMPTS', 5)
+    app.config.setdefault('MAIL_RETRY_BASE_SECONDS', 30)
+    app.config.setdefault('MAIL_RETRY_MAX_SECONDS', 3600)
+    app.config.setdefault('MAIL_POOL_SIZE', 1)
+    app.config.setdefault('MAIL_POOL_IDLE_SECONDS', 30)
+
+    @app.cli.command('mail-worker')
+    def mail_worker_command():
+        """Drena a fila de e-mails em primeiro plano (processo dedicado)."""
+        from app import get_db
+        worker = MailWorker(app, get_db)
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            worker.encerrar()
+            worker.pool.fechar_todas()
+        print(f"Envio encerrado: {worker.estatisticas.to_dict()}")
@@ -0,0 +1,315 @@
+# app/metricas.py
+"""
+Métricas no formato texto do Prometheus, servidas em /metrics.
+
+Cada processo acumula as suas séries em memória. Com METRICS_DIR configurado (servidores
+pre-fork como o Passenger), cada processo grava periodicamente um retrato em
+<METRICS_DIR>/metricas_<pid>.json e a coleta soma os retratos de todos: contadores e
+histogramas de processos já encerrados continuam valendo; medidores só dos processos vivos.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import weakref
+
+from flask import current_app, g, has_app_context, jsonify, request
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Nome da série: (tipo, descrição)
+SERIES = {
+    "http_requests_total": ("counter", "Requisições atendidas, por rota e status."),
+    "http_request_duration_seconds": ("histogram", "Duração das requisições, por blueprint e rota."),
+    "upload_bytes_total": ("counter", "Bytes recebidos em uploads de imagens."),
+    "cache_hits_total": ("counter", "Consultas a caches atendidas pelo cache."),
+    "cache_misses_total": ("counter", "Consultas a caches que precisaram calcular o valor."),
+    "cache_hit_ratio": ("gauge", "Proporção de acertos de cada cache desde o início dos processos."),
+    "db_pool_size": ("gauge", "Conexões mantidas pelo pool do banco."),
+    "db_pool_checked_out": ("gauge", "Conexões do pool em uso."),
+    "db_pool_overflow": ("gauge", "Conexões abertas além do tamanho do pool."),
+    "mail_queue_messages": ("gauge", "Mensagens na fila de e-mails, por estado."),
+}
+
+_registros = weakref.WeakSet()
+
+
+def _chave(nome, rotulos):
+    return nome, tuple(sorted(rotulos.items()))
+
+
+class Metricas:
+    """Séries do processo atual; thread-safe, pois as requisições podem vir de várias threads."""
+
+    def __init__(self, pasta=None, intervalo=1.0, buckets=BUCKETS, externas=None):
+        self.pasta = pasta
+        # Função que devolve séries mantidas fora do registro: {"contadores": [...], "medidores": [...]}
+        self.externas = externas
+        self.intervalo = intervalo
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reiniciar()
+        _registros.add(self)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+            atexit.register(self._gravar_ao_sair)
+
+    def reiniciar(self):
+        self._contadores = {}
+        self._histogramas = {}
+        self._gravado_em = 0.0
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = _chave(nome, rotulos)
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **rotulos):
+        chave = _chave(nome, rotulos)
+        with self._lock:
+            serie = self._histogramas.get(chave)
+            if serie is None:
+                serie = self._histogramas[chave] = [0] * len(self.buckets) + [0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[i] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def retrato(self):
+        """Estado serializável do processo, no formato dos arquivos de METRICS_DIR."""
+        externas = self.externas() if self.externas else {}
+        with self._lock:
+            contadores = [[nome, dict(rotulos), valor] for (nome, rotulos), valor in self._contadores.items()]
+            histogramas = [[nome, dict(rotulos), list(serie)] for (nome, rotulos), serie in self._histogramas.items()]
+        return {
+            "pid": os.getpid(),
+            "buckets": list(self.buckets),
+            "contadores": contadores + externas.get("contadores", []),
+            "histogramas": histogramas,
+            "medidores": externas.get("medidores", []),
+        }
+
+    def gravar(self):
+        if not self.pasta:
+            return
+        destino = os.path.join(self.pasta, f"metricas_{os.getpid()}.json")
+        temporario = f"{destino}.tmp"
+        with open(temporario, 'w') as arquivo:
+            json.dump(self.retrato(), arquivo)
+        os.replace(temporario, destino)  # A coleta nunca lê um arquivo pela metade
+        self._gravado_em = time.monotonic()
+
+    def _gravar_ao_sair(self):
+        try:
+            self.gravar()
+        except OSError:
+            pass  # Pasta já removida
+
+    def gravar_se_preciso(self):
+        if self.pasta and time.monotonic() - self._gravado_em >= self.intervalo:
+            self.gravar()
+
+    def retratos(self):
+        """Retratos de todos os processos (só o do atual quando não há METRICS_DIR)."""
+        if not self.pasta:
+            return [self.retrato()]
+        self.gravar()
+        retratos = []
+        for nome in os.listdir(self.pasta):
+            if nome.startswith('metricas_') and nome.endswith('.json'):
+                try:
+                    with open(os.path.join(self.pasta, nome)) as arquivo:
+                        retratos.append(json.load(arquivo))
+                except (OSError, ValueError):
+                    continue  # Arquivo removido ou substituído durante a leitura
+        return retratos
+
+
+def _descartar_series_herdadas():
+    # O filho de um fork começa do zero: as séries herdadas já são contadas pelo pai
+    for registro in list(_registros):
+        registro._lock = threading.Lock()
+        registro.reiniciar()
+
+
+os.register_at_fork(after_in_child=_descartar_series_herdadas)
+
+
+def _processo_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def agregar(retratos):
+    """Soma os retratos: {(nome, rótulos): valor} e {(nome, rótulos): [buckets..., soma, contagem]}."""
+    contadores, histogramas, medidores = {}, {}, {}
+    buckets = BUCKETS
+    for retrato in retratos:
+        buckets = tuple(retrato["buckets"])
+        for nome, rotulos, valor in retrato["contadores"]:
+            chave = _chave(nome, rotulos)
+            contadores[chave] = contadores.get(chave, 0) + valor
+        for nome, rotulos, serie in retrato["histogramas"]:
+            chave = _chave(nome, rotulos)
+            atual = histogramas.get(chave)
+            histogramas[chave] = serie if atual is None else [a + b for a, b in zip(atual, serie)]
+        if retrato["pid"] == os.getpid() or _processo_vivo(retrato["pid"]):
+            for nome, rotulos, valor in retrato["medidores"]:
+                chave = _chave(nome, rotulos)
+                medidores[chave] = medidores.get(chave, 0) + valor
+    return contadores, histogramas, medidores, buckets
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _rotulos(rotulos, extra=()):
+    pares = [*rotulos, *extra]
+    if not pares:
+        return ''
+    return '{' + ','.join(f'{nome}="{_escapar(valor)}"' for nome, valor in pares) + '}'
+
+
+def _numero(valor):
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+def formatar(contadores, histogramas, medidores, buckets):
+    """Formato de exposição em texto do Prometheus (versão 0.0.4)."""
+    por_nome = {}
+    for origem in (contadores, medidores):
+        for (nome, rotulos), valor in sorted(origem.items()):
+            por_nome.setdefault(nome, []).append(f"{nome}{_rotulos(rotulos)} {_numero(valor)}")
+    for (nome, rotulos), serie in sorted(histogramas.items()):
+        linhas = por_nome.setdefault(nome, [])
+        for limite, total in zip(buckets, serie):
+            linhas.append(f"{nome}_bucket{_rotulos(rotulos, [('le', _numero(float(limite)))])} {total}")
+        linhas.append(f"{nome}_bucket{_rotulos(rotulos, [('le', '+Inf')])} {serie[-1]}")
+        linhas.append(f"{nome}_sum{_rotulos(rotulos)} {_numero(float(serie[-2]))}")
+        linhas.append(f"{nome}_count{_rotulos(rotulos)} {serie[-1]}")
+
+    saida = []
+    for nome in sorted(por_nome):
+        tipo, descricao = SERIES.get(nome, ("untyped", nome))
+        saida += [f"# HELP {nome} {descricao}", f"# TYPE {nome} {tipo}", *por_nome[nome]]
+    return '\n'.join(saida) + '\n'
+
+
+def contar(nome, valor=1, **rotulos):
+    """Incrementa um contador do processo atual (sem efeito fora de uma aplicação com métricas)."""
+    if not has_app_context():
+        return
+    metricas = current_app.extensions.get('metricas')
+    if metricas is not None:
+        metricas.contar(nome, valor, **rotulos)
+
+
+def contar_cache(cache, acerto):
+    contar("cache_hits_total" if acerto else "cache_misses_total", cache=cache)
+
+
+def _series_do_processo(app):
+    """Uso do pool de conexões e acertos do cache de tokens, que já conta os próprios."""
+    from app import Session
+    medidores, contadores = [], []
+    pool = getattr(Session.session_factory.kw.get('bind'), 'pool', None)
+    for nome, metodo in (("db_pool_size", "size"), ("db_pool_checked_out", "checkedout"),
+                         ("db_pool_overflow", "overflow")):
+        if callable(getattr(pool, metodo, None)):
+            # overflow() fica negativo enquanto o pool ainda não abriu todas as conexões
+            medidores.append([nome, {}, max(getattr(pool, metodo)(), 0)])
+    cache = app.extensions.get('token_cache')
+    if cache is not None:
+        contadores += [["cache_hits_total", {"cache": "token"}, cache.hits],
+                       ["cache_misses_total", {"cache": "token"}, cache.misses]]
+    return {"contadores": contadores, "medidores": medidores}
+
+
+def _fila_de_emails():
+    from sqlalchemy import func
+    from app import get_db
+    from app.models.outbox import OutboxEmail, OutboxStatus
+    db = get_db()
+    try:
+        totais = dict(db.query(OutboxEmail.status, func.count(OutboxEmail.id))
+                        .filter(OutboxEmail.status != OutboxStatus.SENT)
+                        .group_by(OutboxEmail.status))
+    finally:
+        db.close()
+    return {(("status", status),): totais.get(status, 0)
+            for status in (OutboxStatus.PENDING, OutboxStatus.SENDING, OutboxStatus.FAILED)}
+
+
+def coletar(app):
+    """Texto de /metrics com as séries de todos os processos e as medidas feitas na coleta."""
+    metricas = app.extensions['metricas']
+    contadores, histogramas, medidores, buckets = agregar(metricas.retratos())
+
+    caches = {dict(rotulos)["cache"] for nome, rotulos in contadores
+              if nome in ("cache_hits_total", "cache_misses_total")}
+    for cache in caches:
+        acertos = contadores.get(_chave("cache_hits_total", {"cache": cache}), 0)
+        falhas = contadores.get(_chave("cache_misses_total", {"cache": cache}), 0)
+        if acertos + falhas:
+            medidores[_chave("cache_hit_ratio", {"cache": cache})] = round(acertos / (acertos + falhas), 4)
+
+    try:
+        for rotulos, total in _fila_de_emails().items():
+            medidores[("mail_queue_messages", rotulos)] = total
+    except Exception as e:
+        app.logger.warning(f"Métricas: fila de e-mails indisponível: {str(e)}")
+    return formatar(contadores, histogramas, medidores, buckets)
+
+
+def init_metricas(app):
+    # Pasta compartilhada pelos processos de um servidor pre-fork; vazia mantém as métricas só em memória
+    app.config.setdefault('METRICS_DIR', os.getenv('METRICS_DIR'))
+    app.config.setdefault('METRICS_FLUSH_INTERVAL', float(os.getenv('METRICS_FLUSH_INTERVAL', 1.0)))
+    # Quando definido, /metrics exige 'Authorization: Bearer <METRICS_TOKEN>'
+    app.config.setdefault('METRICS_TOKEN', os.getenv('METRICS_TOKEN'))
+    app.extensions['metricas'] = Metricas(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'],
+                                          externas=lambda: _series_do_processo(app))
+
+    @app.before_request
+    def _iniciar_cronometro():
+        g._inicio_requisicao = time.perf_counter()
+
+    def _registrar(status):
+        inicio = g.__dict__.pop('_inicio_requisicao', None)
+        if inicio is None:
+            return
+        metricas = app.extensions['metricas']
+        # O molde da rota (e não o caminho) mantém o número de séries limitado
+        rota = request.url_rule.rule if request.url_rule is not None else 'sem_rota'
+        blueprint = request.blueprint or ''
+        metricas.observar("http_request_duration_seconds", time.perf_counter() - inicio,
+                          blueprint=blueprint, route=rota, method=request.method)
+        metricas.contar("http_requests_total", blueprint=blueprint, route=rota, method=request.method,
+                        status=str(status))
+        metricas.gravar_se_preciso()
+
+    @app.after_request
+    def _medir_requisicao(resposta):
+        _registrar(resposta.status_code)
+        return resposta
+
+    @app.teardown_request
+    def _medir_falha(erro=None):
+        # Exceção não tratada: o after_request não roda e a resposta é um 500
+        if erro is not None:
+            _registrar(500)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        token = app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization', '') != f"Bearer {token}":
+            return jsonify({"erro": "Token ausente ou inválido"}), 401
+        return coletar(app), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -0,0 +1,16 @@
+# app/models/blob.py
+from sqlalchemy import Column, String, DateTime, func, Integer, BigInteger
+from app.database import Base
+
+
+class Blob(Base):
+    """Conteúdo armazenado uma única vez, identificado pelo SHA-256."""
+    __tablename__ = 'blobs'
+    checksum = Column(String(64), primary_key=True)
+    path = Column(String(255), nullable=False)  # Relativo à pasta de upload
+    size = Column(BigInteger, nullable=False)
+    refcount = Column(Integer, default=0, nullable=False)  # Imagens de exame que apontam para o conteúdo
+    created_at = Column(DateTime, default=func.now())
+
+    def __repr__(self):
+        return f"<Blob(checksum='{self.checksum[:12]}', size={self.size}, refcount={self.refcount})>"
@@ -5,6 +5,7 @@ from datetime import datetime
 import pytz
 import ulid
 from app.database import Base
+from .exam_image import ExamImage
 
 timezone = pytz.timezone('UTC')
 
@@ -22,6 +23,8 @@ class Exam(Base):
 
     user = relationship("User", back_populates="exams")
     company = relationship("Company", back_populates="exams")
+    images = relationship("ExamImage", back_populates="exam", order_by="ExamImage.position",
+                          cascade="all, delete-orphan")
 
         
         
@@ -0,0 +1,44 @@
+# app/models/exam_image.py
+from sqlalchemy import Column, String, DateTime, func, ForeignKey, Integer, BigInteger, UniqueConstraint
+from sqlalchemy.orm import relationship
+import ulid
+from app.database import Base
+from .blob import Blob
+
+
+class ExamImage(Base):
+    __tablename__ = 'exam_images'
+    # O nome vem do cliente: só é único dentro do exame
+    __table_args__ = (UniqueConstraint('exam_id', 'name', name='uq_exam_images_exam_id_name'),)
+    id = Column(String(26), primary_key=True, default=lambda: str(ulid.new()))
+    exam_id = Column(String(26), ForeignKey('exams.id'), nullable=False, index=True)
+    name = Column(String(255), nullable=False)  # Nome lógico do arquivo ('<exam_id>_000.jpg')
+    path = Column(String(255), nullable=False, index=True)  # Relativo à pasta de upload; compartilhado entre duplicatas
+    blob_checksum = Column(String(64), ForeignKey('blobs.checksum'), nullable=True, index=True)
+    size = Column(BigInteger, nullable=False)
+    mime_type = Column(String(100), nullable=False)
+    checksum = Column(String(64), nullable=False)  # SHA-256 em hexadecimal
+    # Antes da otimização (metadados removidos e recompressão): tamanho enviado e, se mantido, o blob original
+    original_size = Column(BigInteger, nullable=True)
+    original_checksum = Column(String(64), ForeignKey('blobs.checksum'), nullable=True, index=True)
+    position = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+    exam = relationship("Exam", back_populates="images")
+
+    def __repr__(self):
+        return f"<ExamImage(exam_id='{self.exam_id}', name='{self.name}', size={self.size})>"
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'exam_id': self.exam_id,
+            'name': self.name,
+            'path': self.path,
+            'size': self.size,
+            'mime_type': self.mime_type,
+            'checksum': self.checksum,
+            'original_size': self.original_size,
+            'position': self.position,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
@@ -0,0 +1,44 @@
+# app/models/job.py
+from sqlalchemy import Column, String, DateTime, func, Integer, JSON, Text
+import ulid
+from app.database import Base
+
+
+# Estados de uma tarefa em segundo plano
+class JobStatus:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class BackgroundJob(Base):
+    __tablename__ = 'background_jobs'
+    id = Column(String(26), primary_key=True, default=lambda: str(ulid.new()))
+    kind = Column(String(50), nullable=False)
+    status = Column(String(10), default=JobStatus.PENDING, nullable=False)
+    total = Column(Integer, default=0, nullable=False)
+    processed = Column(Integer, default=0, nullable=False)
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    finished_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<BackgroundJob(kind='{self.kind}', status='{self.status}', processed={self.processed}/{self.total})>"
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'progress': round(self.processed / self.total, 4) if self.total else None,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
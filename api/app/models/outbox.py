@@ -0,0 +1,34 @@
+# app/models/outbox.py
+from sqlalchemy import Column, String, DateTime, func, Integer, JSON, Text, Index
+import ulid
+from app.database import Base
+
+
+# Estados de uma mensagem na fila de saída
+class OutboxStatus:
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+
+class OutboxEmail(Base):
+    __tablename__ = 'mail_outbox'
+    id = Column(String(26), primary_key=True, default=lambda: str(ulid.new()))
+    subject = Column(String(255), nullable=False)
+    recipients = Column(JSON, nullable=False)
+    html = Column(Text, nullable=True)
+    sender = Column(String(120), nullable=True)
+    attachments = Column(JSON, nullable=True)  # [{"path", "filename", "content_type"}]
+    status = Column(String(10), default=OutboxStatus.PENDING, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=func.now(), nullable=False)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+
+    # O worker busca sempre por estado e horário da próxima tentativa
+    __table_args__ = (Index('ix_mail_outbox_status_next_attempt', 'status', 'next_attempt_at'),)
+
+    def __repr__(self):
+        return f"<OutboxEmail(subject='{self.subject}', status='{self.status}', attempts={self.attempts})>"
@@ -0,0 +1,49 @@
+# app/models/storage_usage.py
+from sqlalchemy import Column, String, DateTime, func, Integer, BigInteger
+from app.database import Base
+
+
+# Alcance de cada contador
+class UsageScope:
+    COMPANY = 'company'
+    EXAM = 'exam'
+
+
+class StorageUsage(Base):
+    """Bytes e arquivos das imagens, somados a cada upload e exclusão (sem varrer a pasta de upload)."""
+    __tablename__ = 'storage_usage'
+    scope = Column(String(10), primary_key=True)
+    owner_id = Column(String(26), primary_key=True)  # Id da empresa ou do exame, conforme o escopo
+    company_id = Column(String(26), nullable=False, index=True)
+    bytes = Column(BigInteger, default=0, nullable=False)
+    files = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<StorageUsage(scope='{self.scope}', owner_id='{self.owner_id}', bytes={self.bytes}, files={self.files})>"
+
+    def to_dict(self):
+        return {
+            'scope': self.scope,
+            'owner_id': self.owner_id,
+            'company_id': self.company_id,
+            'bytes': self.bytes,
+            'files': self.files,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class CompanyQuota(Base):
+    """
+    Cotas de armazenamento da empresa em bytes; nulas (ou sem linha) usam
+    STORAGE_SOFT_QUOTA_BYTES / STORAGE_HARD_QUOTA_BYTES. Tabela própria para que o
+    create_all a crie numa base existente, sem alterar a tabela de empresas.
+    """
+    __tablename__ = 'company_quotas'
+    company_id = Column(String(26), primary_key=True)
+    soft_quota = Column(BigInteger, nullable=True)
+    hard_quota = Column(BigInteger, nullable=True)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<CompanyQuota(company_id='{self.company_id}', soft_quota={self.soft_quota}, hard_quota={self.hard_quota})>"
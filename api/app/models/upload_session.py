@@ -0,0 +1,69 @@
+# app/models/upload_session.py
+from sqlalchemy import Column, String, DateTime, func, ForeignKey, Integer, BigInteger, UniqueConstraint
+from sqlalchemy.orm import relationship
+import ulid
+from app.database import Base
+
+
+# Estados de um upload retomável
+class UploadStatus:
+    OPEN = 'open'
+    FINALIZING = 'finalizing'  # Reservada por uma chamada de finalização em andamento
+    COMPLETED = 'completed'
+    FAILED = 'failed'  # Finalização falhou depois de consumir o arquivo parcial: é preciso reenviar
+
+
+class UploadSession(Base):
+    __tablename__ = 'upload_sessions'
+    id = Column(String(26), primary_key=True, default=lambda: str(ulid.new()))
+    exam_id = Column(String(26), ForeignKey('exams.id'), nullable=False, index=True)
+    filename = Column(String(255), nullable=False)  # Nome final do arquivo (já com extensão)
+    mime_type = Column(String(100), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+    received = Column(BigInteger, default=0, nullable=False)  # Bytes contíguos já gravados
+    status = Column(String(10), default=UploadStatus.OPEN, nullable=False)
+    image_id = Column(String(26), ForeignKey('exam_images.id'), nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    expires_at = Column(DateTime, nullable=False)
+
+    chunks = relationship("UploadChunk", back_populates="session", order_by="UploadChunk.number",
+                          cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return f"<UploadSession(exam_id='{self.exam_id}', filename='{self.filename}', received={self.received}/{self.size})>"
+
+    @property
+    def next_chunk(self):
+        return self.received // self.chunk_size
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'exam_id': self.exam_id,
+            'filename': self.filename,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'offset': self.received,
+            'next_chunk': self.next_chunk,
+            'status': self.status,
+            'image_id': self.image_id,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None
+        }
+
+
+class UploadChunk(Base):
+    __tablename__ = 'upload_chunks'
+    __table_args__ = (UniqueConstraint('session_id', 'number'),)
+    id = Column(String(26), primary_key=True, default=lambda: str(ulid.new()))
+    session_id = Column(String(26), ForeignKey('upload_sessions.id'), nullable=False, index=True)
+    number = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    checksum = Column(String(64), nullable=False)  # SHA-256 do bloco
+    created_at = Column(DateTime, default=func.now())
+
+    session = relationship("UploadSession", back_populates="chunks")
+
+    def __repr__(self):
+        return f"<UploadChunk(session_id='{self.session_id}', number={self.number}, size={self.size})>"
@@ -18,10 +18,11 @@ class UserRole:
     ADMIN = 0
     EDITOR = 1
     WORKER = 2
+    COMPANY = 4  # Papel atribuído às empresas nos tokens de login
 
     @classmethod
     def get_choices(cls):
-        return [(cls.ADMIN, "Admin"), (cls.EDITOR, "Editor"), (cls.WORKER, "Worker")]
+        return [(cls.ADMIN, "Admin"), (cls.EDITOR, "Editor"), (cls.WORKER, "Worker"), (cls.COMPANY, "Empresa")]
 
     @classmethod
     def get_label(cls, value):
@@ -0,0 +1,168 @@
+# app/notificacoes.py
+import os
+from collections import defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.orm import joinedload
+from werkzeug.utils import secure_filename
+
+from app import armazenamento
+from app.assinatura import gerar_url_arquivo
+from app.mail_queue import enfileirar_email, notificar_worker
+from app.models.exam import Exam
+from app.models.exam_image import ExamImage
+
+
+def formatar_data(exame):
+    return exame.exam_date.strftime("%d-%m-%Y") if exame.exam_date else datetime.now().strftime("%d-%m-%Y")
+
+
+def email_trabalhador(exame, usuario, empresa, data_formatada):
+    assunto = f"Seu exame está pronto - {data_formatada}"
+    corpo = f"""
+        <html>
+            <body>
+                <h2>Olá, {usuario.name}!</h2>
+                <p>Seu exame realizado na empresa <b>{empresa.name}</b> em <b>{data_formatada}</b> está pronto.</p>
+                <p>Descrição do exame: <b>{exame.description}</b></p>
+                <p>Entre em contato com a empresa para mais informações ou para buscar o resultado completo.</p>
+                <p>Obrigado!</p>
+            </body>
+        </html>
+        """
+    return assunto, corpo
+
+
+def email_empresa(exame, usuario, empresa, data_formatada):
+    assunto = f"Exame de {usuario.name} está pronto - {data_formatada}"
+    corpo = f"""
+        <html>
+            <body>
+                <h2>Olá, {empresa.name}!</h2>
+                <p>O exame do funcionário <b>{usuario.name}</b> realizado em <b>{data_formatada}</b> está pronto.</p>
+                <p>Descrição do exame: <b>{exame.description}</b></p>
+                <p>As imagens foram processadas e estão disponíveis no sistema.</p>
+                <p>Entre em contato com o funcionário para informá-lo sobre o resultado.</p>
+            </body>
+        </html>
+        """
+    return assunto, corpo
+
+
+def email_resumo_empresa(empresa, exames):
+    """Resumo único para a empresa com todos os exames prontos do lote."""
+    linhas = "".join(
+        f"<tr><td>{exame.user.name}</td><td>{formatar_data(exame)}</td><td>{exame.description}</td></tr>"
+        for exame in exames
+    )
+    assunto = f"{len(exames)} exame(s) pronto(s) - {empresa.name}"
+    corpo = f"""
+        <html>
+            <body>
+                <h2>Olá, {empresa.name}!</h2>
+                <p>Os exames abaixo estão prontos e as imagens estão disponíveis no sistema.</p>
+                <table>
+                    <tr><th>Funcionário</th><th>Data</th><th>Descrição</th></tr>
+                    {linhas}
+                </table>
+                <p>Cada funcionário também foi notificado por e-mail.</p>
+            </body>
+        </html>
+        """
+    return assunto, corpo
+
+
+def imagens_por_exame(db, exam_ids):
+    """Agrupa as imagens dos exames informados com uma única consulta indexada."""
+    agrupadas = defaultdict(list)
+    if not exam_ids:
+        return agrupadas
+    imagens = db.query(ExamImage)\
+                .filter(ExamImage.exam_id.in_(exam_ids))\
+                .order_by(ExamImage.exam_id, ExamImage.position)\
+                .all()
+    for imagem in imagens:
+        agrupadas[imagem.exam_id].append(imagem)
+    return agrupadas
+
+
+def preparar_anexos(exame, usuario, empresa, imagens):
+    """
+    Monta os anexos apontando para os arquivos originais, apenas com um nome amigável.
+    Arquivos acima de MAIL_ATTACHMENT_MAX_BYTES seguem como link assinado.
+    """
+    limite = current_app.config['MAIL_ATTACHMENT_MAX_BYTES']
+    data_formatada = formatar_data(exame)
+    anexos = []
+    for i, imagem in enumerate(imagens):
+        extensao = os.path.splitext(imagem.name)[1]
+        nome_exibicao = f"{usuario.name.replace(' ', '_')}_{empresa.name.replace(' ', '_')}_{data_formatada}_{i+1}{extensao}"
+        nome_exibicao = secure_filename(nome_exibicao)
+        anexo = {
+            # Arquivo no bucket vai pela chave: o worker de e-mail o lê pelo driver
+            "path": imagem.path if armazenamento.remoto(imagem.path) else armazenamento.caminho_absoluto(imagem.path),
+            "filename": nome_exibicao,
+            "content_type": imagem.mime_type
+        }
+        if imagem.size > limite:
+            # Link da rota /arquivos, que redireciona para o bucket quando o arquivo está no driver remoto
+            anexo["url"] = gerar_url_arquivo(imagem.path, imagem.mime_type, nome_exibicao,
+                                             validade=current_app.config['MAIL_LINK_MAX_AGE'])
+        anexos.append(anexo)
+    return anexos
+
+
+def notificar_exames_em_lote(db, progresso, exam_ids=None, company_id=None, data_inicial=None, data_final=None):
+    """
+    Tarefa em segundo plano: um e-mail por trabalhador e um resumo por empresa.
+    Exames, usuários e empresas são carregados numa única consulta.
+    """
+    query = db.query(Exam)\
+        .options(joinedload(Exam.user), joinedload(Exam.company))\
+        .filter(Exam.image_uploaded == True)
+    if exam_ids:
+        query = query.filter(Exam.id.in_(exam_ids))
+    else:
+        query = query.filter(
+            Exam.company_id == company_id,
+            Exam.exam_date >= datetime.strptime(data_inicial, '%Y-%m-%d').date(),
+            Exam.exam_date <= datetime.strptime(data_final, '%Y-%m-%d').date()
+        )
+    exames = query.order_by(Exam.exam_date).all()
+    progresso.definir_total(len(exames))
+
+    imagens = imagens_por_exame(db, [exame.id for exame in exames])
+    por_empresa = defaultdict(list)
+    ignorados = []
+    emails_trabalhadores = 0
+
+    for exame in exames:
+        usuario, empresa = exame.user, exame.company
+        if not usuario or not empresa or not imagens.get(exame.id):
+            ignorados.append(exame.id)
+            progresso.avancar()
+            continue
+
+        anexos = preparar_anexos(exame, usuario, empresa, imagens[exame.id])
+        assunto, corpo = email_trabalhador(exame, usuario, empresa, formatar_data(exame))
+        enfileirar_email(db, assunto, [usuario.email], corpo, anexos=anexos, commit=False)
+        emails_trabalhadores += 1
+
+        exame.updated_at = datetime.now()
+        por_empresa[empresa.id].append(exame)
+        progresso.avancar()
+
+    for exames_empresa in por_empresa.values():
+        empresa = exames_empresa[0].company
+        assunto, corpo = email_resumo_empresa(empresa, exames_empresa)
+        enfileirar_email(db, assunto, [empresa.email], corpo, commit=False)
+
+    db.commit()
+    notificar_worker()
+
+    return {
+        "exames_notificados": emails_trabalhadores,
+        "resumos_empresas": len(por_empresa),
+        "ignorados": ignorados
+    }
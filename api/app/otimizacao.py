@@ -0,0 +1,178 @@
+# app/otimizacao.py
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
+
+from flask import current_app
+
+from app import armazenamento, blobs, derivados
+from app.armazenamento import ArquivoRecebido
+from app.consumo import registrar_consumo
+from app.imagens import calcular_checksum
+from app.jobs import iniciar_job
+from app.models.exam_image import ExamImage
+
+# Fotos de celular: os formatos que vale a pena limpar e recomprimir
+TIPOS_OTIMIZAVEIS = {'image/jpeg', 'image/png'}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _descartar_pool_herdado():
+    # Num fork depois do pool criado, o filho herdaria um executor cujas threads ficaram no pai
+    global _pool, _pool_lock
+    _pool, _pool_lock = None, threading.Lock()
+
+
+os.register_at_fork(after_in_child=_descartar_pool_herdado)
+
+
+def otimizar_arquivo(origem, destino, mime_type, qualidade, lado_maximo):
+    """
+    Executado no pool de processos: aplica a orientação do EXIF, reduz o lado maior a `lado_maximo`
+    e grava sem metadados (EXIF, GPS, comentários); só o perfil de cor é mantido.
+    Retorna (tamanho, checksum) do arquivo gravado.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(origem) as aberta:
+        perfil = aberta.info.get('icc_profile')
+        imagem = ImageOps.exif_transpose(aberta)
+        imagem.thumbnail((lado_maximo, lado_maximo), Image.LANCZOS)  # Nunca amplia o original
+        if mime_type == 'image/jpeg':
+            if imagem.mode != 'RGB':
+                imagem = imagem.convert('RGB')
+            imagem.save(destino, 'JPEG', quality=qualidade, optimize=True, progressive=True, icc_profile=perfil)
+        else:
+            imagem.save(destino, 'PNG', optimize=True, icc_profile=perfil)
+    return os.path.getsize(destino), calcular_checksum(destino)
+
+
+def _get_pool(app):
+    global _pool
+    with _pool_lock:
+        # Criado sob demanda no processo que atende a requisição (compatível com pre-fork)
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=app.config['IMAGE_OPTIMIZE_WORKERS'])
+    return _pool
+
+
+def otimizavel(imagem):
+    return imagem.mime_type in TIPOS_OTIMIZAVEIS and imagem.original_size is None
+
+
+def _substituir(db, image_id, checksum_anterior, tamanho_anterior, recebido):
+    """
+    Aponta a imagem para o conteúdo otimizado. A atualização exige o checksum lido antes:
+    se a imagem foi reenviada ou apagada nesse meio tempo, o resultado é descartado.
+    """
+    manter = current_app.config['IMAGE_OPTIMIZE_KEEP_ORIGINALS']
+    blob, _ = blobs.armazenar(db, recebido)
+    atualizados = db.query(ExamImage)\
+        .filter(ExamImage.id == image_id, ExamImage.checksum == checksum_anterior)\
+        .update({
+            "path": blob.path,
+            "blob_checksum": blob.checksum,
+            "checksum": blob.checksum,
+            "size": blob.size,
+            "original_size": tamanho_anterior,
+            "original_checksum": checksum_anterior if manter else None
+        }, synchronize_session=False)
+    if not atualizados:
+        blobs.liberar(db, blob.checksum)
+        db.commit()
+        return False
+    if not manter:
+        blobs.liberar(db, checksum_anterior)
+    # O exame passa a ocupar o tamanho otimizado (mais o original, quando mantido)
+    exam_id = db.query(ExamImage.exam_id).filter(ExamImage.id == image_id).scalar()
+    registrar_consumo(db, exam_id, blob.size - (0 if manter else tamanho_anterior), 0)
+    db.commit()
+    return True
+
+
+def otimizar_imagens(db, progresso, image_ids):
+    """
+    Tarefa em segundo plano: envia as imagens ao pool de processos, todas de uma vez,
+    e troca o conteúdo de cada uma conforme os resultados chegam.
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    imagens = [imagem for imagem in db.query(ExamImage).filter(ExamImage.id.in_(image_ids)).all()
+               if otimizavel(imagem)]
+    progresso.definir_total(len(imagens))
+    resultado = {"otimizadas": 0, "bytes_antes": 0, "bytes_depois": 0, "falhas": 0}
+
+    pendentes = []
+    with ExitStack() as copias, tempfile.TemporaryDirectory(dir=armazenamento.pasta_temporaria()) as pasta:
+        for imagem in imagens:
+            # Blobs no bucket ficam baixados no disco local até o fim da tarefa
+            origem = copias.enter_context(armazenamento.copia_local(imagem.path))
+            if origem is None:
+                resultado["falhas"] += 1
+                progresso.avancar()
+                continue
+            destino = os.path.join(pasta, imagem.id)
+            argumentos = (origem, destino, imagem.mime_type,
+                          config['IMAGE_OPTIMIZE_QUALITY'], config['IMAGE_OPTIMIZE_MAX_SIDE'])
+            if config['IMAGE_OPTIMIZE_SYNC']:
+                futuro = Future()
+                try:
+                    futuro.set_result(otimizar_arquivo(*argumentos))
+                except Exception as e:
+                    futuro.set_exception(e)
+            else:
+                futuro = _get_pool(app).submit(otimizar_arquivo, *argumentos)
+            pendentes.append((imagem.id, imagem.checksum, imagem.size, destino, futuro))
+
+        otimizadas = []
+        for image_id, checksum_anterior, tamanho_anterior, destino, futuro in pendentes:
+            try:
+                tamanho, checksum = futuro.result()
+                recebido = ArquivoRecebido(destino, tamanho, checksum)
+                if _substituir(db, image_id, checksum_anterior, tamanho_anterior, recebido):
+                    resultado["otimizadas"] += 1
+                    resultado["bytes_antes"] += tamanho_anterior
+                    resultado["bytes_depois"] += tamanho
+                    otimizadas.append(image_id)
+            except Exception as e:
+                db.rollback()
+                resultado["falhas"] += 1
+                app.logger.error(f"Erro ao otimizar a imagem {image_id}: {str(e)}")
+            progresso.avancar()
+
+    # Prévias geradas já a partir do conteúdo otimizado
+    derivados.agendar(db.query(ExamImage).filter(ExamImage.id.in_(otimizadas)).all() if otimizadas else [])
+    resultado["bytes_economizados"] = resultado["bytes_antes"] - resultado["bytes_depois"]
+    return resultado
+
+
+def apos_upload(db, imagens):
+    """
+    Etapa que segue o upload: com IMAGE_OPTIMIZE ligado, fotos JPEG/PNG passam pela otimização
+    (que agenda as prévias ao terminar); o restante vai direto para os derivados.
+    """
+    if not current_app.config['IMAGE_OPTIMIZE']:
+        derivados.agendar(imagens)
+        return None
+    otimizaveis = [imagem for imagem in imagens if otimizavel(imagem)]
+    derivados.agendar([imagem for imagem in imagens if not otimizavel(imagem)])
+    if not otimizaveis:
+        return None
+    return iniciar_job(db, 'otimizar_imagens', otimizar_imagens, image_ids=[imagem.id for imagem in otimizaveis])
+
+
+def init_otimizacao(app):
+    # Etapa opcional: remove metadados e recomprime as fotos depois do upload
+    app.config.setdefault('IMAGE_OPTIMIZE', os.getenv('IMAGE_OPTIMIZE', 'false').lower() == 'true')
+    app.config.setdefault('IMAGE_OPTIMIZE_QUALITY', int(os.getenv('IMAGE_OPTIMIZE_QUALITY', 82)))
+    app.config.setdefault('IMAGE_OPTIMIZE_MAX_SIDE', int(os.getenv('IMAGE_OPTIMIZE_MAX_SIDE', 2560)))
+    # Mantém o arquivo enviado como blob (referenciado por original_checksum)
+    app.config.setdefault('IMAGE_OPTIMIZE_KEEP_ORIGINALS',
+                          os.getenv('IMAGE_OPTIMIZE_KEEP_ORIGINALS', 'false').lower() == 'true')
+    app.config.setdefault('IMAGE_OPTIMIZE_WORKERS', 2)
+    # Nos testes a otimização roda na própria tarefa, de forma determinística
+    app.config.setdefault('IMAGE_OPTIMIZE_SYNC', app.config.get('TESTING', False))
@@ -0,0 +1,313 @@
+# app/povoamento.py
+import hashlib
+import random
+import threading
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta
+from time import monotonic
+
+import click
+import ulid
+from bcrypt import gensalt, hashpw
+from sqlalchemy import insert
+
+from app.models.company import Company
+from app.models.exam import Exam
+from app.models.user import User, UserRole
+
+# Volume na escala 1 (a mesma proporção do antigo /populate, mais os exames)
+USUARIOS = 10000
+EMPRESAS = 1000
+EXAMES = 30000
+
+SENHA_PADRAO = '123456'
+LOTE = 5000
+
+# Fração de administradores e editores; os demais usuários são trabalhadores
+ADMINISTRADORES = 0.01
+EDITORES = 0.03
+
+TIPOS_DE_EXAME = [
+    ("Exame admissional", 30),
+    ("Exame periódico", 45),
+    ("Exame demissional", 12),
+    ("Retorno ao trabalho", 8),
+    ("Mudança de função", 5),
+]
+
+DOMINIOS = ['gmail.com', 'hotmail.com', 'outlook.com', 'yahoo.com', 'uol.com.br']
+
+_faker = None
+_faker_lock = threading.Lock()
+
+
+def _get_faker():
+    global _faker
+    with _faker_lock:
+        # Um Faker por processo: criá-lo a cada linha era o que deixava o /populate lento
+        if _faker is None:
+            import faker
+            _faker = faker.Faker('pt_BR')
+    return _faker
+
+
+def gerar_id(semente, tipo, indice, criado_em):
+    """ULID determinístico: o instante de criação seguido de bytes derivados da semente e do índice."""
+    aleatorio = hashlib.blake2b(f"{semente}:{tipo}:{indice}".encode(), digest_size=10).digest()
+    instante = int(criado_em.timestamp() * 1000).to_bytes(6, 'big')
+    return str(ulid.from_bytes(instante + aleatorio))
+
+
+def _pesos_cnpj(tamanho):
+    return [(i % 8) + 2 for i in range(tamanho - 1, -1, -1)]
+
+
+def gerar_cpf(semente, indice):
+    """CPF válido e único por índice: a multiplicação por 3^18 embaralha os números sem repetir."""
+    base = f"{(indice * 387420489 + semente) % 10 ** 9:09d}"
+    for _ in range(2):
+        soma = sum(int(d) * p for d, p in zip(base, range(len(base) + 1, 1, -1)))
+        resto = soma % 11
+        base += '0' if resto < 2 else str(11 - resto)
+    return f"{base[:3]}.{base[3:6]}.{base[6:9]}-{base[9:]}"
+
+
+def gerar_cnpj(semente, indice):
+    """CNPJ válido (só dígitos, como a coluna comporta) e único por índice."""
+    base = f"{(indice * 4782969 + semente) % 10 ** 8:08d}0001"
+    for _ in range(2):
+        soma = sum(int(d) * p for d, p in zip(base, _pesos_cnpj(len(base))))
+        resto = soma % 11
+        base += '0' if resto < 2 else str(11 - resto)
+    return base
+
+
+def _sem_acentos(texto):
+    return ''.join(c for c in unicodedata.normalize('NFD', texto) if unicodedata.category(c) != 'Mn')
+
+
+def _enderecos(fake, rng):
+    sorteio = rng.random()
+    quantidade = 1 if sorteio < 0.7 else 2 if sorteio < 0.9 else 3 if sorteio < 0.95 else 4
+    return [{
+        "id": str(ulid.from_bytes(rng.randbytes(16))),
+        "cep": fake.postcode(),
+        "logradouro": fake.street_name(),
+        "numero": fake.building_number(),
+        "complemento": "Casa",
+        "bairro": fake.neighborhood(),
+        "cidade": fake.city(),
+        "estado": fake.state_abbr(),
+    } for _ in range(quantidade)]
+
+
+def papeis_especiais(total):
+    """Quantos dos primeiros índices são administradores e editores."""
+    return max(1, int(total * ADMINISTRADORES)) + int(total * EDITORES)
+
+
+def papel_do_usuario(indice, total):
+    """O papel sai do índice, sem consultar o banco: os primeiros são administradores e editores."""
+    if indice < max(1, int(total * ADMINISTRADORES)):
+        return UserRole.ADMIN
+    if indice < papeis_especiais(total):
+        return UserRole.EDITOR
+    return UserRole.WORKER
+
+
+def criado_em(semente, tipo, indice, total, periodo):
+    """
+    Cadastros espalhados no período na ordem dos índices (os ULIDs ficam em ordem de criação).
+    Depende só da semente e do índice: os exames calculam o id do usuário e da empresa sem consultar o banco.
+    """
+    inicio, fim = periodo
+    passo = (fim - inicio) / max(total, 1)
+    desvio = int.from_bytes(hashlib.blake2b(f"{semente}:{tipo}:{indice}".encode(), digest_size=4).digest(), 'big')
+    return inicio + passo * indice + timedelta(seconds=desvio % max(int(passo.total_seconds()), 1))
+
+
+def id_do_cadastro(semente, tipo, indice, total, periodo):
+    return gerar_id(semente, tipo, indice, criado_em(semente, tipo, indice, total, periodo))
+
+
+def gerar_usuarios(semente, inicio, quantidade, parametros):
+    """Executado no pool de processos: um lote de usuários, sempre igual para a mesma semente e índice inicial."""
+    fake = _get_faker()
+    fake.seed_instance(f"{semente}:usuarios:{inicio}")
+    rng = random.Random(f"{semente}:usuarios:{inicio}")
+    total, periodo, senha = parametros['total'], parametros['periodo'], parametros['senha_hash']
+    linhas = []
+    for indice in range(inicio, inicio + quantidade):
+        nome, sobrenome = fake.first_name(), fake.last_name()
+        cadastro = criado_em(semente, 'usuario', indice, total, periodo)
+        usuario = _sem_acentos(f"{nome}{rng.choice(['', '.'])}{sobrenome}".lower().replace(' ', ''))
+        linhas.append({
+            "id": gerar_id(semente, 'usuario', indice, cadastro),
+            "name": f"{nome} {sobrenome}"[:50],
+            "email": f"{usuario}.{indice}@{rng.choice(DOMINIOS)}",
+            "password_hash": senha,
+            "address": _enderecos(fake, rng),
+            "phone": fake.phone_number()[:20],
+            "cpf": gerar_cpf(semente, indice),
+            "role": papel_do_usuario(indice, total),
+            "ativo": True,
+            "created_at": cadastro,
+            "updated_at": cadastro,
+        })
+    return linhas
+
+
+def gerar_empresas(semente, inicio, quantidade, parametros):
+    fake = _get_faker()
+    fake.seed_instance(f"{semente}:empresas:{inicio}")
+    rng = random.Random(f"{semente}:empresas:{inicio}")
+    total, periodo, senha = parametros['total'], parametros['periodo'], parametros['senha_hash']
+    linhas = []
+    for indice in range(inicio, inicio + quantidade):
+        nome = fake.company()
+        cadastro = criado_em(semente, 'empresa', indice, total, periodo)
+        dominio = ''.join(c for c in _sem_acentos(nome.lower()) if c.isalnum())[:15] or 'empresa'
+        linhas.append({
+            "id": gerar_id(semente, 'empresa', indice, cadastro),
+            "name": nome[:100],
+            "email": f"contato{indice}@{dominio}.com.br",
+            "password_hash": senha,
+            "address": _enderecos(fake, rng),
+            "phone": fake.phone_number()[:20],
+            "cnpj": gerar_cnpj(semente, indice),
+            "ativo": True,
+            "created_at": cadastro,
+            "updated_at": cadastro,
+        })
+    return linhas
+
+
+def _data_do_exame(rng, ate):
+    """Mais exames recentes que antigos (até dois anos), alguns já agendados e quase nenhum no fim de semana."""
+    if rng.random() < 0.08:
+        dia = ate + timedelta(days=rng.randint(1, 30))
+    else:
+        dia = ate - timedelta(days=min(int(rng.expovariate(1 / 180)), 730))
+    if dia.weekday() == 6:
+        dia += timedelta(days=1)
+    elif dia.weekday() == 5 and rng.random() < 0.7:
+        dia -= timedelta(days=1)
+    return dia
+
+
+def gerar_exames(semente, inicio, quantidade, parametros):
+    """
+    Executado no pool de processos. Empresas grandes concentram os exames (distribuição log-uniforme
+    sobre os índices) e cada trabalhador pertence a uma faixa fixa de uma empresa.
+    """
+    rng = random.Random(f"{semente}:exames:{inicio}")
+    empresas, usuarios = parametros['empresas'], parametros['usuarios']
+    periodo, ate = parametros['periodo'], parametros['ate']
+    primeiro = papeis_especiais(usuarios)
+    trabalhadores = max(usuarios - primeiro, 1)
+    tipos, pesos = zip(*TIPOS_DE_EXAME)
+    linhas = []
+    for indice in range(inicio, inicio + quantidade):
+        empresa = min(int(empresas ** rng.random()) - 1, empresas - 1)
+        faixa_inicio = primeiro + trabalhadores * empresa // empresas
+        faixa_fim = max(primeiro + trabalhadores * (empresa + 1) // empresas, faixa_inicio + 1)
+        usuario = min(rng.randrange(faixa_inicio, faixa_fim), usuarios - 1)
+
+        dia = _data_do_exame(rng, ate)
+        agendado_em = datetime.combine(dia - timedelta(days=rng.randint(1, 21)),
+                                       time(rng.randint(7, 18), rng.randrange(60), rng.randrange(60)))
+        if dia > ate:
+            enviado = False
+        else:
+            # Exames da última semana ainda aguardam as imagens com mais frequência
+            enviado = rng.random() < (0.5 if (ate - dia).days < 7 else 0.92)
+        linhas.append({
+            "id": gerar_id(semente, 'exame', indice, agendado_em),
+            "description": rng.choices(tipos, pesos)[0],
+            "image_uploaded": enviado,
+            "user_id": id_do_cadastro(semente, 'usuario', usuario, usuarios, periodo),
+            "company_id": id_do_cadastro(semente, 'empresa', empresa, empresas, periodo),
+            "created_at": agendado_em,
+            "updated_at": agendado_em,
+            "exam_date": dia,
+        })
+    return linhas
+
+
+def _lotes(total, tamanho):
+    return [(inicio, min(tamanho, total - inicio)) for inicio in range(0, total, tamanho)]
+
+
+def _executar(pool, funcao, semente, lotes, parametros):
+    """Lotes gerados no pool e devolvidos em ordem; sem pool (processos=0) a geração é feita aqui."""
+    if pool is None:
+        return (funcao(semente, inicio, quantidade, parametros) for inicio, quantidade in lotes)
+    return pool.map(funcao, *zip(*[(semente, inicio, quantidade, parametros) for inicio, quantidade in lotes]))
+
+
+def povoar(db, escala=1.0, semente=42, exames=None, lote=LOTE, processos=None, ate=None, logger=None):
+    """
+    Cria usuários, empresas e exames para desenvolvimento e testes de desempenho.
+    A senha comum é criptografada uma única vez, os lotes são gerados em paralelo e inseridos
+    com um INSERT de várias linhas por lote. Com a mesma semente e a mesma data `ate`
+    o resultado é idêntico, inclusive os ids.
+    """
+    if db.query(User.id).first() or db.query(Company.id).first():
+        raise ValueError("O banco já tem usuários ou empresas; o povoamento precisa de um banco vazio")
+
+    ate = ate or date.today()
+    usuarios = max(int(USUARIOS * escala), 1)
+    empresas = max(int(EMPRESAS * escala), 1)
+    exames = int(EXAMES * escala) if exames is None else exames
+    # Cadastros nos três anos anteriores à data de referência
+    periodo = (datetime.combine(ate - timedelta(days=3 * 365), time()), datetime.combine(ate, time()))
+    senha_hash = hashpw(SENHA_PADRAO.encode('utf-8'), gensalt()).decode('utf-8')
+
+    etapas = [
+        (User, gerar_usuarios, usuarios, {'total': usuarios, 'periodo': periodo, 'senha_hash': senha_hash}),
+        (Company, gerar_empresas, empresas, {'total': empresas, 'periodo': periodo, 'senha_hash': senha_hash}),
+        (Exam, gerar_exames, exames, {'usuarios': usuarios, 'empresas': empresas, 'periodo': periodo, 'ate': ate}),
+    ]
+    resultado = {}
+    pool = ProcessPoolExecutor(max_workers=processos) if processos != 0 else None
+    try:
+        for modelo, funcao, total, parametros in etapas:
+            inseridos = 0
+            for linhas in _executar(pool, funcao, semente, _lotes(total, lote), parametros):
+                db.execute(insert(modelo), linhas)
+                db.commit()
+                inseridos += len(linhas)
+                if logger:
+                    logger.info(f"{modelo.__tablename__}: {inseridos}/{total}")
+            resultado[modelo.__tablename__] = inseridos
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return resultado
+
+
+def init_povoamento(app):
+    @app.cli.command('seed')
+    @click.option('--escala', default=1.0, show_default=True,
+                  help=f'Multiplica {USUARIOS} usuários, {EMPRESAS} empresas e {EXAMES} exames.')
+    @click.option('--exames', type=int, default=None, help='Número de exames (substitui o da escala).')
+    @click.option('--semente', default=42, show_default=True, help='Mesma semente, mesmos dados.')
+    @click.option('--ate', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+                  help='Data de referência (padrão: hoje); fixe-a para reproduzir os dados em outro dia.')
+    @click.option('--lote', default=LOTE, show_default=True, help='Linhas por INSERT.')
+    @click.option('--processos', type=int, default=None, help='Processos geradores (0 gera no próprio processo).')
+    def seed_command(escala, exames, semente, ate, lote, processos):
+        """Povoa um banco vazio com dados sintéticos (substitui o antigo POST /populate)."""
+        from app import get_db, init_db
+        init_db()
+        db = get_db()
+        inicio = monotonic()
+        try:
+            resultado = povoar(db, escala, semente, exames, lote, processos, ate.date() if ate else None,
+                               logger=app.logger)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        finally:
+            db.close()
+        print(f"Povoamento concluído em {monotonic() - inicio:.1f}s: {resultado}")
@@ -1,10 +1,13 @@
 from flask import Blueprint, request, jsonify, current_app, url_for
 from app.models.company import Company, CompanyDTO
-from app import get_db, mail
-from flask_mail import Message
+from app.models.storage_usage import CompanyQuota
+from app import get_db
+from app.mail_queue import enfileirar_email
 from bcrypt import hashpw, gensalt
 from datetime import datetime, timedelta, timezone
-from app.models.user import User
+from app.models.user import User, UserRole
+from app.auth import requer_papel
+from app import consumo
 import json
 import ulid
 
@@ -19,29 +22,18 @@ company_bp = Blueprint("company", __name__)
 
 
 def enviar_email(para, assunto, template):
-    try:
-        msg = Message(
-            assunto,
-            recipients=[para],
-            html=template,
-            sender=current_app.config["MAIL_USERNAME"],
-        )
-        mail.send(msg)
-    except Exception as e:
-        pass
+    # O envio acontece em segundo plano; aqui apenas gravamos na fila de saída
+    enfileirar_email(get_db(), assunto, [para], template)
 
 
 def enviar_email_verificacao(company_dto: CompanyDTO):
-    try:
-        token = company_dto.to_jwt()
-        frontend_url = current_app.config["FRONTEND_URL"]
-        confirm_url = f"{frontend_url}/redefine-senha-empresa/{token}"
-        html = f'<b>Bem-vindo! Por favor, confirme seu e-mail clicando <a href="{confirm_url}">aqui</a>.</b>'
-        assunto = "Por favor, confirme seu e-mail"
-        enviar_email(company_dto.email, assunto, html)
-        return confirm_url
-    except Exception as e:
-        pass
+    token = company_dto.to_jwt()
+    frontend_url = current_app.config["FRONTEND_URL"]
+    confirm_url = f"{frontend_url}/redefine-senha-empresa/{token}"
+    html = f'<b>Bem-vindo! Por favor, confirme seu e-mail clicando <a href="{confirm_url}">aqui</a>.</b>'
+    assunto = "Por favor, confirme seu e-mail"
+    enviar_email(company_dto.email, assunto, html)
+    return confirm_url
 
 
 @company_bp.route("/empresa/reenviaremail/<id>", methods=["GET"])
@@ -384,6 +376,61 @@ def deletar(id):
         return jsonify({"erro": "Erro ao deletar empresa"}), 500
 
 
+@company_bp.route("/empresa/armazenamento/<id>", methods=["GET"])
+def armazenamento(id):
+    """Espaço ocupado pelas imagens da empresa, cotas e os exames que mais ocupam (lido dos contadores)."""
+    try:
+        db = get_db()
+        if not db.query(Company.id).filter(Company.id == id).first():
+            return jsonify({"erro": "Empresa não encontrada"}), 404
+        exames = min(request.args.get("exames", 10, type=int), 100)
+        return jsonify({"armazenamento": consumo.uso(db, id, exames)}), 200
+    except Exception as e:
+        current_app.logger.error(f"Erro ao obter armazenamento da empresa: {str(e)}")
+        return jsonify({"erro": "Erro ao obter armazenamento da empresa"}), 500
+
+
+@company_bp.route("/empresas/armazenamento", methods=["GET"])
+@requer_papel(UserRole.ADMIN)
+def relatorio_armazenamento():
+    """Relatório do administrador: empresas ordenadas pelo espaço ocupado e situação das cotas."""
+    try:
+        db = get_db()
+        return jsonify({"relatorio": consumo.relatorio_consumo(db, request.args.get("limite", type=int))}), 200
+    except Exception as e:
+        current_app.logger.error(f"Erro ao gerar relatório de armazenamento: {str(e)}")
+        return jsonify({"erro": "Erro ao gerar relatório de armazenamento"}), 500
+
+
+@company_bp.route("/empresas/armazenamento/<id>/cotas", methods=["PUT"])
+@requer_papel(UserRole.ADMIN)
+def definir_cotas(id):
+    """Define as cotas da empresa em bytes; null volta ao padrão da configuração."""
+    try:
+        dados = request.get_json()
+        if not dados:
+            return jsonify({"erro": "Nenhum dado de entrada fornecido"}), 400
+        db = get_db()
+        company = db.query(Company).get(id)
+        if not company:
+            return jsonify({"erro": "Empresa não encontrada"}), 404
+
+        cotas = db.query(CompanyQuota).get(id) or CompanyQuota(company_id=id)
+        for campo, coluna in (("cota_suave", "soft_quota"), ("cota_rigida", "hard_quota")):
+            if campo in dados:
+                valor = dados[campo]
+                if valor is not None and (not isinstance(valor, int) or valor < 0):
+                    return jsonify({"erro": f"{campo} deve ser um número de bytes"}), 400
+                setattr(cotas, coluna, valor)
+        db.add(cotas)
+        db.commit()
+        return jsonify({"armazenamento": consumo.uso(db, id, 0)}), 200
+    except Exception as e:
+        db.rollback()
+        current_app.logger.error(f"Erro ao definir cotas da empresa: {str(e)}")
+        return jsonify({"erro": "Erro ao definir cotas da empresa"}), 500
+
+
 @company_bp.route("/empresas/all", defaults={"page": 1, "limit": 100}, methods=["GET"])
 @company_bp.route("/empresas/all/<int:page>/<int:limit>", methods=["GET"])
 def get_all_companies(page, limit):
@@ -0,0 +1,29 @@
+from flask import Blueprint, jsonify, current_app, request
+from app.auth import requer_papel
+from app.models.user import UserRole
+
+diagnostico_bp = Blueprint('diagnostico', __name__)
+
+
+# Rota do administrador: consultas lentas registradas por este processo, da mais recente para a mais antiga
+@diagnostico_bp.route('/diagnostico/consultas_lentas', methods=['GET'])
+@requer_papel(UserRole.ADMIN)
+def listar_consultas_lentas():
+    gravador = current_app.extensions.get('consultas_lentas')
+    if gravador is None:
+        return jsonify({"erro": "Registro de consultas lentas desligado (SLOW_QUERY_MS)"}), 404
+    return jsonify({
+        "limite_ms": gravador.limite_ms,
+        "arquivo": gravador.arquivo,
+        "consultas": gravador.listar(request.args.get("limite", type=int)),
+    }), 200
+
+
+@diagnostico_bp.route('/diagnostico/consultas_lentas', methods=['DELETE'])
+@requer_papel(UserRole.ADMIN)
+def limpar_consultas_lentas():
+    gravador = current_app.extensions.get('consultas_lentas')
+    if gravador is None:
+        return jsonify({"erro": "Registro de consultas lentas desligado (SLOW_QUERY_MS)"}), 404
+    gravador.limpar()
+    return jsonify({"mensagem": "Registro de consultas lentas limpo"}), 200
@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
 from app.models.exam import Exam
 from app.models.user import User
 from app.models.company import Company
@@ -7,11 +7,16 @@ from datetime import datetime, timedelta, date
 from sqlalchemy import distinct, func
 import ulid
 import os
-from werkzeug.utils import secure_filename
-from flask_mail import Message
-import shutil
-from app import mail  # Importar o objeto mail configurado no __init__.py
-from flask import send_from_directory
+from app import armazenamento, blobs, consumo, metricas
+from app import exportacao
+from app.compactacao import gerar_zip
+from app.imagens import imagens_do_exame
+from app.jobs import iniciar_job
+from app.models.upload_session import UploadSession
+from app.uploads import caminho_parcial
+from app.mail_queue import enfileirar_email, notificar_worker
+from app.notificacoes import (email_empresa, email_trabalhador, formatar_data, imagens_por_exame,
+                              notificar_exames_em_lote, preparar_anexos)
 exam_bp = Blueprint('exam', __name__)
 
 @exam_bp.route('/exames', methods=['POST'])
@@ -96,6 +101,7 @@ def atualizar(id):
         # Atualiza os campos (pode ser feito de forma mais dinâmica)
         exam.description = data.get('description', exam.description)
         exam.image_uploaded = data.get('image_uploaded', exam.image_uploaded)
+        consumo.transferir_exame(db, exam.id, exam.company_id, data.get('company_id', exam.company_id))
         exam.company_id = data.get('company_id', exam.company_id)
         exam.user_id = data.get('user_id', exam.user_id)
         exam.exam_date = datetime.strptime(data.get('exam_date'), '%Y-%m-%d').date() if data.get('exam_date') else exam.exam_date
@@ -117,6 +123,16 @@ def deletar(id):
         if not exam:
             return jsonify({"erro": "Exame não encontrado"}), 404
 
+        # Os arquivos das imagens e dos uploads em andamento saem junto com o exame (após o commit)
+        for sessao in db.query(UploadSession).filter_by(exam_id=exam.id).all():
+            blobs.remover_apos_commit(db, caminho_parcial(sessao.id))
+            db.delete(sessao)
+        db.flush()
+        for imagem in list(exam.images):
+            blobs.remover_imagem(db, imagem, exam.company_id)
+        consumo.remover_exame(db, exam.id)
+        db.flush()
+        db.expire(exam, ['images'])  # Já apagadas: a cascata não deve repetir o DELETE
         db.delete(exam)
         db.commit()
 
@@ -126,6 +142,17 @@ def deletar(id):
         current_app.logger.error(f"Erro ao excluir exame: {str(e)}")
         return jsonify({"erro": "Erro ao excluir exame"}), 500
 
+@exam_bp.route('/exames/armazenamento/<id>', methods=['GET'])
+def armazenamento_do_exame(id):
+    try:
+        db = get_db()
+        if not db.query(Exam.id).filter(Exam.id == id).first():
+            return jsonify({"erro": "Exame não encontrado"}), 404
+        return jsonify({"armazenamento": consumo.uso_do_exame(db, id)}), 200
+    except Exception as e:
+        current_app.logger.error(f"Erro ao obter armazenamento do exame: {str(e)}")
+        return jsonify({"erro": "Erro ao obter armazenamento do exame"}), 500
+
 @exam_bp.route('/exames/listar', defaults={'page': 1, 'limit': 10}, methods=['GET'])
 @exam_bp.route('/exames/listar/<int:page>/<int:limit>', methods=['GET'])
 def listar(page, limit):
@@ -608,91 +635,29 @@ def notificar_exame_pronto(id):
             return jsonify({"erro": "Este exame não possui imagem carregada"}), 400
             
         # 4. Localizar imagens relacionadas ao exame
-        imagens = []
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        for filename in os.listdir(upload_folder):
-            if filename.startswith(f"{exame.id}"):
-                imagens.append(filename)
+        imagens = imagens_por_exame(db, [exame.id]).get(exame.id, [])
                 
         if not imagens:
             return jsonify({"erro": "Nenhuma imagem encontrada para este exame"}), 404
             
-        # 5. Renomear as imagens com um formato mais amigável
-        data_formatada = exame.exam_date.strftime("%d-%m-%Y") if exame.exam_date else datetime.now().strftime("%d-%m-%Y")
-        arquivos_renomeados = []
-        for i, imagem in enumerate(imagens):
-            extensao = os.path.splitext(imagem)[1]
-            novo_nome = f"{usuario.name.replace(' ', '_')}_{empresa.name.replace(' ', '_')}_{data_formatada}_{i+1}{extensao}"
-            novo_nome = secure_filename(novo_nome)
-            caminho_antigo = os.path.join(upload_folder, imagem)
-            caminho_novo = os.path.join(upload_folder, novo_nome)
-            # Criar uma cópia para manter o arquivo original
-            shutil.copy2(caminho_antigo, caminho_novo)
-            arquivos_renomeados.append(novo_nome)
-            
-        # 6. Preparar e enviar e-mail para o usuário
-        assunto_usuario = f"Seu exame está pronto - {data_formatada}"
-        corpo_usuario = f"""
-        <html>
-            <body>
-                <h2>Olá, {usuario.name}!</h2>
-                <p>Seu exame realizado na empresa <b>{empresa.name}</b> em <b>{data_formatada}</b> está pronto.</p>
-                <p>Descrição do exame: <b>{exame.description}</b></p>
-                <p>Entre em contato com a empresa para mais informações ou para buscar o resultado completo.</p>
-                <p>Obrigado!</p>
-            </body>
-        </html>
-        """
-        
-        # 7. Preparar e enviar e-mail para a empresa
-        assunto_empresa = f"Exame de {usuario.name} está pronto - {data_formatada}"
-        corpo_empresa = f"""
-        <html>
-            <body>
-                <h2>Olá, {empresa.name}!</h2>
-                <p>O exame do funcionário <b>{usuario.name}</b> realizado em <b>{data_formatada}</b> está pronto.</p>
-                <p>Descrição do exame: <b>{exame.description}</b></p>
-                <p>As imagens foram processadas e estão disponíveis no sistema.</p>
-                <p>Entre em contato com o funcionário para informá-lo sobre o resultado.</p>
-            </body>
-        </html>
-        """
-        
-        try:
-            # Enviar e-mail para o usuário
-            msg_usuario = Message(
-                assunto_usuario,
-                recipients=[usuario.email],
-                html=corpo_usuario,
-                sender=current_app.config['MAIL_USERNAME']
-            )
-            for nome_arquivo in arquivos_renomeados:
-                with open(os.path.join(upload_folder, nome_arquivo), 'rb') as arquivo:
-                    msg_usuario.attach(nome_arquivo, 'image/jpeg', arquivo.read())
-            mail.send(msg_usuario)
-            
-            # Enviar e-mail para a empresa
-            msg_empresa = Message(
-                assunto_empresa,
-                recipients=[empresa.email],
-                html=corpo_empresa,
-                sender=current_app.config['MAIL_USERNAME']
-            )
-            for nome_arquivo in arquivos_renomeados:
-                with open(os.path.join(upload_folder, nome_arquivo), 'rb') as arquivo:
-                    msg_empresa.attach(nome_arquivo, 'image/jpeg', arquivo.read())
-            mail.send(msg_empresa)
+        # 5. Anexos com nome amigável, sem copiar os arquivos originais
+        data_formatada = formatar_data(exame)
+        anexos = preparar_anexos(exame, usuario, empresa, imagens)
+        arquivos_renomeados = [anexo["filename"] for anexo in anexos]
             
-        except Exception as e:
-            current_app.logger.error(f"Erro ao enviar e-mails: {str(e)}")
-            return jsonify({"erro": f"Erro ao enviar e-mails: {str(e)}"}), 500
+        # 6. e 7. E-mails para o usuário e para a empresa, enviados em segundo plano
+        assunto_usuario, corpo_usuario = email_trabalhador(exame, usuario, empresa, data_formatada)
+        assunto_empresa, corpo_empresa = email_empresa(exame, usuario, empresa, data_formatada)
+        enfileirar_email(db, assunto_usuario, [usuario.email], corpo_usuario, anexos=anexos, commit=False)
+        enfileirar_email(db, assunto_empresa, [empresa.email], corpo_empresa, anexos=anexos, commit=False)
         
         # 8. Atualizar o status do exame (opcional)
         exame.updated_at = datetime.now()
         db.commit()
+        notificar_worker()
         
         return jsonify({
-            "mensagem": "Notificações enviadas com sucesso",
+            "mensagem": "Notificações enfileiradas para envio",
             "emails_enviados": [usuario.email, empresa.email],
             "arquivos": arquivos_renomeados
         }), 200
@@ -702,6 +667,50 @@ def notificar_exame_pronto(id):
             db.rollback()
         current_app.logger.error(f"Erro ao processar notificação de exame: {str(e)}")
         return jsonify({"erro": f"Erro ao processar notificação de exame: {str(e)}"}), 500
+
+# Rota para notificar vários exames prontos de uma vez, em segundo plano
+@exam_bp.route('/exames/notificar_em_lote', methods=['POST'])
+def notificar_em_lote():
+    """
+    Recebe uma lista de exam_ids ou company_id com data_inicial e data_final.
+    Envia um e-mail por trabalhador e um único resumo por empresa.
+    """
+    try:
+        db = get_db()
+        data = request.get_json()
+        if not data:
+            return jsonify({"erro": "Nenhum dado de entrada fornecido"}), 400
+
+        exam_ids = data.get('exam_ids')
+        if exam_ids is not None:
+            if not isinstance(exam_ids, list) or len(exam_ids) == 0:
+                return jsonify({"erro": "exam_ids deve ser uma lista não vazia"}), 400
+            parametros = {"exam_ids": exam_ids}
+        else:
+            if not data.get('company_id') or not data.get('data_inicial') or not data.get('data_final'):
+                return jsonify({"erro": "Informe exam_ids ou company_id, data_inicial e data_final"}), 400
+            try:
+                datetime.strptime(data['data_inicial'], '%Y-%m-%d')
+                datetime.strptime(data['data_final'], '%Y-%m-%d')
+            except ValueError:
+                return jsonify({"erro": "Formato de data inválido. Use YYYY-MM-DD."}), 400
+            parametros = {
+                "company_id": data['company_id'],
+                "data_inicial": data['data_inicial'],
+                "data_final": data['data_final']
+            }
+
+        job_id = iniciar_job(db, 'notificar_exames', notificar_exames_em_lote, **parametros)
+
+        return jsonify({
+            "mensagem": "Notificações em processamento",
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}"
+        }), 202
+
+    except Exception as e:
+        current_app.logger.error(f"Erro ao iniciar notificação em lote: {str(e)}")
+        return jsonify({"erro": "Erro ao iniciar notificação em lote"}), 500
     
 # Rota para listar exames entregues por empresa
 @exam_bp.route('/exames/entregues_por_empresa/<company_id>', methods=['GET'])
@@ -758,31 +767,130 @@ def download_imagens_exame(exam_id):
             return jsonify({"erro": "Nenhuma imagem carregada para este exame"}), 400
 
         # Localizar imagens relacionadas ao exame
-        upload_folder = current_app.config['UPLOAD_FOLDER']
-        imagens = [
-            filename for filename in os.listdir(upload_folder)
-            if filename.startswith(f"{exam.id}")
-        ]
+        imagens = imagens_do_exame(db, exam.id)
 
         if not imagens:
             return jsonify({"erro": "Nenhuma imagem encontrada para este exame"}), 404
 
-        # Compactar as imagens em um arquivo ZIP
-        zip_filename = f"exame_{exam.id}_imagens.zip"
-        zip_path = os.path.join(upload_folder, zip_filename)
-
-        with shutil.ZipFile(zip_path, 'w') as zipf:
-            for imagem in imagens:
-                zipf.write(os.path.join(upload_folder, imagem), arcname=imagem)
-
-        # Enviar o arquivo ZIP para download
-        return send_from_directory(upload_folder, zip_filename, as_attachment=True)
+        arquivos = []
+        for imagem in imagens:
+            caminho = armazenamento.origem(imagem.path, imagem.size)
+            if caminho is None:
+                current_app.logger.warning(f"Arquivo da imagem {imagem.name} não encontrado")
+                continue
+            arquivos.append((caminho, imagem.name, imagem.mime_type))
+
+        # O ZIP é gerado enquanto é enviado: sem arquivo temporário na pasta de upload
+        return Response(
+            gerar_zip(arquivos),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="exame_{exam.id}_imagens.zip"'}
+        )
 
     except Exception as e:
         current_app.logger.error(f"Erro ao fazer download das imagens do exame: {str(e)}")
         return jsonify({"erro": "Erro ao fazer download das imagens do exame"}), 500
 
 
+def _periodo_exportacao(dados):
+    data_inicial, data_final = dados.get('data_inicial'), dados.get('data_final')
+    if not data_inicial or not data_final:
+        return None
+    try:
+        datetime.strptime(data_inicial, '%Y-%m-%d')
+        datetime.strptime(data_final, '%Y-%m-%d')
+    except ValueError:
+        return None
+    return data_inicial, data_final
+
+
+# Rota para baixar de uma vez todos os exames entregues de uma empresa no período
+@exam_bp.route('/exames/exportar/<company_id>', methods=['GET'])
+def exportar_exames_empresa(company_id):
+    """
+    Transmite um ZIP com as imagens organizadas por trabalhador e data, mais um manifesto CSV.
+    Se o mesmo conjunto de imagens já foi exportado, envia o arquivo do cache.
+    """
+    try:
+        periodo = _periodo_exportacao(request.args)
+        if not periodo:
+            return jsonify({"erro": "data_inicial e data_final (AAAA-MM-DD) são obrigatórias"}), 400
+
+        db = get_db()
+        linhas, manifesto, chave = exportacao.preparar(db, company_id, *periodo)
+        if not linhas:
+            return jsonify({"erro": "Nenhum exame entregue no período"}), 404
+
+        nome = f"exames_{company_id}_{periodo[0]}_{periodo[1]}.zip"
+        em_cache = exportacao.caminho_em_cache(chave)
+        existe = os.path.exists(em_cache)
+        metricas.contar_cache('exportacao', existe)
+        if existe:
+            return armazenamento.enviar_arquivo(em_cache, as_attachment=True, download_name=nome, etag=chave)
+
+        return Response(
+            stream_with_context(gerar_zip(exportacao.entradas(linhas, manifesto))),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="{nome}"'}
+        )
+
+    except Exception as e:
+        current_app.logger.error(f"Erro ao exportar exames da empresa: {str(e)}")
+        return jsonify({"erro": "Erro ao exportar exames da empresa"}), 500
+
+
+# Rota para preparar a exportação em segundo plano (conjuntos grandes)
+@exam_bp.route('/exames/exportacoes', methods=['POST'])
+def criar_exportacao():
+    """
+    Recebe company_id, data_inicial e data_final. Se o conjunto já está em cache devolve o link;
+    conjuntos pequenos podem ser transmitidos na hora; os demais viram uma tarefa em segundo plano.
+    """
+    try:
+        data = request.get_json() or {}
+        company_id = data.get('company_id')
+        periodo = _periodo_exportacao(data)
+        if not company_id or not periodo:
+            return jsonify({"erro": "company_id, data_inicial e data_final (AAAA-MM-DD) são obrigatórios"}), 400
+
+        db = get_db()
+        linhas, _, chave = exportacao.preparar(db, company_id, *periodo)
+        if not linhas:
+            return jsonify({"erro": "Nenhum exame entregue no período"}), 404
+
+        em_cache = os.path.exists(exportacao.caminho_em_cache(chave))
+        metricas.contar_cache('exportacao', em_cache)
+        if em_cache:
+            return jsonify({"chave": chave, "download_url": exportacao.url_download(chave)}), 200
+        if len(linhas) <= current_app.config['EXPORT_STREAM_MAX_IMAGES']:
+            return jsonify({"download_url": exportacao.url_fluxo(company_id, *periodo)}), 200
+
+        job_id = iniciar_job(db, 'exportacao_exames', exportacao.exportar_para_cache,
+                             company_id=company_id, data_inicial=periodo[0], data_final=periodo[1])
+        return jsonify({
+            "mensagem": "Exportação iniciada",
+            "job_id": job_id,
+            "status_url": f"/api/jobs/{job_id}"
+        }), 202
+
+    except Exception as e:
+        current_app.logger.error(f"Erro ao criar exportação: {str(e)}")
+        return jsonify({"erro": "Erro ao criar exportação"}), 500
+
+
+# Rota para baixar uma exportação pronta
+@exam_bp.route('/exames/exportacoes/<chave>', methods=['GET'])
+def baixar_exportacao(chave):
+    if len(chave) != 64 or not all(c in '0123456789abcdef' for c in chave):
+        return jsonify({"erro": "Exportação não encontrada"}), 404
+    caminho = exportacao.caminho_em_cache(chave)
+    if not os.path.exists(caminho):
+        return jsonify({"erro": "Exportação não encontrada"}), 404
+    # O nome é o hash do conteúdo: a resposta nunca muda
+    return armazenamento.enviar_arquivo(caminho, as_attachment=True, download_name=f"exportacao_{chave[:12]}.zip",
+                                        etag=chave, max_age=24 * 3600)
+
+
 # Rota para estatísticas de exames por empresa
 @exam_bp.route('/exames/estatisticas_por_empresa/<company_id>', methods=['GET'])
 def estatisticas_exames_por_empresa(company_id):
@@ -10,9 +10,19 @@ def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}  # Adicionado 'pdf'
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 import os
+import time
 from flask import Blueprint, request, jsonify, current_app
 from werkzeug.utils import secure_filename
 from app.models.exam import Exam  # Importe o modelo Exam
+from itsdangerous import BadSignature, SignatureExpired
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+from app.assinatura import gerar_url_arquivo, verificar_url_arquivo
+from app.imagens import imagens_do_exame, registrar_imagem, tipo_mime
+from app import armazenamento, blobs, consumo, derivados, metricas, otimizacao
+from app.models.exam_image import ExamImage
+from app.armazenamento import ArquivoMuitoGrande
+from app.uploads import ErroUpload, cancelar_sessao, criar_sessao, finalizar_sessao, gravar_bloco, obter_sessao
 
 image_bp = Blueprint('image', __name__)
 
@@ -25,6 +35,8 @@ def allowed_file(filename):
 def upload_images():
     
     db = get_db()
+    recebidos = []
+    novos = []
     
     try:
         if 'imagens' not in request.files:
@@ -40,50 +52,304 @@ def upload_images():
         if len(files) != len(image_names):
             return jsonify({'erro': 'Número de arquivos e nomes de imagens não correspondem'}), 400
 
-        uploaded_files = []
-        for file, image_name in zip(files, image_names):
-            if file and allowed_file(file.filename):
-                filename = secure_filename(image_name + '.' + file.filename.rsplit('.', 1)[1].lower())
-                file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-                uploaded_files.append(filename)
-            else:
-                return jsonify({'erro': f'Tipo de arquivo não permitido: {file.filename}'}), 400
-        
-        # Atualizar o status image_uploaded do exame
+        # Validar o exame e os tipos antes de gravar qualquer arquivo
         exam = db.query(Exam).get(exam_id)
-        print(exam)
-        if exam:
-            exam.image_uploaded = True
-            db.commit()
-        else:
+        if not exam:
             return jsonify({'erro': 'Exame não encontrado'}), 404
 
-        return jsonify({'mensagem': 'Arquivos enviados com sucesso', 'filenames': uploaded_files}), 200
+        for file in files:
+            if not file or not allowed_file(file.filename):
+                return jsonify({'erro': f'Tipo de arquivo não permitido: {file.filename}'}), 400
+
+        # Cota da empresa conferida pelo tamanho declarado da requisição, antes de gravar qualquer byte
+        declarado = request.content_length
+        aviso_cota = consumo.verificar_cota(db, exam.company_id, declarado or 0)
 
+        # Cada parte é copiada em blocos para um temporário, com o checksum calculado na escrita
+        limite = current_app.config['UPLOAD_MAX_FILE_BYTES']
+        uploaded_files = []
+        for file, image_name in zip(files, image_names):
+            filename = secure_filename(image_name + '.' + file.filename.rsplit('.', 1)[1].lower())
+            recebido = armazenamento.receber(file, limite)
+            recebidos.append(recebido)
+            uploaded_files.append((filename, file.mimetype, recebido))
+            if declarado is None:
+                # Envio chunked, sem Content-Length: a cota vale para o total já recebido, parte a parte
+                aviso_cota = consumo.verificar_cota(db, exam.company_id, sum(r.tamanho for r in recebidos))
+
+        # Só depois de todas as partes recebidas o conteúdo vai para o armazenamento por hash;
+        # conteúdo repetido só ganha mais uma referência, sem ocupar disco
+        imagens = []
+        for filename, mimetype, recebido in uploaded_files:
+            blob, criado = blobs.armazenar(db, recebido)
+            if criado:
+                novos.append(blob.path)
+            imagens.append(registrar_imagem(db, exam.id, filename, blob, mime_type=tipo_mime(filename, mimetype),
+                                            respeitar_cota=True))
+        exam.image_uploaded = True
+        db.commit()
+        metricas.contar('upload_bytes_total', sum(recebido.tamanho for recebido in recebidos), via='multipart')
+        job_id = otimizacao.apos_upload(db, imagens)
+
+        resposta = {'mensagem': 'Arquivos enviados com sucesso', 'filenames': [f[0] for f in uploaded_files]}
+        if job_id:
+            resposta['otimizacao_job_id'] = job_id  # Acompanhado em /api/jobs/<id>
+        if aviso_cota:
+            resposta['aviso_cota'] = aviso_cota
+        return jsonify(resposta), 200
+
+    except consumo.CotaExcedida as e:
+        db.rollback()
+        for relativo in novos:
+            armazenamento.remover(relativo)  # Blobs gravados antes do UPDATE condicional recusar o envio
+        return jsonify({'erro': e.mensagem, **e.dados}), 507
+    except (ArquivoMuitoGrande, RequestEntityTooLarge) as e:
+        db.rollback()
+        nome = f': {e}' if isinstance(e, ArquivoMuitoGrande) else ''
+        return jsonify({'erro': f'Arquivo excede o tamanho máximo permitido{nome}'}), 413
     except Exception as e:
+        db.rollback()
+        for relativo in novos:
+            armazenamento.remover(relativo)
         current_app.logger.error(f"Erro ao fazer upload das imagens: {str(e)}")
         return jsonify({'erro': 'Erro ao fazer upload das imagens'}), 500
+    finally:
+        armazenamento.descartar(recebidos)
+# Upload retomável: cria a sessão, envia blocos numerados, consulta o offset e finaliza
+@image_bp.route('/images/uploads', methods=['POST'])
+def criar_upload():
+    db = get_db()
+    try:
+        data = request.get_json() or {}
+        exam_id = data.get('exam_id')
+        image_name = data.get('image_name')
+        original = data.get('filename', '')
+
+        if not exam_id or not image_name or not data.get('size'):
+            return jsonify({'erro': 'exam_id, image_name, filename e size são obrigatórios'}), 400
+        try:
+            tamanho = int(data['size'])
+        except (TypeError, ValueError):
+            tamanho = 0
+        if tamanho <= 0:
+            return jsonify({'erro': 'Tamanho do arquivo inválido'}), 400
+        if not allowed_file(original):
+            return jsonify({'erro': f'Tipo de arquivo não permitido: {original}'}), 400
+        exam = db.query(Exam).get(exam_id)
+        if not exam:
+            return jsonify({'erro': 'Exame não encontrado'}), 404
+        aviso_cota = consumo.verificar_cota(db, exam.company_id, tamanho)
+
+        filename = secure_filename(image_name + '.' + original.rsplit('.', 1)[1].lower())
+        sessao = criar_sessao(db, exam_id, filename, tamanho,
+                              tipo_mime(filename, data.get('mime_type', 'application/octet-stream')))
+        resposta = {'upload': sessao.to_dict(), 'upload_url': f"/api/images/uploads/{sessao.id}"}
+        if aviso_cota:
+            resposta['aviso_cota'] = aviso_cota
+        return jsonify(resposta), 201
+
+    except ErroUpload as e:
+        db.rollback()
+        return jsonify({'erro': e.mensagem, **e.dados}), e.status
+    except consumo.CotaExcedida as e:
+        db.rollback()
+        return jsonify({'erro': e.mensagem, **e.dados}), 507
+    except Exception as e:
+        db.rollback()
+        current_app.logger.error(f"Erro ao criar upload: {str(e)}")
+        return jsonify({'erro': 'Erro ao criar upload'}), 500
+
+
+@image_bp.route('/images/uploads/<upload_id>', methods=['GET'])
+def consultar_upload(upload_id):
+    db = get_db()
+    try:
+        return jsonify({'upload': obter_sessao(db, upload_id).to_dict()}), 200
+    except ErroUpload as e:
+        return jsonify({'erro': e.mensagem, **e.dados}), e.status
+
+
+@image_bp.route('/images/uploads/<upload_id>/chunks/<int:numero>', methods=['PUT'])
+def enviar_bloco(upload_id, numero):
+    db = get_db()
+    try:
+        sessao = obter_sessao(db, upload_id)
+        sessao = gravar_bloco(db, sessao, numero, request.stream, request.headers.get('X-Chunk-Checksum'))
+        metricas.contar('upload_bytes_total', request.content_length or 0, via='retomavel')
+        return jsonify({'upload': sessao.to_dict()}), 200
+    except ErroUpload as e:
+        db.rollback()
+        return jsonify({'erro': e.mensagem, **e.dados}), e.status
+    except RequestEntityTooLarge:
+        return jsonify({'erro': 'Bloco excede o tamanho máximo permitido'}), 413
+    except Exception as e:
+        db.rollback()
+        current_app.logger.error(f"Erro ao gravar bloco {numero} do upload {upload_id}: {str(e)}")
+        return jsonify({'erro': 'Erro ao gravar bloco'}), 500
+
+
+@image_bp.route('/images/uploads/<upload_id>/finalize', methods=['POST'])
+def finalizar_upload(upload_id):
+    db = get_db()
+    try:
+        sessao = finalizar_sessao(db, obter_sessao(db, upload_id))
+        return jsonify({'mensagem': 'Arquivo enviado com sucesso', 'upload': sessao.to_dict()}), 200
+    except ErroUpload as e:
+        db.rollback()
+        return jsonify({'erro': e.mensagem, **e.dados}), e.status
+    except consumo.CotaExcedida as e:
+        db.rollback()
+        return jsonify({'erro': e.mensagem, **e.dados}), 507
+    except Exception as e:
+        db.rollback()
+        current_app.logger.error(f"Erro ao finalizar upload {upload_id}: {str(e)}")
+        return jsonify({'erro': 'Erro ao finalizar upload'}), 500
+
+
+@image_bp.route('/images/uploads/<upload_id>', methods=['DELETE'])
+def cancelar_upload(upload_id):
+    db = get_db()
+    try:
+        # Uma sessão expirada também pode ser cancelada: o arquivo parcial sai sem esperar a coleta
+        cancelar_sessao(db, obter_sessao(db, upload_id, aceitar_expirada=True))
+        return jsonify({'mensagem': 'Upload cancelado'}), 200
+    except ErroUpload as e:
+        return jsonify({'erro': e.mensagem, **e.dados}), e.status
+    except Exception as e:
+        db.rollback()
+        current_app.logger.error(f"Erro ao cancelar upload {upload_id}: {str(e)}")
+        return jsonify({'erro': 'Erro ao cancelar upload'}), 500
+
+# Lista as imagens do exame com os endereços das prévias, para não baixar os originais
+@image_bp.route('/images/exame/<exam_id>', methods=['GET'])
+def listar_imagens(exam_id):
+    db = get_db()
+    imagens = []
+    for imagem in imagens_do_exame(db, exam_id):
+        dados = imagem.to_dict()
+        # URLs assinadas: o navegador baixa direto, sem passar por esta API de novo
+        dados['url'] = armazenamento.url_assinada(imagem.path, imagem.mime_type, imagem.name)
+        if derivados.suporta_derivados(imagem.mime_type):
+            dados['previews'] = {
+                largura: {
+                    formato: gerar_url_arquivo(derivados.caminho_derivado(imagem.checksum, largura, formato),
+                                               derivados.FORMATOS[formato][2])
+                    for formato in derivados.FORMATOS
+                }
+                for largura in current_app.config['DERIVATIVE_WIDTHS']
+            }
+        imagens.append(dados)
+    return jsonify({'imagens': imagens}), 200
+
+
+@image_bp.route('/arquivos/<path:relativo>', methods=['GET'])
+def arquivo_assinado(relativo):
+    """
+    Serve o arquivo de uma URL gerada por gerar_url_arquivo. A assinatura e o prazo são
+    conferidos sem consultar o banco, e a resposta pode ficar em cache até a URL vencer.
+    """
+    try:
+        mime_type, nome, expira = verificar_url_arquivo(relativo, request.args)
+    except SignatureExpired:
+        return jsonify({'erro': 'Link expirado'}), 410
+    except BadSignature:
+        return jsonify({'erro': 'Link inválido'}), 403
+
+    if safe_join(current_app.config['UPLOAD_FOLDER'], relativo) is None:
+        return jsonify({'erro': 'Arquivo não encontrado'}), 404
+    caminho = armazenamento.localizar(relativo)
+    if caminho is None and relativo.startswith('derivados/'):
+        caminho = derivados.regenerar_por_caminho(relativo)
+    if caminho is None:
+        # Arquivo no bucket (link de e-mail, ou URL emitida antes dos blobs irem para o bucket)
+        return armazenamento.redirecionar(relativo, mime_type, nome, max(int(expira - time.time()), 1)) or \
+            (jsonify({'erro': 'Arquivo não encontrado'}), 404)
+
+    resposta = armazenamento.enviar_arquivo(caminho, mimetype=mime_type or None, download_name=nome or None,
+                                            max_age=max(int(expira - time.time()), 0))
+    resposta.cache_control.public = False
+    resposta.cache_control.private = True
+    resposta.cache_control.immutable = True
+    return resposta
+
+
+@image_bp.route('/images/<image_id>/arquivo', methods=['GET'])
+def obter_arquivo(image_id):
+    """
+    Arquivo original para exibição no navegador. Atende Range (206), então visualizadores
+    de PDF buscam só as páginas que precisam.
+    """
+    db = get_db()
+    imagem = db.query(ExamImage).get(image_id)
+    if not imagem:
+        return jsonify({'erro': 'Imagem não encontrada'}), 404
+    caminho = armazenamento.localizar(imagem.path)
+    if caminho is None:
+        # No driver remoto o bucket atende o Range direto
+        return armazenamento.redirecionar(imagem.path, imagem.mime_type, imagem.name) or \
+            (jsonify({'erro': 'Arquivo da imagem não encontrado'}), 404)
+
+    resposta = armazenamento.enviar_arquivo(caminho, mimetype=imagem.mime_type, download_name=imagem.name,
+                                            etag=imagem.checksum, max_age=3600)
+    resposta.cache_control.public = False
+    resposta.cache_control.private = True
+    return resposta
+
+
+@image_bp.route('/images/<image_id>/derivado', methods=['GET'])
+def obter_derivado(image_id):
+    """
+    Miniatura na menor largura configurada que atende `largura`, em WebP quando o navegador aceita.
+    O conteúdo é endereçado pelo hash, então pode ficar em cache indefinidamente.
+    """
+    db = get_db()
+    imagem = db.query(ExamImage).get(image_id)
+    if not imagem:
+        return jsonify({'erro': 'Imagem não encontrada'}), 404
+    if not derivados.suporta_derivados(imagem.mime_type):
+        return jsonify({'erro': 'Tipo de arquivo sem prévia'}), 415
+
+    larguras = current_app.config['DERIVATIVE_WIDTHS']
+    largura = derivados.escolher_largura(request.args.get('largura', min(larguras), type=int), larguras)
+    formato = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+
+    try:
+        caminho = derivados.obter_derivado(imagem, largura, formato)
+    except Exception as e:
+        current_app.logger.error(f"Erro ao gerar prévia da imagem {image_id}: {str(e)}")
+        return jsonify({'erro': 'Erro ao gerar prévia da imagem'}), 500
+    if caminho is None:
+        return jsonify({'erro': 'Arquivo da imagem não encontrado'}), 404
+
+    resposta = armazenamento.enviar_arquivo(caminho, mimetype=derivados.FORMATOS[formato][2], max_age=365 * 24 * 3600,
+                                            etag=f"{imagem.checksum}-{largura}-{formato}")
+    # Exames são dados pessoais: só o navegador guarda, caches compartilhados não
+    resposta.cache_control.public = False
+    resposta.cache_control.private = True
+    resposta.cache_control.immutable = True
+    resposta.vary.add('Accept')
+    return resposta
+
 @image_bp.route('images/delete_images/<id>', methods=['DELETE'])
 def delete_images(id):
+    db = get_db()
     try:
-        folder_path = current_app.config['UPLOAD_FOLDER']
         deleted_files = []
+        bytes_liberados = 0
 
-        for filename in os.listdir(folder_path):
-            if filename.startswith(id + '_'):
-                file_path = os.path.join(folder_path, filename)
-                try:
-                    os.remove(file_path)
-                    deleted_files.append(filename)
-                except Exception as e:
-                    current_app.logger.error(f"Erro ao deletar o arquivo {filename}: {str(e)}")
-                    return jsonify({'erro': f'Erro ao deletar o arquivo {filename}'}), 500
+        # Os arquivos só são apagados depois do commit, quando nenhuma outra imagem usa o conteúdo
+        for imagem in imagens_do_exame(db, id):
+            bytes_liberados += blobs.remover_imagem(db, imagem)
+            deleted_files.append(imagem.name)
+        db.commit()
 
         if deleted_files:
-            return jsonify({'mensagem': 'Arquivos deletados com sucesso', 'filenames': deleted_files}), 200
+            return jsonify({'mensagem': 'Arquivos deletados com sucesso', 'filenames': deleted_files,
+                            'bytes_liberados': bytes_liberados}), 200
         else:
             return jsonify({'mensagem': 'Nenhum arquivo encontrado para deletar com este ID'}), 404
 
     except Exception as e:
+        db.rollback()
         current_app.logger.error(f"Erro ao deletar as imagens: {str(e)}")
-        return jsonify({'erro': 'Erro ao deletar as imagens'}), 500
\ No newline at end of file
+        return jsonify({'erro': 'Erro ao deletar as imagens'}), 500
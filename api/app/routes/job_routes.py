@@ -0,0 +1,18 @@
+from flask import Blueprint, jsonify, current_app
+from app import get_db
+from app.models.job import BackgroundJob
+
+job_bp = Blueprint('job', __name__)
+
+# Rota para acompanhar o andamento de uma tarefa em segundo plano
+@job_bp.route('/jobs/<id>', methods=['GET'])
+def obter(id):
+    try:
+        db = get_db()
+        job = db.query(BackgroundJob).get(id)
+        if not job:
+            return jsonify({"erro": "Tarefa não encontrada"}), 404
+        return jsonify({"job": job.to_dict()}), 200
+    except Exception as e:
+        current_app.logger.error(f"Erro ao obter tarefa: {str(e)}")
+        return jsonify({"erro": "Erro ao obter tarefa"}), 500
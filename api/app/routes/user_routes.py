@@ -1,8 +1,8 @@
 from flask import Blueprint, request, jsonify, current_app
 import jwt
 from app.models.user import User, UserDTO
-from app import get_db, mail
-from flask_mail import Message
+from app import get_db
+from app.mail_queue import enfileirar_email
 from bcrypt import hashpw, gensalt
 import json
 from datetime import datetime, timedelta
@@ -20,8 +20,8 @@ user_bp = Blueprint('user', __name__)
 #                    if unicodedata.category(c) != 'Mn')
 
 def enviar_email(para, assunto, template):
-    msg = Message(assunto, recipients=[para], html=template, sender=current_app.config['MAIL_USERNAME'])
-    mail.send(msg)
+    # O envio acontece em segundo plano; aqui apenas gravamos na fila de saída
+    enfileirar_email(get_db(), assunto, [para], template)
 
 def enviar_email_verificacao(user_dto: UserDTO):
     token = user_dto.to_jwt()
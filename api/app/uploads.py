@@ -0,0 +1,223 @@
+# app/uploads.py
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from app import armazenamento
+from app import blobs, consumo, otimizacao
+from app.armazenamento import TAMANHO_BLOCO, ArquivoRecebido
+from app.imagens import calcular_checksum, registrar_imagem
+from app.models.blob import Blob
+from app.models.exam import Exam
+from app.models.upload_session import UploadChunk, UploadSession, UploadStatus
+
+
+class ErroUpload(Exception):
+    """Erro do protocolo de upload retomável, com o status HTTP a devolver."""
+
+    def __init__(self, mensagem, status=400, **dados):
+        super().__init__(mensagem)
+        self.mensagem = mensagem
+        self.status = status
+        self.dados = dados
+
+
+# SHA-256 do arquivo inteiro, atualizado conforme os blocos chegam em ordem.
+# Fica na memória do processo: se um bloco cair em outro processo o hash é refeito ao finalizar.
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def caminho_parcial(sessao_id):
+    return os.path.join(armazenamento.pasta_temporaria(), f"{sessao_id}.part")
+
+
+def _copiar(fluxo, esperado, destino=None, acumulado=None):
+    """Lê até `esperado` bytes em blocos fixos, gravando e calculando o hash do bloco."""
+    sha256 = hashlib.sha256()
+    tamanho = 0
+    for bloco in iter(lambda: fluxo.read(min(TAMANHO_BLOCO, esperado + 1 - tamanho)), b''):
+        tamanho += len(bloco)
+        if tamanho > esperado:
+            raise ErroUpload(f'Bloco maior que o esperado ({esperado} bytes)')
+        sha256.update(bloco)
+        if destino is not None:
+            destino.write(bloco)
+        if acumulado is not None:
+            acumulado.update(bloco)
+    if tamanho != esperado:
+        raise ErroUpload(f'Bloco incompleto: recebidos {tamanho} de {esperado} bytes')
+    return sha256.hexdigest()
+
+
+def criar_sessao(db, exam_id, nome, tamanho, mime_type):
+    if tamanho <= 0:
+        raise ErroUpload('Tamanho do arquivo inválido')
+    if tamanho > current_app.config['UPLOAD_MAX_FILE_BYTES']:
+        raise ErroUpload('Arquivo excede o tamanho máximo permitido', 413)
+
+    agora = datetime.now()
+    sessao = UploadSession(
+        exam_id=exam_id,
+        filename=nome,
+        mime_type=mime_type,
+        size=tamanho,
+        chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'],
+        received=0,
+        status=UploadStatus.OPEN,
+        created_at=agora,
+        updated_at=agora,
+        expires_at=agora + timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+    )
+    db.add(sessao)
+    db.commit()
+    # Arquivo único que recebe cada bloco na sua posição: nada a montar no final
+    open(caminho_parcial(sessao.id), 'wb').close()
+    return sessao
+
+
+def obter_sessao(db, sessao_id, aceitar_expirada=False):
+    """Sessão do upload; expirada só é devolvida com `aceitar_expirada` (para cancelá-la)."""
+    sessao = db.query(UploadSession).get(sessao_id)
+    if sessao is None:
+        raise ErroUpload('Upload não encontrado', 404)
+    if not aceitar_expirada and sessao.status == UploadStatus.OPEN and sessao.expires_at < datetime.now():
+        raise ErroUpload('Upload expirado', 410)
+    return sessao
+
+
+def gravar_bloco(db, sessao, numero, fluxo, checksum=None):
+    """
+    Grava o bloco `numero` na sua posição do arquivo parcial.
+    Os blocos chegam em ordem; reenviar um bloco já gravado é aceito se o conteúdo for o mesmo.
+    """
+    if sessao.status != UploadStatus.OPEN:
+        raise ErroUpload('Upload já finalizado', 409)
+    inicio = numero * sessao.chunk_size
+    if numero < 0 or inicio >= sessao.size:
+        raise ErroUpload('Número de bloco inválido')
+    esperado = min(sessao.chunk_size, sessao.size - inicio)
+
+    if numero < sessao.next_chunk:
+        # A resposta do envio anterior se perdeu: confere o conteúdo sem regravar
+        parte = db.query(UploadChunk).filter_by(session_id=sessao.id, number=numero).first()
+        if parte is not None and _copiar(fluxo, esperado) == parte.checksum:
+            return sessao
+        raise ErroUpload('Bloco difere do já recebido', 409, offset=sessao.received)
+    if numero > sessao.next_chunk:
+        raise ErroUpload(f'Bloco fora de ordem; próximo esperado: {sessao.next_chunk}', 409,
+                         offset=sessao.received)
+
+    with _hashes_lock:
+        acumulado = _hashes.pop(sessao.id, None)
+    if inicio == 0:
+        acumulado = (hashlib.sha256(), 0)
+    elif acumulado is not None and acumulado[1] != inicio:
+        acumulado = None
+
+    with open(caminho_parcial(sessao.id), 'r+b') as destino:
+        destino.seek(inicio)
+        resumo = _copiar(fluxo, esperado, destino, acumulado[0] if acumulado else None)
+    if checksum and checksum.lower() != resumo:
+        raise ErroUpload('Checksum do bloco não confere', 422, offset=sessao.received)
+
+    # Atualização condicional: dois envios simultâneos do mesmo bloco não avançam o offset duas vezes
+    atualizados = db.query(UploadSession)\
+        .filter(UploadSession.id == sessao.id, UploadSession.received == inicio)\
+        .update({"received": inicio + esperado, "updated_at": datetime.now()}, synchronize_session=False)
+    if not atualizados:
+        db.rollback()
+        raise ErroUpload('Bloco já recebido por outra requisição', 409)
+    db.add(UploadChunk(session_id=sessao.id, number=numero, size=esperado, checksum=resumo,
+                       created_at=datetime.now()))
+    db.commit()
+
+    if acumulado is not None:
+        with _hashes_lock:
+            _hashes[sessao.id] = (acumulado[0], inicio + esperado)
+    db.refresh(sessao)
+    return sessao
+
+
+def finalizar_sessao(db, sessao):
+    """Move o arquivo completo para o armazenamento e registra a imagem do exame."""
+    if sessao.status == UploadStatus.COMPLETED:
+        return sessao
+    if sessao.status == UploadStatus.FINALIZING:
+        raise ErroUpload('Upload já em finalização', 409)
+    if sessao.status == UploadStatus.FAILED:
+        raise ErroUpload('Falha ao finalizar o upload; envie o arquivo novamente', 409)
+    if sessao.received != sessao.size:
+        raise ErroUpload('Upload incompleto', 409, offset=sessao.received)
+    exam = db.query(Exam).get(sessao.exam_id)
+    if exam is None:
+        raise ErroUpload('Exame não encontrado', 404)
+    # Desde a criação da sessão outros envios podem ter sido concluídos: a cota é conferida de novo
+    consumo.verificar_cota(db, exam.company_id, sessao.size, exceto_sessao=sessao.id)
+
+    # Reserva a sessão: de duas finalizações simultâneas só uma registra a imagem
+    reservadas = db.query(UploadSession)\
+                   .filter(UploadSession.id == sessao.id, UploadSession.status == UploadStatus.OPEN)\
+                   .update({"status": UploadStatus.FINALIZING}, synchronize_session=False)
+    db.commit()
+    if not reservadas:
+        db.refresh(sessao)
+        if sessao.status == UploadStatus.COMPLETED:
+            return sessao
+        raise ErroUpload('Upload já em finalização', 409)
+
+    parcial = caminho_parcial(sessao.id)
+    checksum = None
+    try:
+        with _hashes_lock:
+            acumulado = _hashes.pop(sessao.id, None)
+        if acumulado is not None and acumulado[1] == sessao.size:
+            checksum = acumulado[0].hexdigest()
+        else:
+            checksum = calcular_checksum(parcial)
+
+        blob, _ = blobs.armazenar(db, ArquivoRecebido(parcial, sessao.size, checksum))
+        imagem = registrar_imagem(db, exam.id, sessao.filename, blob, mime_type=sessao.mime_type,
+                                  respeitar_cota=True)
+        exam.image_uploaded = True
+        sessao.status = UploadStatus.COMPLETED
+        sessao.image_id = imagem.id
+        db.commit()
+    except Exception:
+        db.rollback()
+        _recuperar_finalizacao(db, sessao, parcial, checksum)
+        raise
+    if os.path.exists(parcial):
+        os.remove(parcial)  # Conteúdo já existia como blob
+    otimizacao.apos_upload(db, [imagem])
+    return sessao
+
+
+def _recuperar_finalizacao(db, sessao, parcial, checksum):
+    """
+    Desfaz uma finalização que falhou. Se `blobs.armazenar` já tinha movido o parcial para o blob
+    (que saiu com o rollback), o arquivo volta para o parcial e a sessão reabre para nova tentativa;
+    sem como devolvê-lo (driver remoto) o blob órfão é apagado e a sessão fica como falha.
+    """
+    if checksum is not None and not os.path.exists(parcial) and db.query(Blob).get(checksum) is None:
+        relativo = blobs.caminho_blob(checksum)
+        absoluto = armazenamento.localizar(relativo)
+        if absoluto is not None:
+            os.replace(absoluto, parcial)
+        else:
+            armazenamento.remover(relativo)
+    sessao.status = UploadStatus.OPEN if os.path.exists(parcial) else UploadStatus.FAILED
+    db.commit()
+
+
+def cancelar_sessao(db, sessao):
+    with _hashes_lock:
+        _hashes.pop(sessao.id, None)
+    parcial = caminho_parcial(sessao.id)
+    if os.path.exists(parcial):
+        os.remove(parcial)
+    db.delete(sessao)
+    db.commit()
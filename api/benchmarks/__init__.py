@@ -0,0 +1,8 @@
+"""
+Benchmarks dos endpoints principais pelo test client do Flask, em bancos povoados pelo `flask seed`.
+
+    python -m benchmarks --escalas 10000 100000 1000000 --saida antes.json
+    python -m benchmarks.comparar antes.json depois.json
+
+O banco de benchmark é separado do configurado no .env (SQLite na pasta temporária, ou --url).
+"""
@@ -0,0 +1,9 @@
+import os
+
+# O pacote da aplicação cria os engines ao ser importado; o benchmark troca o banco depois
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('TEST_DATABASE_URL', 'sqlite://')
+
+from benchmarks.executar import main
+
+main()
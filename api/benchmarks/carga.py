@@ -0,0 +1,442 @@
+# benchmarks/carga.py
+"""
+Teste de carga com tráfego misto, de uma máquina só, sem dependências além da biblioteca padrão.
+
+    python -m benchmarks.carga --exames 100000 --processos 4 --usuarios 50 --duracao 60
+    python -m benchmarks.carga --alvo http://127.0.0.1:8000 --url postgresql://... --duracao 120
+
+Sem --alvo a aplicação é servida localmente como no Passenger: carregada uma vez e bifurcada em
+processos de uma thread que disputam o mesmo socket. Usuários virtuais (asyncio) seguem o modelo
+de tráfego, cada um com um perfil, ações sorteadas pelo peso e pausas exponenciais entre elas.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks.medicao import percentil
+
+# Perfis de uso: peso entre os usuários virtuais, pausa média (s) entre ações e ações com seus pesos
+MODELO = {
+    "painel": {"peso": 2, "pausa": 5.0, "acoes": {"dashboard": 1}},
+    "escritorio": {"peso": 3, "pausa": 2.0,
+                   "acoes": {"empresas": 3, "busca_empresas": 2, "listagem": 2, "criar_em_lote": 1}},
+    "trabalhador": {"peso": 4, "pausa": 3.0, "acoes": {"login": 1, "listagem_por_empresa": 1}},
+    "clinica": {"peso": 1, "pausa": 4.0, "acoes": {"upload": 2, "filtro_por_data": 1}},
+}
+
+
+class RespostaHTTP:
+    def __init__(self, status, cabecalhos, corpo):
+        self.status = status
+        self.cabecalhos = cabecalhos
+        self.corpo = corpo
+
+
+class ConexaoHTTP:
+    """Cliente HTTP/1.1 mínimo sobre asyncio: reaproveita a conexão quando o servidor mantém keep-alive."""
+
+    def __init__(self, host, porta, tempo_limite=30.0):
+        self.host = host
+        self.porta = porta
+        self.tempo_limite = tempo_limite
+        self.leitor = self.escritor = None
+
+    async def fechar(self):
+        if self.escritor is not None:
+            self.escritor.close()
+            try:
+                await self.escritor.wait_closed()
+            except OSError:
+                pass
+        self.leitor = self.escritor = None
+
+    async def _ler_corpo(self, cabecalhos):
+        if cabecalhos.get('transfer-encoding', '').lower() == 'chunked':
+            partes = []
+            while True:
+                tamanho = int((await self.leitor.readline()).split(b';')[0], 16)
+                if tamanho == 0:
+                    await self.leitor.readline()
+                    return b''.join(partes)
+                partes.append(await self.leitor.readexactly(tamanho))
+                await self.leitor.readline()
+        if 'content-length' in cabecalhos:
+            return await self.leitor.readexactly(int(cabecalhos['content-length']))
+        return await self.leitor.read()  # Até o servidor fechar a conexão
+
+    async def _enviar(self, metodo, caminho, corpo, cabecalhos):
+        if self.escritor is None:
+            self.leitor, self.escritor = await asyncio.open_connection(self.host, self.porta)
+        linhas = [f"{metodo} {caminho} HTTP/1.1", f"Host: {self.host}:{self.porta}",
+                  f"Content-Length: {len(corpo)}", "Connection: keep-alive"]
+        linhas += [f"{nome}: {valor}" for nome, valor in cabecalhos.items()]
+        self.escritor.write(('\r\n'.join(linhas) + '\r\n\r\n').encode('latin-1') + corpo)
+        await self.escritor.drain()
+
+        status = int((await self.leitor.readline()).split()[1])
+        recebidos = {}
+        while True:
+            linha = (await self.leitor.readline()).decode('latin-1').strip()
+            if not linha:
+                break
+            nome, _, valor = linha.partition(':')
+            recebidos[nome.strip().lower()] = valor.strip()
+        resposta = RespostaHTTP(status, recebidos, await self._ler_corpo(recebidos))
+        if recebidos.get('connection', '').lower() == 'close' or 'content-length' not in recebidos \
+                and recebidos.get('transfer-encoding', '').lower() != 'chunked':
+            await self.fechar()
+        return resposta
+
+    async def requisitar(self, metodo, caminho, corpo=b'', cabecalhos=None):
+        reaproveitada = self.escritor is not None
+        try:
+            return await asyncio.wait_for(self._enviar(metodo, caminho, corpo, cabecalhos or {}), self.tempo_limite)
+        except (ConnectionError, asyncio.IncompleteReadError, IndexError):
+            await self.fechar()
+            if not reaproveitada:
+                raise
+        # O servidor fechou a conexão ociosa: uma nova tentativa numa conexão nova
+        return await asyncio.wait_for(self._enviar(metodo, caminho, corpo, cabecalhos or {}), self.tempo_limite)
+
+
+def _json(dados):
+    return json.dumps(dados).encode(), {"Content-Type": "application/json"}
+
+
+def _multipart(campos, arquivos):
+    fronteira = uuid.uuid4().hex
+    partes = []
+    for nome, valor in campos:
+        partes.append(f'--{fronteira}\r\nContent-Disposition: form-data; name="{nome}"\r\n\r\n{valor}\r\n'.encode())
+    for nome, arquivo, conteudo, tipo in arquivos:
+        partes.append(f'--{fronteira}\r\nContent-Disposition: form-data; name="{nome}"; filename="{arquivo}"\r\n'
+                      f'Content-Type: {tipo}\r\n\r\n'.encode() + conteudo + b'\r\n')
+    partes.append(f'--{fronteira}--\r\n'.encode())
+    return b''.join(partes), {"Content-Type": f"multipart/form-data; boundary={fronteira}"}
+
+
+def _escolher(contexto, chave, rng):
+    return rng.choice(contexto[chave])
+
+
+# Cada ação devolve (método, caminho, corpo, cabeçalhos) a partir do contexto do banco
+def acao_dashboard(contexto, rng):
+    return "GET", "/api/dashboard/dados", b'', {}
+
+
+def acao_empresas(contexto, rng):
+    return "GET", f"/api/empresas/all/{rng.randint(1, 5)}/50", b'', {}
+
+
+def acao_busca_empresas(contexto, rng):
+    return "GET", f"/api/empresas/find_by_substring/{_escolher(contexto, 'buscas', rng)}/1/20", b'', {}
+
+
+def acao_listagem(contexto, rng):
+    return "GET", f"/api/exames/listar/{rng.randint(1, contexto['paginas'])}/50", b'', {}
+
+
+def acao_listagem_por_empresa(contexto, rng):
+    return "GET", f"/api/exames/listar_por_empresa/{contexto['maior_empresa']}/{rng.randint(1, 5)}/20", b'', {}
+
+
+def acao_filtro_por_data(contexto, rng):
+    fim = contexto["hoje"] - timedelta(days=30 * rng.randrange(6))
+    consulta = urlencode({"data_inicial": (fim - timedelta(days=30)).isoformat(), "data_final": fim.isoformat()})
+    return "GET", f"/api/exames/filtrar_por_data/{contexto['maior_empresa']}?{consulta}", b'', {}
+
+
+def acao_login(contexto, rng):
+    from app.povoamento import SENHA_PADRAO  # app só é importado depois das variáveis de ambiente
+    return ("POST", "/api/login") + _json({"email": _escolher(contexto, 'emails', rng), "password": SENHA_PADRAO})
+
+
+def acao_criar_em_lote(contexto, rng):
+    return ("POST", "/api/exames/criar_em_lote") + _json({
+        "company_id": contexto["maior_empresa"],
+        "users": rng.sample(contexto["trabalhadores"], min(20, len(contexto["trabalhadores"]))),
+        "description": "Exame periódico",
+        "exam_date": (contexto["hoje"] + timedelta(days=rng.randint(1, 30))).isoformat(),
+    })
+
+
+def acao_upload(contexto, rng):
+    exam_id = _escolher(contexto, 'pendentes', rng)
+    corpo, cabecalhos = _multipart([("exam_id", exam_id), ("image_names", f"{exam_id}_{rng.randrange(1000):03d}")],
+                                   [("imagens", "foto.jpg", _escolher(contexto, 'fotos', rng), "image/jpeg")])
+    return "POST", "/api/images/upload_images", corpo, cabecalhos
+
+
+ACOES = {nome[len('acao_'):]: funcao for nome, funcao in globals().items() if nome.startswith('acao_')}
+# Lista do contexto de onde cada ação sorteia valores: vazia, a ação sai do modelo
+REQUER = {"busca_empresas": "buscas", "login": "emails", "upload": "pendentes"}
+
+
+class Estatisticas:
+    def __init__(self):
+        self.latencias = {}
+        self.status = {}
+        self.erros = {}
+        self.inicio = time.monotonic()
+
+    def registrar(self, acao, latencia, status=None, erro=None):
+        self.latencias.setdefault(acao, []).append(latencia)
+        if erro is not None:
+            self.erros.setdefault(acao, {}).setdefault(erro, 0)
+            self.erros[acao][erro] += 1
+        else:
+            contagem = self.status.setdefault(acao, {})
+            contagem[str(status)] = contagem.get(str(status), 0) + 1
+
+    def falhas(self, acao):
+        # Erros de conexão e respostas 5xx (4xx de validação fazem parte do tráfego)
+        return sum(self.erros.get(acao, {}).values()) + \
+            sum(total for status, total in self.status.get(acao, {}).items() if status.startswith('5'))
+
+    def resumo(self, duracao):
+        acoes = {}
+        for acao, latencias in sorted(self.latencias.items()):
+            acoes[acao] = {
+                "requisicoes": len(latencias),
+                "por_segundo": round(len(latencias) / duracao, 2),
+                "p50_ms": round(percentil(latencias, 50), 2),
+                "p90_ms": round(percentil(latencias, 90), 2),
+                "p95_ms": round(percentil(latencias, 95), 2),
+                "p99_ms": round(percentil(latencias, 99), 2),
+                "max_ms": round(max(latencias), 2),
+                "taxa_de_erro": round(self.falhas(acao) / len(latencias), 4),
+                "status": self.status.get(acao, {}),
+                "erros": self.erros.get(acao, {}),
+            }
+        todas = [latencia for latencias in self.latencias.values() for latencia in latencias]
+        total = len(todas)
+        return {
+            "duracao_s": round(duracao, 1),
+            "requisicoes": total,
+            "por_segundo": round(total / duracao, 2) if duracao else 0,
+            "p50_ms": round(percentil(todas, 50), 2) if todas else None,
+            "p95_ms": round(percentil(todas, 95), 2) if todas else None,
+            "p99_ms": round(percentil(todas, 99), 2) if todas else None,
+            "taxa_de_erro": round(sum(self.falhas(acao) for acao in self.latencias) / total, 4) if total else 0,
+            "acoes": acoes,
+        }
+
+
+async def usuario_virtual(numero, alvo, modelo, contexto, estatisticas, fim, semente, atraso):
+    rng = random.Random(f"{semente}:{numero}")
+    perfis = list(modelo)
+    perfil = modelo[rng.choices(perfis, [modelo[p]["peso"] for p in perfis])[0]]
+    acoes = [acao for acao in perfil["acoes"] if acao not in REQUER or contexto[REQUER[acao]]]
+    if not acoes:
+        return
+    pesos = [perfil["acoes"][a] for a in acoes]
+    conexao = ConexaoHTTP(alvo.hostname, alvo.port or 80)
+    await asyncio.sleep(atraso)  # Rampa de subida: os usuários entram aos poucos
+    try:
+        while time.monotonic() < fim:
+            acao = rng.choices(acoes, pesos)[0]
+            metodo, caminho, corpo, cabecalhos = ACOES[acao](contexto, rng)
+            inicio = time.perf_counter()
+            try:
+                resposta = await conexao.requisitar(metodo, caminho, corpo, cabecalhos)
+                estatisticas.registrar(acao, (time.perf_counter() - inicio) * 1000, status=resposta.status)
+            except Exception as e:
+                await conexao.fechar()
+                estatisticas.registrar(acao, (time.perf_counter() - inicio) * 1000, erro=type(e).__name__)
+            await asyncio.sleep(min(rng.expovariate(1 / perfil["pausa"]), max(fim - time.monotonic(), 0)))
+    finally:
+        await conexao.fechar()
+
+
+async def _relatar(estatisticas, fim, intervalo, log):
+    anterior, momento = 0, time.monotonic()
+    while time.monotonic() < fim:
+        await asyncio.sleep(min(intervalo, max(fim - time.monotonic(), 0.01)))
+        total = sum(len(latencias) for latencias in estatisticas.latencias.values())
+        falhas = sum(estatisticas.falhas(acao) for acao in estatisticas.latencias)
+        agora = time.monotonic()
+        log(f"{agora - estatisticas.inicio:6.0f}s  {(total - anterior) / (agora - momento):8.1f} req/s  "
+            f"{total:8} requisições  {falhas} falhas")
+        anterior, momento = total, agora
+
+
+async def gerar_carga(alvo, contexto, usuarios, duracao, modelo=MODELO, rampa=10.0, semente=42,
+                      intervalo=10.0, log=print):
+    """Executa os usuários virtuais contra `alvo` (URL base) e devolve o resumo."""
+    alvo = urlsplit(alvo)
+    estatisticas = Estatisticas()
+    fim = time.monotonic() + rampa + duracao
+    tarefas = [usuario_virtual(i, alvo, modelo, contexto, estatisticas, fim, semente, rampa * i / max(usuarios, 1))
+               for i in range(usuarios)]
+    await asyncio.gather(_relatar(estatisticas, fim, intervalo, log), *tarefas)
+    return estatisticas.resumo(time.monotonic() - estatisticas.inicio)
+
+
+def iniciar_servidor(app, engine, processos, host='127.0.0.1', porta=0):
+    """
+    Servidor pre-fork como o do Passenger: a aplicação já carregada é bifurcada em `processos`
+    processos de uma thread, todos aceitando conexões no mesmo socket. Retorna (porta, pids).
+    """
+    from werkzeug.serving import make_server
+
+    ouvinte = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    ouvinte.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ouvinte.bind((host, porta))
+    ouvinte.listen(128)
+    porta = ouvinte.getsockname()[1]
+    engine.dispose()  # Nenhuma conexão aberta é herdada pelos filhos
+
+    pids = []
+    for _ in range(processos):
+        pid = os.fork()
+        if pid == 0:
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+            # Grupo próprio: o encerramento alcança também os pools de processos que o worker criar
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                make_server(host, porta, app, fd=ouvinte.fileno()).serve_forever()
+            finally:
+                os._exit(0)
+        os.setpgid(pid, pid)  # Também no pai, para não depender de quem roda primeiro
+        pids.append(pid)
+    ouvinte.close()
+    return porta, pids
+
+
+def encerrar_servidor(pids):
+    for pid in pids:
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def _aguardar_porta(host, porta, limite=10.0):
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        try:
+            socket.create_connection((host, porta), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Servidor não respondeu em {host}:{porta}")
+
+
+def executar_carga(url, exames, usuarios, duracao, processos=4, alvo=None, modelo=MODELO, rampa=10.0,
+                   semente=42, repovoar=False, intervalo=10.0, log=print):
+    """
+    Prepara o banco, sobe o servidor local (sem `alvo`) e aplica a carga. Com `alvo` o banco é o
+    do servidor: só é lido para sortear os ids, e falta de volume é erro (nunca repovoa).
+    """
+    import app as pacote
+    from app import create_app
+    from benchmarks.cenarios import montar_contexto
+    from benchmarks.executar import _abrir_banco_existente, _preparar_banco, _sessoes
+
+    if alvo is not None and repovoar:
+        raise ValueError("repovoar não pode ser usado com um alvo: o banco é o do servidor")
+    vinculos_originais = [sessao.session_factory.kw.get('bind') for sessao in _sessoes()]
+    pasta = tempfile.mkdtemp(prefix='carga-uploads-')
+    pids = []
+    try:
+        if alvo is None:
+            engine, _ = _preparar_banco(url.format(exames=exames), exames, semente, repovoar, log)
+        else:
+            engine = _abrir_banco_existente(url.format(exames=exames), exames, log)
+        db = pacote.Session()
+        contexto = montar_contexto(db, semente)
+        db.close()
+        pacote.Session.remove()
+
+        if alvo is None:
+            app = create_app()
+            app.config.update(UPLOAD_FOLDER=pasta, MAIL_QUEUE_WORKER='external',
+                              SECRET_KEY=app.config['SECRET_KEY'] or 'carga')
+            porta, pids = iniciar_servidor(app, engine, processos)
+            _aguardar_porta('127.0.0.1', porta)
+            alvo = f"http://127.0.0.1:{porta}"
+        log(f"Carga em {alvo}: {usuarios} usuários por {duracao}s (rampa de {rampa}s)")
+        resumo = asyncio.run(gerar_carga(alvo, contexto, usuarios, duracao, modelo, rampa, semente, intervalo, log))
+    finally:
+        encerrar_servidor(pids)
+        shutil.rmtree(pasta, ignore_errors=True)
+        for sessao, vinculo in zip(_sessoes(), vinculos_originais):
+            sessao.remove()
+            sessao.configure(bind=vinculo)
+    resumo.update({"alvo": alvo, "usuarios": usuarios, "processos": processos if pids else None,
+                   "exames": exames, "modelo": modelo})
+    return resumo
+
+
+def main(argv=None):
+    from benchmarks.executar import _commit
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.carga',
+                                     description='Carga mista concorrente: vazão, latência e taxa de erro.')
+    parser.add_argument('--alvo', help='URL base de um servidor já em execução (padrão: sobe um local).')
+    parser.add_argument('--url', default=None,
+                        help="Banco usado pelo servidor local e para sortear ids (com --alvo, só lido).")
+    parser.add_argument('--exames', type=int, default=100000)
+    parser.add_argument('--processos', type=int, default=4, help='Processos do servidor local.')
+    parser.add_argument('--usuarios', type=int, default=50, help='Usuários virtuais simultâneos.')
+    parser.add_argument('--duracao', type=float, default=60.0, help='Segundos de carga depois da rampa.')
+    parser.add_argument('--rampa', type=float, default=10.0)
+    parser.add_argument('--modelo', help='JSON com o modelo de tráfego (mesmo formato de MODELO).')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--repovoar', action='store_true')
+    parser.add_argument('--saida', help='Arquivo JSON do resultado.')
+    argumentos = parser.parse_args(argv)
+
+    modelo = MODELO
+    if argumentos.modelo:
+        with open(argumentos.modelo) as arquivo:
+            modelo = json.load(arquivo)
+    desconhecidas = {acao for perfil in modelo.values() for acao in perfil["acoes"]} - set(ACOES)
+    if desconhecidas:
+        parser.error(f"Ações desconhecidas no modelo: {', '.join(sorted(desconhecidas))}")
+
+    if argumentos.alvo and not argumentos.url:
+        parser.error('--alvo exige --url com o banco do servidor (só lido, para sortear os ids)')
+    if argumentos.alvo and argumentos.repovoar:
+        parser.error('--repovoar não pode ser usado com --alvo: o banco é o do servidor')
+
+    url = argumentos.url or f"sqlite:///{os.path.join(tempfile.gettempdir(), 'benchmark_{exames}.db')}"
+    log = lambda mensagem: print(mensagem, file=sys.stderr)
+    resumo = executar_carga(url, argumentos.exames, argumentos.usuarios, argumentos.duracao, argumentos.processos,
+                            argumentos.alvo, modelo, argumentos.rampa, argumentos.semente, argumentos.repovoar,
+                            log=log)
+    resumo["commit"] = _commit()
+
+    print(f"{resumo['requisicoes']} requisições em {resumo['duracao_s']}s: {resumo['por_segundo']} req/s, "
+          f"p50 {resumo['p50_ms']} ms, p95 {resumo['p95_ms']} ms, p99 {resumo['p99_ms']} ms, "
+          f"erros {resumo['taxa_de_erro']:.2%}")
+    for acao, medida in resumo["acoes"].items():
+        print(f"  {acao:<22} {medida['requisicoes']:>7}  {medida['por_segundo']:>7} req/s  "
+              f"p50 {medida['p50_ms']:>8} ms  p95 {medida['p95_ms']:>8} ms  p99 {medida['p99_ms']:>8} ms  "
+              f"erros {medida['taxa_de_erro']:.2%}")
+    if argumentos.saida:
+        with open(argumentos.saida, 'w') as arquivo:
+            json.dump(resumo, arquivo, indent=2, ensure_ascii=False, default=str)
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    os.environ.setdefault('TEST_DATABASE_URL', 'sqlite://')
+    main()
@@ -0,0 +1,147 @@
+# benchmarks/cenarios.py
+import io
+import random
+from datetime import date, timedelta
+
+from sqlalchemy import func
+
+from app.models.company import Company
+from app.models.exam import Exam
+from app.models.user import User, UserRole
+from app.povoamento import SENHA_PADRAO
+
+FOTOS = 64
+
+
+class Cenario:
+    """
+    Uma requisição medida; `executar(cliente, contexto, i)` varia os parâmetros pela iteração `i`.
+    `requer` lista as chaves do contexto de onde o cenário sorteia valores: vazia alguma, ele não é medido.
+    """
+
+    def __init__(self, nome, executar, requer=()):
+        self.nome = nome
+        self.executar = executar
+        self.requer = requer
+
+    def motivo_para_ignorar(self, contexto):
+        vazias = [chave for chave in self.requer if not contexto[chave]]
+        if vazias:
+            return f"Contexto sem valores para: {', '.join(vazias)}"
+        return None
+
+
+def _foto(rng):
+    from PIL import Image
+    saida = io.BytesIO()
+    Image.frombytes('RGB', (320, 240), rng.randbytes(320 * 240 * 3)).save(saida, 'JPEG', quality=85)
+    return saida.getvalue()
+
+
+def montar_contexto(db, semente=42, amostra=200):
+    """Ids e valores reais do banco povoado, sorteados com semente fixa para as requisições."""
+    rng = random.Random(semente)
+    hoje = date.today()
+    total_exames = db.query(func.count(Exam.id)).scalar()
+    maior_empresa = db.query(Exam.company_id, func.count(Exam.id))\
+                      .group_by(Exam.company_id)\
+                      .order_by(func.count(Exam.id).desc())\
+                      .first()[0]
+    nomes = [nome for (nome,) in db.query(Company.name).order_by(Company.id).limit(amostra)]
+    emails = [email for (email,) in db.query(User.email).filter(User.role == UserRole.WORKER)
+                                      .order_by(User.id).limit(amostra)]
+    trabalhadores = [id for (id,) in db.query(Exam.user_id).filter(Exam.company_id == maior_empresa)
+                                        .distinct().limit(amostra)]
+    pendentes = [id for (id,) in db.query(Exam.id).filter(Exam.image_uploaded.is_(False), Exam.exam_date <= hoje)
+                                   .order_by(Exam.id).limit(amostra)]
+    rng.shuffle(pendentes)
+    return {
+        "hoje": hoje,
+        "paginas": max(total_exames // 50, 1),
+        "maior_empresa": maior_empresa,
+        "buscas": sorted({nome.split()[0][:4] for nome in nomes if nome}),
+        "emails": emails,
+        "trabalhadores": trabalhadores,
+        "pendentes": pendentes,
+        # Preenchido pelo cenário de upload: o povoamento não grava arquivos de imagem
+        "com_imagem": [],
+        # Fotos distintas geradas antes da medição (conteúdo repetido cairia na deduplicação)
+        "fotos": [_foto(rng) for _ in range(FOTOS)],
+    }
+
+
+def _escolher(contexto, chave, i):
+    itens = contexto[chave]
+    return itens[i % len(itens)]
+
+
+def listagem(cliente, contexto, i):
+    pagina = 1 + (i * 7919) % contexto["paginas"]
+    return cliente.get(f"/api/exames/listar/{pagina}/50")
+
+
+def listagem_por_empresa(cliente, contexto, i):
+    return cliente.get(f"/api/exames/listar_por_empresa/{contexto['maior_empresa']}/{1 + i % 5}/50")
+
+
+def busca(cliente, contexto, i):
+    # Com os valores padrão (1/10) a rota redireciona para a URL curta
+    return cliente.get(f"/api/empresas/find_by_substring/{_escolher(contexto, 'buscas', i)}/1/20")
+
+
+def filtro_por_data(cliente, contexto, i):
+    # Um mês de exames da maior empresa: a rota consulta o usuário de cada exame
+    fim = contexto["hoje"] - timedelta(days=30 * (i % 6))
+    return cliente.get(f"/api/exames/filtrar_por_data/{contexto['maior_empresa']}",
+                       query_string={"data_inicial": (fim - timedelta(days=30)).isoformat(),
+                                     "data_final": fim.isoformat()})
+
+
+def dashboard(cliente, contexto, i):
+    return cliente.get("/api/dashboard/dados")
+
+
+def login(cliente, contexto, i):
+    return cliente.post("/api/login", json={"email": _escolher(contexto, 'emails', i), "password": SENHA_PADRAO})
+
+
+def criar_em_lote(cliente, contexto, i):
+    trabalhadores = contexto["trabalhadores"]
+    inicio = (i * 25) % len(trabalhadores)
+    return cliente.post("/api/exames/criar_em_lote", json={
+        "company_id": contexto["maior_empresa"],
+        "users": (trabalhadores * 2)[inicio:inicio + 25],
+        "description": "Exame periódico",
+        "exam_date": (contexto["hoje"] + timedelta(days=1 + i % 20)).isoformat(),
+    })
+
+
+def upload(cliente, contexto, i):
+    exam_id = _escolher(contexto, 'pendentes', i)
+    resposta = cliente.post("/api/images/upload_images", content_type='multipart/form-data', data={
+        "imagens": [(io.BytesIO(_escolher(contexto, 'fotos', i)), 'foto.jpg')],
+        "image_names": [f"{exam_id}_000"],
+        "exam_id": exam_id,
+    })
+    if resposta.status_code == 200 and exam_id not in contexto["com_imagem"]:
+        contexto["com_imagem"].append(exam_id)
+    return resposta
+
+
+def notificar(cliente, contexto, i):
+    # Usa os exames que receberam imagem no cenário de upload; sem ele (ou sem nenhum sucesso) é ignorado
+    return cliente.post(f"/api/exames/notificar_exame_pronto/{_escolher(contexto, 'com_imagem', i)}")
+
+
+CENARIOS = [
+    Cenario("listagem", listagem),
+    Cenario("listagem_por_empresa", listagem_por_empresa),
+    Cenario("busca_empresas", busca, requer=("buscas",)),
+    Cenario("filtro_por_data", filtro_por_data),
+    Cenario("dashboard", dashboard),
+    Cenario("login", login, requer=("emails",)),
+    # Os que gravam no banco vêm por último, para não alterar o volume medido pelos demais
+    Cenario("criar_em_lote", criar_em_lote, requer=("trabalhadores",)),
+    Cenario("upload", upload, requer=("pendentes",)),
+    Cenario("notificar", notificar, requer=("com_imagem",)),
+]
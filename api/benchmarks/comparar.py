@@ -0,0 +1,49 @@
+# benchmarks/comparar.py
+import argparse
+import json
+import sys
+
+
+def comparar(anterior, atual, tolerancia=0.2):
+    """
+    Regressões entre dois resultados: p95 mais de `tolerancia` acima do anterior
+    ou mais consultas por requisição. Retorna uma lista de (escala, cenário, métrica, antes, depois).
+    """
+    regressoes = []
+    for exames, escala in atual["escalas"].items():
+        base = anterior["escalas"].get(exames, {}).get("cenarios", {})
+        for nome, medida in escala["cenarios"].items():
+            antes = base.get(nome)
+            if antes is None or "ignorado" in antes or "ignorado" in medida:
+                continue
+            if medida["p95_ms"] > antes["p95_ms"] * (1 + tolerancia):
+                regressoes.append((exames, nome, "p95_ms", antes["p95_ms"], medida["p95_ms"]))
+            if medida["consultas_por_requisicao"] > antes["consultas_por_requisicao"]:
+                regressoes.append((exames, nome, "consultas_por_requisicao",
+                                   antes["consultas_por_requisicao"], medida["consultas_por_requisicao"]))
+    return regressoes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.comparar',
+                                     description='Compara dois resultados do benchmark; sai com 1 se houver regressão.')
+    parser.add_argument('anterior')
+    parser.add_argument('atual')
+    parser.add_argument('--tolerancia', type=float, default=0.2, help='Aumento aceito no p95 (0.2 = 20%%).')
+    argumentos = parser.parse_args(argv)
+
+    with open(argumentos.anterior) as arquivo:
+        anterior = json.load(arquivo)
+    with open(argumentos.atual) as arquivo:
+        atual = json.load(arquivo)
+    regressoes = comparar(anterior, atual, argumentos.tolerancia)
+    print(f"{anterior.get('commit')} -> {atual.get('commit')}")
+    for exames, nome, metrica, antes, depois in regressoes:
+        print(f"REGRESSÃO {exames:>8} {nome:<22} {metrica}: {antes} -> {depois}")
+    if not regressoes:
+        print("Nenhuma regressão")
+    return 1 if regressoes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
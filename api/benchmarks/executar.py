@@ -0,0 +1,186 @@
+# benchmarks/executar.py
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+from sqlalchemy import create_engine, inspect
+
+ESCALAS = [10000, 100000, 1000000]
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _sessoes():
+    # O login ainda usa a sessão de app.database; as duas passam a apontar para o banco do benchmark
+    import app as pacote
+    from app import database
+    return [pacote.Session, database.Session]
+
+
+def _vincular(engine):
+    for sessao in _sessoes():
+        sessao.remove()
+        sessao.configure(bind=engine)
+
+
+def _preparar_banco(url, exames, semente, repovoar, log):
+    """Engine da escala; o banco é recriado e povoado, a não ser que já tenha o volume pedido."""
+    import app as pacote
+    from app.models.user import Base
+    from app.models.company import Base
+    from app.models.exam import Base, Exam
+    from app.models.outbox import Base
+    from app.models.job import Base
+    from app.models.blob import Base
+    from app.models.exam_image import Base
+    from app.models.upload_session import Base
+    from app.models.storage_usage import Base
+    from app.povoamento import EXAMES, povoar
+
+    engine = create_engine(url)
+    _vincular(engine)
+    db = pacote.Session()
+    inicio = time.perf_counter()
+    try:
+        # Uma falha na contagem (banco fora do ar, sem permissão) propaga: só a tabela ausente leva a povoar
+        if not repovoar and inspect(engine).has_table(Exam.__tablename__):
+            if db.query(Exam.id).count() >= exames:
+                log(f"Reaproveitando o banco com {exames} exames: {url}")
+                return engine, None
+        Base.metadata.drop_all(bind=engine)
+        Base.metadata.create_all(bind=engine)
+        log(f"Povoando {exames} exames em {url}")
+        povoar(db, escala=exames / EXAMES, semente=semente, exames=exames, ate=date.today())
+    finally:
+        db.close()
+    return engine, round(time.perf_counter() - inicio, 1)
+
+
+def _abrir_banco_existente(url, exames, log):
+    """Engine de um banco que não é do benchmark: só lido, nunca apagado nem povoado."""
+    import app as pacote
+    from app.models.exam import Exam
+
+    engine = create_engine(url)
+    _vincular(engine)
+    db = pacote.Session()
+    try:
+        total = db.query(Exam.id).count()
+    finally:
+        db.close()
+    if total < exames:
+        engine.dispose()
+        raise RuntimeError(f"O banco tem {total} exames, menos que os {exames} pedidos: {url}")
+    log(f"Usando o banco existente com {total} exames: {url}")
+    return engine
+
+
+def executar(escalas, url, repeticoes=30, semente=42, cenarios=None, repovoar=True, log=print):
+    """
+    Mede os cenários em cada escala e devolve o resultado serializável em JSON.
+    `url` pode conter '{exames}' para manter um banco por escala (reaproveitável com repovoar=False).
+    """
+    import app as pacote
+    from app import create_app
+    from benchmarks.cenarios import CENARIOS, montar_contexto
+    from benchmarks.medicao import medir
+
+    selecionados = [c for c in CENARIOS if not cenarios or c.nome in cenarios]
+    resultado = {
+        "commit": _commit(),
+        "data": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "repeticoes": repeticoes,
+        "escalas": {},
+    }
+    vinculos_originais = [sessao.session_factory.kw.get('bind') for sessao in _sessoes()]
+    try:
+        for exames in escalas:
+            engine, povoamento = _preparar_banco(url.format(exames=exames), exames, semente, repovoar, log)
+            resultado["banco"] = engine.dialect.name
+            pasta = tempfile.mkdtemp(prefix='benchmark-uploads-')
+            app = create_app()
+            # Fila de e-mails só gravada (nada é enviado) e uploads numa pasta descartável
+            app.config.update(UPLOAD_FOLDER=pasta, MAIL_QUEUE_WORKER='external',
+                              SECRET_KEY=app.config['SECRET_KEY'] or 'benchmark')
+            try:
+                db = pacote.Session()
+                contexto = montar_contexto(db, semente)
+                db.close()
+                medidas = {}
+                with app.test_client() as cliente:
+                    for cenario in selecionados:
+                        # Verificado na hora: o upload medido antes pode ter preenchido o contexto
+                        motivo = cenario.motivo_para_ignorar(contexto)
+                        if motivo:
+                            log(f"[{exames}] {cenario.nome} ignorado: {motivo}")
+                            medidas[cenario.nome] = {"ignorado": motivo}
+                            continue
+                        log(f"[{exames}] {cenario.nome}")
+                        medidas[cenario.nome] = medir(cliente, engine, cenario, contexto, repeticoes)
+                        for sessao in _sessoes():
+                            sessao.remove()
+            finally:
+                for sessao in _sessoes():
+                    sessao.remove()
+                shutil.rmtree(pasta, ignore_errors=True)
+                engine.dispose()
+            resultado["escalas"][str(exames)] = {
+                "povoamento_s": povoamento,
+                "pico_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "cenarios": medidas,
+            }
+    finally:
+        for sessao, vinculo in zip(_sessoes(), vinculos_originais):
+            sessao.remove()
+            sessao.configure(bind=vinculo)
+    return resultado
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Latência (p50/p95), consultas por requisição e pico de memória dos endpoints principais.')
+    parser.add_argument('--escalas', type=int, nargs='+', default=ESCALAS, help='Número de exames de cada rodada.')
+    parser.add_argument('--url', default=None,
+                        help="URL do banco de benchmark; '{exames}' vira a escala "
+                             "(padrão: um SQLite por escala na pasta temporária).")
+    parser.add_argument('--repeticoes', type=int, default=30)
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--cenarios', nargs='*', help='Só estes cenários (padrão: todos).')
+    parser.add_argument('--reaproveitar', action='store_true',
+                        help='Não repovoa um banco que já tem o volume pedido.')
+    parser.add_argument('--saida', help='Arquivo JSON do resultado (padrão: benchmark-<commit>.json).')
+    argumentos = parser.parse_args(argv)
+
+    url = argumentos.url or f"sqlite:///{os.path.join(tempfile.gettempdir(), 'benchmark_{exames}.db')}"
+    log = lambda mensagem: print(mensagem, file=sys.stderr)
+    resultado = executar(argumentos.escalas, url, argumentos.repeticoes, argumentos.semente,
+                         argumentos.cenarios, not argumentos.reaproveitar, log)
+
+    saida = argumentos.saida or f"benchmark-{resultado['commit'] or 'local'}.json"
+    with open(saida, 'w') as arquivo:
+        json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+    for exames, escala in resultado["escalas"].items():
+        for nome, medida in escala["cenarios"].items():
+            if "ignorado" in medida:
+                print(f"{exames:>8} {nome:<22} ignorado: {medida['ignorado']}")
+                continue
+            print(f"{exames:>8} {nome:<22} p50 {medida['p50_ms']:>9.2f} ms  p95 {medida['p95_ms']:>9.2f} ms  "
+                  f"{medida['consultas_por_requisicao']:>7} consultas  {medida['pico_memoria_kb']:>9} KB")
+    print(f"Resultado gravado em {saida}")
@@ -0,0 +1,76 @@
+# benchmarks/medicao.py
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+
+class ContadorDeConsultas:
+    """Conta as instruções enviadas ao banco pelo engine, ligado só durante a medição."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.consultas = 0
+
+    def _contar(self, *args, **kwargs):
+        self.consultas += 1
+
+    def __enter__(self):
+        self.consultas = 0
+        event.listen(self.engine, 'before_cursor_execute', self._contar)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._contar)
+
+
+def percentil(valores, p):
+    """Percentil com interpolação linear entre os vizinhos (o mesmo critério do numpy)."""
+    ordenados = sorted(valores)
+    if not ordenados:
+        return None
+    posicao = (len(ordenados) - 1) * p / 100
+    inferior = int(posicao)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicao - inferior)
+
+
+def medir(cliente, engine, cenario, contexto, repeticoes, aquecimento=2):
+    """
+    Executa o cenário `repeticoes` vezes pelo test client. As latências são medidas sem o
+    tracemalloc (que deixa a execução várias vezes mais lenta); o pico de memória vem de uma
+    execução extra com ele ligado.
+    """
+    for i in range(aquecimento):
+        cenario.executar(cliente, contexto, i)
+
+    latencias, consultas, status = [], [], {}
+    contador = ContadorDeConsultas(engine)
+    for i in range(repeticoes):
+        with contador:
+            inicio = time.perf_counter()
+            resposta = cenario.executar(cliente, contexto, aquecimento + i)
+            latencias.append((time.perf_counter() - inicio) * 1000)
+        consultas.append(contador.consultas)
+        status[resposta.status_code] = status.get(resposta.status_code, 0) + 1
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        cenario.executar(cliente, contexto, aquecimento + repeticoes)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "repeticoes": repeticoes,
+        "p50_ms": round(percentil(latencias, 50), 3),
+        "p95_ms": round(percentil(latencias, 95), 3),
+        "media_ms": round(sum(latencias) / len(latencias), 3),
+        "max_ms": round(max(latencias), 3),
+        "consultas_por_requisicao": round(sum(consultas) / len(consultas), 1),
+        "consultas_max": max(consultas),
+        "pico_memoria_kb": round(pico / 1024, 1),
+        "status": {str(codigo): total for codigo, total in sorted(status.items())},
+    }
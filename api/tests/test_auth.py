@@ -0,0 +1,115 @@
+import unittest
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+import jwt
+from flask import g, jsonify
+from bcrypt import hashpw, gensalt
+from app import create_app, drop_test_db
+from app.auth import TokenCache, login_obrigatorio, requer_papel
+from app.database import Base
+from app.models.user import User, UserRole
+from app import TestSession
+
+class AuthTestCase(unittest.TestCase):
+    def setUp(self):
+        """Configuração executada antes de cada teste"""
+        drop_test_db()
+        self.db = TestSession()
+        Base.metadata.create_all(bind=self.db.bind)
+
+        self.test_user = User(
+            name="Admin Teste",
+            email="admin@teste.com",
+            password_hash=hashpw("123456".encode("utf-8"), gensalt()).decode("utf-8"),
+            cpf="12345678901",
+            role=UserRole.ADMIN
+        )
+        self.db.add(self.test_user)
+        self.db.commit()
+
+        self.app = create_app(testing=True)
+
+        @self.app.route('/teste/perfil')
+        @login_obrigatorio
+        def perfil():
+            return jsonify({"name": g.principal.name})
+
+        @self.app.route('/teste/admin')
+        @requer_papel(UserRole.ADMIN)
+        def somente_admin():
+            return jsonify({"ok": True})
+
+    def tearDown(self):
+        """Limpeza executada após cada teste"""
+        self.db.close()
+        drop_test_db()
+
+    def gerar_token(self, role, exp=timedelta(hours=1)):
+        payload = {'sub': self.test_user.id, 'role': role, 'exp': datetime.now(timezone.utc) + exp}
+        return jwt.encode(payload, self.app.config['SECRET_KEY'], algorithm='HS256')
+
+    def test_sem_token(self):
+        """Rotas protegidas recusam requisições sem token"""
+        with self.app.test_client() as client:
+            response = client.get('/teste/perfil')
+            self.assertEqual(response.status_code, 401)
+
+    def test_token_expirado(self):
+        """Tokens expirados são recusados"""
+        token = self.gerar_token(UserRole.ADMIN, exp=timedelta(seconds=-10))
+        with self.app.test_client() as client:
+            response = client.get('/teste/perfil', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, 401)
+
+    @patch('app.auth.get_db')
+    def test_principal_carregado(self, mock_get_db):
+        """O principal é carregado a partir do 'sub' do token"""
+        mock_get_db.return_value = self.db
+        token = self.gerar_token(UserRole.ADMIN)
+        with self.app.test_client() as client:
+            response = client.get('/teste/perfil', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['name'], "Admin Teste")
+
+    @patch('app.auth.get_db')
+    def test_papel_sem_consulta_ao_banco(self, mock_get_db):
+        """A verificação de papel usa apenas os claims e reaproveita o cache"""
+        token = self.gerar_token(UserRole.WORKER)
+        cache = self.app.extensions['token_cache']
+        with self.app.test_client() as client:
+            for _ in range(3):
+                response = client.get('/teste/admin', headers={'Authorization': f'Bearer {token}'})
+                self.assertEqual(response.status_code, 403)
+        mock_get_db.assert_not_called()
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 2)
+
+    @patch('app.auth.get_db')
+    def test_token_de_confirmacao_nao_autentica(self, mock_get_db):
+        """Tokens de confirmação e de nova senha (to_jwt) não valem como credencial"""
+        mock_get_db.return_value = self.db
+        with self.app.app_context():
+            token = self.test_user.to_jwt()
+        with self.app.test_client() as client:
+            response = client.get('/teste/admin', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, 401)
+            response = client.get('/teste/perfil', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, 401)
+
+    def test_token_cache_lru(self):
+        """O cache descarta o item menos usado e os tokens expirados"""
+        cache = TokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.set('a', {'exp': exp})
+        cache.set('b', {'exp': exp})
+        cache.get('a')
+        cache.set('c', {'exp': exp})
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+
+        cache.set('d', {'exp': time.time() - 1})
+        self.assertIsNone(cache.get('d'))
+
+if __name__ == "__main__":
+    unittest.main()
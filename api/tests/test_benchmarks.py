@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, text
+
+from app import create_app
+from app.database import Base
+from app.models.company import Company
+from benchmarks.carga import executar_carga
+from benchmarks.cenarios import montar_contexto
+from benchmarks.comparar import comparar
+from benchmarks.executar import executar
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    """O benchmark roda de ponta a ponta numa escala mínima e compara resultados"""
+
+    def setUp(self):
+        self.pasta = tempfile.mkdtemp()
+        create_app(testing=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.pasta)
+
+    def test_execucao_e_comparacao(self):
+        url = f"sqlite:///{os.path.join(self.pasta, 'benchmark_{exames}.db')}"
+        resultado = executar([300], url, repeticoes=3, log=lambda mensagem: None)
+
+        cenarios = resultado["escalas"]["300"]["cenarios"]
+        self.assertEqual(set(cenarios), {"listagem", "listagem_por_empresa", "busca_empresas", "filtro_por_data",
+                                         "dashboard", "login", "criar_em_lote", "upload", "notificar"})
+        for nome, medida in cenarios.items():
+            self.assertTrue(all(status.startswith('2') for status in medida["status"]), (nome, medida["status"]))
+            self.assertLessEqual(medida["p50_ms"], medida["p95_ms"])
+            self.assertGreater(medida["consultas_por_requisicao"], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.pasta, 'benchmark_300.db')))
+
+        # Mais consultas ou p95 acima da tolerância contam como regressão
+        pior = {"escalas": {"300": {"cenarios": {nome: dict(medida) for nome, medida in cenarios.items()}}}}
+        pior["escalas"]["300"]["cenarios"]["dashboard"]["consultas_por_requisicao"] += 1
+        pior["escalas"]["300"]["cenarios"]["listagem"]["p95_ms"] *= 2
+        self.assertEqual(comparar(resultado, resultado), [])
+        self.assertEqual([(nome, metrica) for _, nome, metrica, _, _ in comparar(resultado, pior)],
+                         [("listagem", "p95_ms"), ("dashboard", "consultas_por_requisicao")])
+
+        # Sem valores para sortear, o cenário é registrado como ignorado em vez de derrubar a execução:
+        # a notificação sem o upload e o upload sem exames pendentes
+        with patch('benchmarks.cenarios.montar_contexto',
+                   side_effect=lambda db, semente: {**montar_contexto(db, semente), "pendentes": []}):
+            resultado = executar([300], url, repeticoes=2, cenarios=["upload", "notificar"], repovoar=False,
+                                 log=lambda mensagem: None)
+        self.assertEqual(resultado["escalas"]["300"]["cenarios"],
+                         {"upload": {"ignorado": "Contexto sem valores para: pendentes"},
+                          "notificar": {"ignorado": "Contexto sem valores para: com_imagem"}})
+        self.assertEqual(comparar(resultado, resultado), [])
+
+    def test_carga_no_servidor_local(self):
+        url = f"sqlite:///{os.path.join(self.pasta, 'carga.db')}"
+        resumo = executar_carga(url, 300, usuarios=4, duracao=1.5, processos=2, rampa=0.2, intervalo=0.5,
+                                log=lambda mensagem: None)
+
+        self.assertGreater(resumo["requisicoes"], 0)
+        self.assertEqual(resumo["taxa_de_erro"], 0)
+        for acao, medida in resumo["acoes"].items():
+            self.assertLessEqual(medida["p50_ms"], medida["p99_ms"], acao)
+            self.assertEqual(medida["erros"], {}, acao)
+
+    def test_carga_em_alvo_nao_altera_o_banco(self):
+        url = f"sqlite:///{os.path.join(self.pasta, 'servidor.db')}"
+        engine = create_engine(url)
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as conexao:
+            conexao.execute(Company.__table__.insert().values(
+                id="c" * 26, name="Empresa Real", phone="1", cnpj="1", email="real@teste.com"))
+
+        # O banco de um servidor em execução nunca é apagado nem povoado: falta de volume é erro
+        with self.assertRaises(RuntimeError):
+            executar_carga(url, 300, usuarios=1, duracao=0.1, alvo="http://127.0.0.1:9",
+                           log=lambda mensagem: None)
+        with self.assertRaises(ValueError):
+            executar_carga(url, 300, usuarios=1, duracao=0.1, alvo="http://127.0.0.1:9", repovoar=True,
+                           log=lambda mensagem: None)
+        with engine.connect() as conexao:
+            self.assertEqual(conexao.execute(text("SELECT name FROM companies")).scalars().all(), ["Empresa Real"])
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
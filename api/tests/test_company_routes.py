@@ -6,6 +6,9 @@ from bcrypt import hashpw, gensalt, checkpw
 from app import create_app, drop_test_db
 from app.database import Base
 from app.models.company import Company, CompanyDTO
+from app.models.storage_usage import CompanyQuota, StorageUsage, UsageScope
+from app.models.user import UserRole
+import jwt
 from app import TestSession
 
 class CompanyRoutesTestCase(unittest.TestCase):
@@ -390,5 +393,42 @@ class CompanyRoutesTestCase(unittest.TestCase):
                 checkpw(senha_original.encode('utf-8'), empresa_atualizada.password_hash.encode('utf-8'))
             )
 
+    @patch('app.routes.company_routes.get_db')
+    def test_armazenamento_e_cotas(self, mock_get_db):
+        """Teste do consumo da empresa, do relatório do administrador e da definição de cotas"""
+        mock_get_db.return_value = self.db
+        empresa = Company(name="Empresa Grande", phone="44444444444", cnpj="44444444444444",
+                          email="grande@teste.com")
+        self.db.add(empresa)
+        self.db.commit()
+        empresa_id = empresa.id
+        self.db.add_all([
+            CompanyQuota(company_id=empresa_id, hard_quota=1000),
+            StorageUsage(scope=UsageScope.COMPANY, owner_id=empresa_id, company_id=empresa_id, bytes=1200, files=3),
+            StorageUsage(scope=UsageScope.EXAM, owner_id="e" * 26, company_id=empresa_id, bytes=1200, files=3),
+            StorageUsage(scope=UsageScope.COMPANY, owner_id="c" * 26, company_id="c" * 26, bytes=10, files=1)
+        ])
+        self.db.commit()
+        self.app = create_app(testing=True)
+        payload = {'sub': "u" * 26, 'role': UserRole.ADMIN, 'exp': datetime.now(timezone.utc) + timedelta(hours=1)}
+        admin = {'Authorization': f"Bearer {jwt.encode(payload, self.app.config['SECRET_KEY'], algorithm='HS256')}"}
+
+        with self.app.test_client() as client:
+            response = client.get(f"/api/empresa/armazenamento/{empresa_id}")
+            self.assertEqual(response.status_code, 200)
+            armazenamento = response.json["armazenamento"]
+            self.assertEqual((armazenamento["bytes"], armazenamento["situacao"]), (1200, "cota_rigida"))
+            self.assertEqual(armazenamento["exames"][0]["exam_id"], "e" * 26)
+
+            self.assertEqual(client.get("/api/empresas/armazenamento").status_code, 401)
+            relatorio = client.get("/api/empresas/armazenamento", headers=admin).json["relatorio"]
+            self.assertEqual(relatorio["bytes"], 1210)
+            self.assertEqual([e["nome"] for e in relatorio["empresas"]], ["Empresa Grande", None])
+
+            response = client.put(f"/api/empresas/armazenamento/{empresa_id}/cotas", headers=admin,
+                                  json={"cota_suave": 1000, "cota_rigida": None})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json["armazenamento"]["situacao"], "cota_suave")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,79 @@
+import json
+import logging
+import unittest
+
+from flask import jsonify
+from sqlalchemy import text
+
+from app import TestSession, create_app
+from app.consultas import OrcamentoDeConsultasExcedido, forma_da_instrucao, logger
+
+
+class ConsultasTestCase(unittest.TestCase):
+    """Contagem de consultas por requisição, N+1 e orçamento"""
+
+    def setUp(self):
+        self.app = create_app(testing=True)
+
+        @self.app.route('/teste/consultas/<int:quantidade>')
+        def consultas(quantidade):
+            db = TestSession()
+            for i in range(quantidade):
+                db.execute(text("SELECT :n"), {"n": i})
+            db.execute(text("SELECT 1 + 1"))
+            return jsonify({"ok": True})
+
+    def tearDown(self):
+        TestSession.remove()
+
+    def test_server_timing_e_n_mais_um(self):
+        with self.app.test_client() as client:
+            with self.assertLogs(self.app.logger, level='WARNING') as logs:
+                response = client.get('/teste/consultas/12')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('desc="13 consultas"', response.headers['Server-Timing'])
+            self.assertIn('db-lenta;dur=', response.headers['Server-Timing'])
+            self.assertIn('db-n-mais-um;desc="12x 1 forma(s)"', response.headers['Server-Timing'])
+            self.assertIn("Possível N+1", logs.output[0])
+
+            # Abaixo do limite de repetições nada é sinalizado
+            response = client.get('/teste/consultas/3')
+            self.assertNotIn('db-n-mais-um', response.headers['Server-Timing'])
+
+    def test_log_estruturado(self):
+        self.app.config['SQL_STATS'] = 'log'
+        # Sem assertLogs, que forçaria o nível: a linha tem de sair com a configuração da própria aplicação
+        registros = []
+        handler = logging.Handler()
+        handler.emit = registros.append
+        logger.addHandler(handler)
+        try:
+            with self.app.test_client() as client:
+                response = client.get('/teste/consultas/2')
+        finally:
+            logger.removeHandler(handler)
+        self.assertFalse(self.app.logger.isEnabledFor(logging.INFO))
+        self.assertNotIn('Server-Timing', response.headers)
+        registro = json.loads(registros[0].getMessage().removeprefix('sql '))
+        self.assertEqual(registro["rota"], 'consultas')
+        self.assertEqual(registro["consultas"], 3)
+        self.assertEqual(registro["n_mais_um"], [])
+        self.assertIsNotNone(registro["mais_lenta"])
+
+    def test_orcamento_de_consultas(self):
+        self.app.config['SQL_QUERY_BUDGET'] = 5
+        with self.app.test_client() as client:
+            self.assertEqual(client.get('/teste/consultas/4').status_code, 200)
+            with self.assertRaises(OrcamentoDeConsultasExcedido) as contexto:
+                client.get('/teste/consultas/5')
+        self.assertEqual(contexto.exception.dados["consultas"], 6)
+
+    def test_forma_da_instrucao(self):
+        self.assertEqual(forma_da_instrucao("SELECT *\n  FROM exams WHERE id IN (?, ?, ?)"),
+                         forma_da_instrucao("SELECT * FROM exams WHERE id IN (?)"))
+        self.assertNotEqual(forma_da_instrucao("SELECT * FROM exams WHERE id = ?"),
+                            forma_da_instrucao("SELECT * FROM users WHERE id = ?"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import jwt
+from flask import jsonify
+
+from app import TestSession, create_app, drop_test_db
+from app.consultas_lentas import GravadorDeConsultasLentas, mascarar
+from app.database import Base
+from app.models.exam import Exam
+from app.models.user import UserRole
+
+
+class ConsultasLentasTestCase(unittest.TestCase):
+    """Consultas acima do limite ficam no buffer com parâmetros mascarados e o plano do banco"""
+
+    def setUp(self):
+        drop_test_db()
+        self.db = TestSession()
+        Base.metadata.create_all(bind=self.db.bind)
+        self.pasta = tempfile.mkdtemp()
+        self.app = create_app(testing=True)
+        self.gravador = self.app.extensions['consultas_lentas']
+        self.gravador.limite_ms = 0  # Toda consulta conta como lenta
+
+        @self.app.route('/teste/busca/<termo>')
+        def busca(termo):
+            # description não tem índice: o banco precisa varrer a tabela
+            total = TestSession().query(Exam).filter(Exam.description == termo).count()
+            return jsonify({"total": total})
+
+    def tearDown(self):
+        self.db.close()
+        drop_test_db()
+        shutil.rmtree(self.pasta)
+
+    def token(self, papel):
+        payload = {'sub': 'admin', 'role': papel, 'exp': datetime.now(timezone.utc) + timedelta(hours=1)}
+        return jwt.encode(payload, self.app.config['SECRET_KEY'], algorithm='HS256')
+
+    def test_registro_com_plano(self):
+        self.gravador.arquivo = os.path.join(self.pasta, 'lentas.jsonl')
+        with self.app.test_client() as client:
+            self.gravador.limpar()
+            self.assertEqual(client.get('/teste/busca/Admissional').status_code, 200)
+
+        registro = next(r for r in self.gravador.listar() if 'FROM exams' in r["sql"])
+        self.assertEqual(registro["rota"], 'busca')
+        self.assertEqual(registro["caminho"], '/teste/busca/<termo>')
+        self.assertIn('<str:11>', registro["parametros"])
+        self.assertNotIn('Admissional', json.dumps(registro))
+        self.assertIn('exams', registro["tabelas_varridas"])
+        self.assertTrue(any('exams' in linha for linha in registro["plano"]))
+
+        with open(self.gravador.arquivo) as arquivo:
+            gravados = [json.loads(linha) for linha in arquivo]
+        self.assertIn(registro["sql"], [gravado["sql"] for gravado in gravados])
+
+    def test_rota_do_administrador(self):
+        with self.app.test_client() as client:
+            client.get('/teste/busca/Periodico')
+            resposta = client.get('/api/diagnostico/consultas_lentas?limite=1',
+                                  headers={'Authorization': f'Bearer {self.token(UserRole.ADMIN)}'})
+            self.assertEqual(resposta.status_code, 200)
+            self.assertEqual(len(resposta.get_json()["consultas"]), 1)
+
+            resposta = client.get('/api/diagnostico/consultas_lentas',
+                                  headers={'Authorization': f'Bearer {self.token(UserRole.WORKER)}'})
+            self.assertEqual(resposta.status_code, 403)
+
+            resposta = client.delete('/api/diagnostico/consultas_lentas',
+                                     headers={'Authorization': f'Bearer {self.token(UserRole.ADMIN)}'})
+            self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(self.gravador.listar(), [])
+
+    def test_buffer_circular_e_mascara(self):
+        gravador = GravadorDeConsultasLentas(capacidade=2)
+        for i in range(3):
+            gravador.registrar({"sql": f"SELECT {i}"})
+        self.assertEqual([r["sql"] for r in gravador.listar()], ["SELECT 2", "SELECT 1"])
+        self.assertEqual(mascarar(("joao@teste.com", 10, None, True)), ["<str:14>", 10, None, True])
+        self.assertEqual(mascarar({"cpf": "12345678901"}), {"cpf": "<str:11>"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import boto3
+from moto import mock_aws
+
+from app import create_app
+from app import drop_test_db, TestSession
+from app.database import Base
+from app.blobs import caminho_blob
+from app.drivers import DriverLocal, DriverS3
+from app.limpeza import coletar_orfaos
+from app.models.blob import Blob
+from app.models.exam import Exam
+from app.models.exam_image import ExamImage
+
+
+class DriversTestCase(unittest.TestCase):
+    """Mesmas operações no disco local e num bucket S3 simulado pelo moto"""
+
+    def setUp(self):
+        self.ambiente = patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'teste', 'AWS_SECRET_ACCESS_KEY': 'teste',
+                                                'AWS_DEFAULT_REGION': 'us-east-1'})
+        self.ambiente.start()
+        self.aws = mock_aws()
+        self.aws.start()
+        boto3.client('s3').create_bucket(Bucket='exames')
+
+        self.pasta = tempfile.mkdtemp()
+        self.app = create_app(testing=True)
+        self.app.config['UPLOAD_FOLDER'] = self.pasta
+
+    def tearDown(self):
+        self.aws.stop()
+        self.ambiente.stop()
+        shutil.rmtree(self.pasta)
+
+    def temporario(self, conteudo):
+        descritor, caminho = tempfile.mkstemp(dir=self.pasta)
+        with os.fdopen(descritor, 'wb') as arquivo:
+            arquivo.write(conteudo)
+        return caminho
+
+    def verificar_driver(self, driver):
+        driver.gravar('blobs/aa/bb/um', self.temporario(b'primeiro'))
+        driver.gravar('blobs/aa/cc/dois', self.temporario(b'segundo!'))
+
+        with driver.abrir('blobs/aa/bb/um') as fluxo:
+            self.assertEqual(fluxo.read(), b'primeiro')
+        self.assertEqual(driver.tamanho('blobs/aa/cc/dois'), 8)
+        self.assertIsNone(driver.tamanho('blobs/nada'))
+        with self.assertRaises(FileNotFoundError):
+            driver.abrir('blobs/nada')
+        self.assertEqual(sorted((chave, tamanho) for chave, tamanho, _ in driver.listar('blobs/aa/')),
+                         [('blobs/aa/bb/um', 8), ('blobs/aa/cc/dois', 8)])
+        with self.app.test_request_context():
+            self.assertIn('blobs/aa/bb/um', driver.url_assinada('blobs/aa/bb/um', 'image/png', 'um.png', 60))
+
+        driver.apagar('blobs/aa/bb/um')
+        self.assertIsNone(driver.tamanho('blobs/aa/bb/um'))
+        # O arquivo de origem sai do disco depois de gravado
+        self.assertEqual(os.listdir(self.pasta), ['blobs'] if not driver.remoto else [])
+
+    def test_driver_local(self):
+        self.verificar_driver(DriverLocal(self.pasta))
+
+    def test_driver_s3(self):
+        self.verificar_driver(DriverS3('exames', prefixo='producao'))
+        chaves = [objeto['Key'] for objeto in boto3.client('s3').list_objects_v2(Bucket='exames')['Contents']]
+        self.assertEqual(chaves, ['producao/blobs/aa/cc/dois'])
+
+
+class ArmazenamentoS3TestCase(unittest.TestCase):
+    """Upload, leitura e exclusão de imagens com os blobs num bucket compartilhado"""
+
+    def setUp(self):
+        self.ambiente = patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'teste', 'AWS_SECRET_ACCESS_KEY': 'teste',
+                                                'AWS_DEFAULT_REGION': 'us-east-1'})
+        self.ambiente.start()
+        self.aws = mock_aws()
+        self.aws.start()
+        self.s3 = boto3.client('s3')
+        self.s3.create_bucket(Bucket='exames')
+
+        drop_test_db()
+        self.db = TestSession()
+        Base.metadata.create_all(bind=self.db.bind)
+        self.pasta = tempfile.mkdtemp()
+        self.app = create_app(testing=True)
+        self.app.config.update(UPLOAD_FOLDER=self.pasta, STORAGE_BACKEND='s3', S3_BUCKET='exames')
+        self.client = self.app.test_client()
+
+        self.exame = Exam(user_id="u" * 26, company_id="c" * 26, description="Exame", image_uploaded=True)
+        self.db.add(self.exame)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        drop_test_db()
+        shutil.rmtree(self.pasta)
+        self.aws.stop()
+        self.ambiente.stop()
+
+    def chaves(self):
+        return [objeto['Key'] for objeto in self.s3.list_objects_v2(Bucket='exames').get('Contents', [])]
+
+    @patch('app.routes.exam_routes.get_db')
+    @patch('app.routes.image_routes.get_db')
+    def test_ciclo_da_imagem_no_bucket(self, mock_get_db, mock_exam_get_db):
+        mock_get_db.return_value = self.db
+        mock_exam_get_db.return_value = self.db
+        response = self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={'imagens': [(io.BytesIO(b'laudo'), 'a.pdf')], 'image_names': ['a_000'], 'exam_id': self.exame.id}
+        )
+        self.assertEqual(response.status_code, 200)
+        checksum = hashlib.sha256(b'laudo').hexdigest()
+        self.assertEqual(self.chaves(), [caminho_blob(checksum)])
+        self.assertFalse(os.path.exists(os.path.join(self.pasta, 'blobs')))
+
+        # O navegador é redirecionado para a URL pré-assinada do bucket
+        imagem = self.db.query(ExamImage).one()
+        response = self.client.get(f'/api/images/{imagem.id}/arquivo')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('X-Amz-Signature', response.headers['Location'])
+        url = self.client.get(f'/api/images/exame/{self.exame.id}').json['imagens'][0]['url']
+        self.assertIn(caminho_blob(checksum), url)
+        self.assertIn('X-Amz-Signature', url)
+
+        # O ZIP lê o objeto do bucket em fluxo
+        response = self.client.get(f'/api/exames/download_imagens/{self.exame.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'laudo', response.get_data())
+
+        # Objeto sem registro é coletado; o que está em uso fica
+        self.s3.put_object(Bucket='exames', Key=caminho_blob('f' * 64), Body=b'orfao')
+        self.app.config['GC_GRACE_SECONDS'] = -60
+        with self.app.app_context():
+            resultado = coletar_orfaos(self.db, taxa=0)
+        self.assertEqual(resultado["orfaos"]["blobs"]["arquivos"], 1)
+        self.assertEqual(self.chaves(), [caminho_blob(checksum)])
+
+        self.assertEqual(self.client.delete(f'/api/images/delete_images/{self.exame.id}').status_code, 200)
+        self.assertEqual(self.db.query(Blob).count(), 0)
+        self.assertEqual(self.chaves(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,10 @@
 import unittest
+import io
 import json
+import zipfile
+import os
+import shutil
+import tempfile
 from datetime import datetime, timedelta, date
 from unittest.mock import patch, MagicMock
 from app import create_app, drop_test_db
@@ -7,6 +12,8 @@ from app.database import Base
 from app.models.exam import Exam
 from app.models.user import User
 from app.models.company import Company
+from app.models.exam_image import ExamImage
+from app.models.outbox import OutboxEmail
 from app import TestSession
 from bcrypt import hashpw, gensalt
 
@@ -502,5 +509,211 @@ class ExamRoutesTestCase(unittest.TestCase):
             exame_atualizado = self.db.query(Exam).get(exame.id)
             self.assertTrue(exame_atualizado.image_uploaded)
 
+    @patch('app.routes.job_routes.get_db')
+    @patch('app.routes.exam_routes.get_db')
+    def test_notificar_em_lote(self, mock_get_db, mock_job_get_db):
+        """Teste de notificação em lote com resumo por empresa"""
+        mock_get_db.return_value = self.db
+        mock_job_get_db.return_value = self.db
+
+        outro_usuario = User(
+            name="Outro Usuário",
+            email="outro@teste.com",
+            cpf="10987654321",
+            password_hash=hashpw("senha123".encode('utf-8'), gensalt()).decode('utf-8')
+        )
+        self.db.add(outro_usuario)
+        exames = [
+            Exam(user=usuario, company_id=self.test_company.id, description="Audiometria",
+                 image_uploaded=True, exam_date=date(2025, 3, 23))
+            for usuario in (self.test_user, outro_usuario)
+        ]
+        sem_imagem = Exam(user_id=self.test_user.id, company_id=self.test_company.id,
+                          description="Pendente", image_uploaded=False, exam_date=date(2025, 3, 23))
+        self.db.add_all(exames + [sem_imagem])
+        self.db.commit()
+
+        self.app = create_app(testing=True)
+        self.app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+        for exame in exames:
+            with open(os.path.join(self.app.config['UPLOAD_FOLDER'], f"{exame.id}_000.jpg"), 'wb') as arquivo:
+                arquivo.write(b'imagem')
+            self.db.add(ExamImage(exam_id=exame.id, name=f"{exame.id}_000.jpg", path=f"{exame.id}_000.jpg", size=6,
+                                  mime_type="image/jpeg", checksum="0" * 64))
+        self.db.commit()
+
+        try:
+            with self.app.test_client() as client:
+                response = client.post(
+                    "/api/exames/notificar_em_lote",
+                    data=json.dumps({"exam_ids": [exame.id for exame in exames] + [sem_imagem.id]}),
+                    content_type="application/json"
+                )
+                self.assertEqual(response.status_code, 202)
+
+                response = client.get(response.json["status_url"])
+                self.assertEqual(response.status_code, 200)
+                job = response.json["job"]
+                self.assertEqual(job["status"], "done")
+                self.assertEqual(job["result"]["exames_notificados"], 2)
+                self.assertEqual(job["result"]["resumos_empresas"], 1)
+
+            # Dois e-mails para os trabalhadores e um único resumo para a empresa
+            destinatarios = sorted(item.recipients[0] for item in self.db.query(OutboxEmail).all())
+            self.assertEqual(destinatarios, ["empresa@teste.com", "outro@teste.com", "usuario@teste.com"])
+        finally:
+            shutil.rmtree(self.app.config['UPLOAD_FOLDER'])
+
+    @patch('app.routes.exam_routes.get_db')
+    def test_notificar_exame_pronto_sem_copias(self, mock_get_db):
+        """Os anexos apontam para o arquivo original e arquivos grandes viram link assinado"""
+        mock_get_db.return_value = self.db
+
+        exame = Exam(user_id=self.test_user.id, company_id=self.test_company.id, description="Raio-X",
+                     image_uploaded=True, exam_date=date(2025, 3, 23))
+        self.db.add(exame)
+        self.db.commit()
+
+        self.app = create_app(testing=True)
+        self.app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+        self.app.config['MAIL_ATTACHMENT_MAX_BYTES'] = 10
+        pasta = self.app.config['UPLOAD_FOLDER']
+        for posicao, (nome, conteudo, mime) in enumerate([("000.jpg", b'foto', "image/jpeg"),
+                                                          ("001.pdf", b'documento grande', "application/pdf")]):
+            with open(os.path.join(pasta, f"{exame.id}_{nome}"), 'wb') as arquivo:
+                arquivo.write(conteudo)
+            self.db.add(ExamImage(exam_id=exame.id, name=f"{exame.id}_{nome}", path=f"{exame.id}_{nome}", size=len(conteudo),
+                                  mime_type=mime, checksum="0" * 64, position=posicao))
+        self.db.commit()
+
+        try:
+            with self.app.test_client() as client:
+                response = client.post(f"/api/exames/notificar_exame_pronto/{exame.id}")
+                self.assertEqual(response.status_code, 200)
+
+                # Nenhuma cópia foi criada na pasta de upload
+                self.assertEqual(len(os.listdir(pasta)), 2)
+
+                anexos = self.db.query(OutboxEmail).first().attachments
+                self.assertEqual(anexos[0]["path"], os.path.join(pasta, f"{exame.id}_000.jpg"))
+                self.assertEqual(anexos[0]["content_type"], "image/jpeg")
+                self.assertNotIn("url", anexos[0])
+                self.assertEqual(anexos[1]["content_type"], "application/pdf")
+
+                # O link assinado baixa o arquivo original com o nome amigável
+                link = anexos[1]["url"]
+                self.assertIn(f"/arquivos/{exame.id}_001.pdf?", link)
+                response = client.get(link[link.index("/api/"):])
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data, b'documento grande')
+                self.assertIn(anexos[1]["filename"], response.headers["Content-Disposition"])
+                response.close()
+        finally:
+            shutil.rmtree(pasta)
+    @patch('app.routes.exam_routes.get_db')
+    def test_download_imagens_em_fluxo(self, mock_get_db):
+        """O ZIP é transmitido sem arquivo temporário, com imagens comprimidas armazenadas sem recompressão"""
+        mock_get_db.return_value = self.db
+
+        exame = Exam(user_id=self.test_user.id, company_id=self.test_company.id, description="Raio-X",
+                     image_uploaded=True)
+        self.db.add(exame)
+        self.db.commit()
+
+        self.app = create_app(testing=True)
+        self.app.config['UPLOAD_FOLDER'] = pasta = tempfile.mkdtemp()
+        arquivos = [("000.jpg", b'foto' * 1000, "image/jpeg"), ("001.txt", b'laudo' * 1000, "text/plain")]
+        for posicao, (nome, conteudo, mime) in enumerate(arquivos):
+            with open(os.path.join(pasta, f"{exame.id}_{nome}"), 'wb') as arquivo:
+                arquivo.write(conteudo)
+            self.db.add(ExamImage(exam_id=exame.id, name=f"{exame.id}_{nome}", path=f"{exame.id}_{nome}",
+                                  size=len(conteudo), mime_type=mime, checksum="0" * 64, position=posicao))
+        self.db.commit()
+
+        try:
+            with self.app.test_client() as client:
+                response = client.get(f"/api/exames/download_imagens/{exame.id}")
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.is_streamed)
+                self.assertEqual(response.mimetype, 'application/zip')
+
+                with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+                    self.assertIsNone(zipf.testzip())
+                    entradas = {info.filename: info for info in zipf.infolist()}
+                    self.assertEqual(entradas[f"{exame.id}_000.jpg"].compress_type, zipfile.ZIP_STORED)
+                    self.assertEqual(entradas[f"{exame.id}_001.txt"].compress_type, zipfile.ZIP_DEFLATED)
+                    self.assertEqual(zipf.read(f"{exame.id}_001.txt"), b'laudo' * 1000)
+                response.close()
+
+            # Nada foi gravado na pasta de upload
+            self.assertEqual(len(os.listdir(pasta)), 2)
+        finally:
+            shutil.rmtree(pasta)
+    @patch('app.routes.job_routes.get_db')
+    @patch('app.routes.exam_routes.get_db')
+    def test_exportar_exames_empresa(self, mock_get_db, mock_job_db):
+        """Exportação em lote organizada por trabalhador e data, com manifesto e cache pelo conjunto de imagens"""
+        mock_get_db.return_value = self.db
+        mock_job_db.return_value = self.db
+
+        self.app = create_app(testing=True)
+        self.app.config['UPLOAD_FOLDER'] = pasta = tempfile.mkdtemp()
+        exames = []
+        for i, data_exame in enumerate([date(2025, 3, 10), date(2025, 3, 20), date(2025, 5, 1)]):
+            exame = Exam(user_id=self.test_user.id, company_id=self.test_company.id, description=f"Exame {i}",
+                         image_uploaded=True, exam_date=data_exame)
+            self.db.add(exame)
+            self.db.commit()
+            with open(os.path.join(pasta, f"{exame.id}_000.jpg"), 'wb') as arquivo:
+                arquivo.write(f"imagem {i}".encode())
+            self.db.add(ExamImage(exam_id=exame.id, name=f"{exame.id}_000.jpg", path=f"{exame.id}_000.jpg",
+                                  size=8, mime_type="image/jpeg", checksum=str(i) * 64))
+            exames.append(exame)
+        self.db.commit()
+        ids = [exame.id for exame in exames]
+        company_id = self.test_company.id
+        periodo = {"data_inicial": "2025-03-01", "data_final": "2025-03-31"}
+
+        try:
+            with self.app.test_client() as client:
+                response = client.get(f"/api/exames/exportar/{company_id}", query_string=periodo)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.is_streamed)
+                with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+                    nomes = zipf.namelist()
+                    manifesto = zipf.read('manifesto.csv').decode('utf-8').splitlines()
+                self.assertEqual(nomes[0], 'manifesto.csv')
+                self.assertEqual(nomes[1:], [f"Usuario_Teste_12345678901/2025-03-10/{ids[0]}_000.jpg",
+                                             f"Usuario_Teste_12345678901/2025-03-20/{ids[1]}_000.jpg"])
+                self.assertEqual(len(manifesto), 3)
+                self.assertIn("Exame 1", manifesto[2])
+
+                # Conjuntos grandes são montados por uma tarefa e ficam em cache
+                self.app.config['EXPORT_STREAM_MAX_IMAGES'] = 1
+                dados = {"company_id": company_id, **periodo}
+                response = client.post("/api/exames/exportacoes", json=dados)
+                self.assertEqual(response.status_code, 202)
+                job = client.get(response.json["status_url"]).json["job"]
+                self.assertEqual(job["status"], "done")
+                self.assertEqual(job["processed"], 2)
+
+                download = client.get(job["result"]["download_url"])
+                self.assertEqual(download.status_code, 200)
+                with zipfile.ZipFile(io.BytesIO(download.data)) as zipf:
+                    self.assertEqual(zipf.namelist(), nomes)
+                download.close()
+
+                response = client.post("/api/exames/exportacoes", json=dados)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json["chave"], job["result"]["chave"])
+
+                # Uma imagem nova muda o conjunto e invalida o cache
+                self.db.add(ExamImage(exam_id=ids[0], name=f"{ids[0]}_001.jpg", path=f"{ids[0]}_000.jpg",
+                                      size=8, mime_type="image/jpeg", checksum="9" * 64, position=1))
+                self.db.commit()
+                self.assertEqual(client.post("/api/exames/exportacoes", json=dados).status_code, 202)
+        finally:
+            shutil.rmtree(pasta)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
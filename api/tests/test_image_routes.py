@@ -1,11 +1,32 @@
+import hashlib
 import unittest
 import json
 import io
 import os
+import shutil
 import tempfile
+import time
+from datetime import datetime, timedelta
 from unittest.mock import patch, mock_open
 from app import create_app
 from werkzeug.datastructures import FileStorage
+from werkzeug.test import EnvironBuilder
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import drop_test_db, TestSession
+from app.database import Base
+from app.models.exam import Exam
+from app.models.exam_image import ExamImage
+from app.imagens import MARCADOR_INDEXACAO, indexacao_concluida, indexar_imagens_existentes
+from app.armazenamento import caminho_relativo, localizar, migrar_para_fragmentado
+from app.blobs import caminho_blob, deduplicar_existentes, relatorio, remover_imagem
+from app.models.blob import Blob
+from app.derivados import caminho_derivado, caminhos_dos_derivados
+from app.assinatura import gerar_url_arquivo
+from app.limpeza import coletar_orfaos
+from app.consumo import recalcular, uso, uso_do_exame
+from app.models.storage_usage import StorageUsage
+from app.models.upload_session import UploadSession, UploadStatus
 
 class ImageRoutesTestCase(unittest.TestCase):
     def setUp(self):
@@ -141,5 +162,750 @@ class ImageRoutesTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertIn('Erro ao fazer upload', response.json['erro'])
 
+
+class ExamImageTestCase(unittest.TestCase):
+    """Metadados das imagens gravados no banco em vez de varrer a pasta de upload"""
+
+    def setUp(self):
+        drop_test_db()
+        self.db = TestSession()
+        Base.metadata.create_all(bind=self.db.bind)
+        self.test_upload_folder = tempfile.mkdtemp()
+        self.app = create_app(testing=True)
+        self.app.config['UPLOAD_FOLDER'] = self.test_upload_folder
+        self.client = self.app.test_client()
+
+        self.exame = Exam(user_id="u" * 26, company_id="c" * 26, description="Exame")
+        self.db.add(self.exame)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        drop_test_db()
+        shutil.rmtree(self.test_upload_folder)
+
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_registra_metadados(self, mock_get_db):
+        """Teste de upload que registra tamanho, tipo, checksum e ordem das imagens"""
+        mock_get_db.return_value = self.db
+        response = self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={
+                'imagens': [(io.BytesIO(b'foto'), 'a.jpg'), (io.BytesIO(b'laudo'), 'b.pdf')],
+                'image_names': [f"{self.exame.id}_000", f"{self.exame.id}_001"],
+                'exam_id': self.exame.id
+            }
+        )
+
+        self.assertEqual(response.status_code, 200)
+        imagens = self.db.query(ExamImage).order_by(ExamImage.position).all()
+        self.assertEqual([imagem.name for imagem in imagens], [f"{self.exame.id}_000.jpg", f"{self.exame.id}_001.pdf"])
+        self.assertEqual(imagens[0].path, caminho_blob(hashlib.sha256(b'foto').hexdigest()))
+        self.assertTrue(os.path.exists(os.path.join(self.test_upload_folder, imagens[0].path)))
+        self.assertEqual([imagem.position for imagem in imagens], [0, 1])
+        self.assertEqual(imagens[1].size, 5)
+        self.assertEqual(imagens[1].mime_type, 'application/pdf')
+        self.assertEqual(imagens[0].checksum, hashlib.sha256(b'foto').hexdigest())
+        self.assertTrue(self.db.query(Exam).get(self.exame.id).image_uploaded)
+
+    def arquivos_gravados(self):
+        return [os.path.join(raiz, nome) for raiz, _, nomes in os.walk(self.test_upload_folder) for nome in nomes]
+
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_acima_do_limite_nao_deixa_arquivos(self, mock_get_db):
+        """Teste de upload recusado pelo limite por arquivo sem deixar arquivos parciais"""
+        mock_get_db.return_value = self.db
+        self.app.config['UPLOAD_MAX_FILE_BYTES'] = 10
+        response = self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={
+                'imagens': [(io.BytesIO(b'foto'), 'a.jpg'), (io.BytesIO(b'x' * 11), 'b.pdf')],
+                'image_names': [f"{self.exame.id}_000", f"{self.exame.id}_001"],
+                'exam_id': self.exame.id
+            }
+        )
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.arquivos_gravados(), [])
+        self.assertEqual(self.db.query(ExamImage).count(), 0)
+        self.assertFalse(self.db.query(Exam).get(self.exame.id).image_uploaded)
+
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_acima_do_limite_da_requisicao(self, mock_get_db):
+        """Teste de requisição maior que MAX_CONTENT_LENGTH"""
+        mock_get_db.return_value = self.db
+        self.app.config['MAX_CONTENT_LENGTH'] = 100
+        response = self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={
+                'imagens': [(io.BytesIO(b'x' * 200), 'a.jpg')],
+                'image_names': [f"{self.exame.id}_000"],
+                'exam_id': self.exame.id
+            }
+        )
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_exame_inexistente_nao_grava(self, mock_get_db):
+        """Teste de upload para exame inexistente: nada é gravado em disco"""
+        mock_get_db.return_value = self.db
+        response = self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={'imagens': [(io.BytesIO(b'foto'), 'a.jpg')], 'image_names': ['x_000'], 'exam_id': 'inexistente'}
+        )
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+    @patch('app.routes.image_routes.get_db')
+    def test_delete_remove_arquivos_e_registros(self, mock_get_db):
+        """Teste de exclusão baseada nos registros do exame"""
+        mock_get_db.return_value = self.db
+        nome = f"{self.exame.id}_000.jpg"
+        with open(os.path.join(self.test_upload_folder, nome), 'wb') as arquivo:
+            arquivo.write(b'foto')
+        self.db.add(ExamImage(exam_id=self.exame.id, name=nome, path=nome, size=4, mime_type='image/jpeg', checksum='0' * 64))
+        self.db.commit()
+
+        response = self.client.delete(f'/api/images/delete_images/{self.exame.id}')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['filenames'], [nome])
+        self.assertFalse(os.path.exists(os.path.join(self.test_upload_folder, nome)))
+        self.assertEqual(self.db.query(ExamImage).count(), 0)
+
+    def test_backfill_indexa_arquivos_existentes(self):
+        """Teste do backfill dos arquivos já presentes na pasta de upload"""
+        for nome in [f"{self.exame.id}_001.png", f"{self.exame.id}_000.jpg", f"{'x' * 26}_000.jpg", "perfil.png"]:
+            with open(os.path.join(self.test_upload_folder, nome), 'wb') as arquivo:
+                arquivo.write(b'dados')
+
+        resultado = indexar_imagens_existentes(self.db, self.test_upload_folder)
+
+        self.assertEqual(resultado, {"indexados": 2, "sem_exame": 1})
+        imagens = self.db.query(ExamImage).order_by(ExamImage.position).all()
+        self.assertEqual([imagem.path for imagem in imagens], [f"{self.exame.id}_000.jpg", f"{self.exame.id}_001.png"])
+        self.assertEqual(imagens[1].mime_type, 'image/png')
+
+        self.assertTrue(indexacao_concluida(self.test_upload_folder))
+
+        # Executar de novo não duplica registros
+        self.assertEqual(indexar_imagens_existentes(self.db, self.test_upload_folder)["indexados"], 0)
+    def test_migracao_para_layout_fragmentado(self):
+        """Teste da migração retomável do formato plano para o fragmentado"""
+        nomes = [f"{self.exame.id}_00{i}.jpg" for i in range(3)]
+        for posicao, nome in enumerate(nomes):
+            with open(os.path.join(self.test_upload_folder, nome), 'wb') as arquivo:
+                arquivo.write(b'foto')
+            self.db.add(ExamImage(exam_id=self.exame.id, name=nome, path=nome, size=4, mime_type='image/jpeg',
+                                  checksum='0' * 64, position=posicao))
+        self.db.commit()
+
+        with self.app.app_context():
+            # Simula uma execução interrompida depois de mover o arquivo e antes de gravar o registro
+            destino = os.path.join(self.test_upload_folder, caminho_relativo(nomes[0]))
+            os.makedirs(os.path.dirname(destino))
+            os.replace(os.path.join(self.test_upload_folder, nomes[0]), destino)
+            self.assertEqual(localizar(nomes[0]), destino)
+
+            resultado = migrar_para_fragmentado(self.db, lote=2)
+            self.assertEqual(resultado, {"migrados": 2, "ja_movidos": 1, "ausentes": 0})
+            self.assertEqual(migrar_para_fragmentado(self.db)["migrados"], 0)
+
+            for imagem in self.db.query(ExamImage).all():
+                self.assertEqual(imagem.path, caminho_relativo(os.path.basename(imagem.path)))
+                self.assertTrue(os.path.exists(localizar(imagem.path)))
+        self.assertEqual([nome for nome in os.listdir(self.test_upload_folder) if nome.endswith('.jpg')], [])
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_retomavel(self, mock_get_db):
+        """Teste do upload em blocos: reenvio, ordem, checksum por bloco e finalização"""
+        mock_get_db.return_value = self.db
+        self.app.config['UPLOAD_CHUNK_SIZE'] = 4
+        conteudo = b'0123456789'
+
+        response = self.client.post('/api/images/uploads', json={
+            'exam_id': self.exame.id, 'image_name': f"{self.exame.id}_000", 'filename': 'raio-x.pdf', 'size': len(conteudo)
+        })
+        self.assertEqual(response.status_code, 201)
+        url = response.json['upload_url']
+
+        self.assertEqual(self.client.put(f'{url}/chunks/0', data=conteudo[0:4]).status_code, 200)
+        # Reenvio do mesmo bloco após perder a resposta
+        self.assertEqual(self.client.put(f'{url}/chunks/0', data=conteudo[0:4]).json['upload']['offset'], 4)
+        response = self.client.put(f'{url}/chunks/2', data=conteudo[8:])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['offset'], 4)
+        response = self.client.put(f'{url}/chunks/1', data=conteudo[4:8], headers={'X-Chunk-Checksum': '0' * 64})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.client.get(url).json['upload']['offset'], 4)
+
+        self.client.put(f'{url}/chunks/1', data=conteudo[4:8],
+                        headers={'X-Chunk-Checksum': hashlib.sha256(conteudo[4:8]).hexdigest()})
+        self.assertEqual(self.client.post(f'{url}/finalize').status_code, 409)
+        self.client.put(f'{url}/chunks/2', data=conteudo[8:])
+        response = self.client.post(f'{url}/finalize')
+
+        self.assertEqual(response.status_code, 200)
+        imagem = self.db.query(ExamImage).one()
+        self.assertEqual(imagem.name, f"{self.exame.id}_000.pdf")
+        self.assertEqual(imagem.path, caminho_blob(hashlib.sha256(conteudo).hexdigest()))
+        self.assertEqual(imagem.checksum, hashlib.sha256(conteudo).hexdigest())
+        self.assertEqual(imagem.mime_type, 'application/pdf')
+        with open(os.path.join(self.test_upload_folder, imagem.path), 'rb') as arquivo:
+            self.assertEqual(arquivo.read(), conteudo)
+        self.assertTrue(self.db.query(Exam).get(self.exame.id).image_uploaded)
+        self.assertEqual(os.listdir(os.path.join(self.test_upload_folder, '.tmp')), [])
+
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_retomavel_cancelado(self, mock_get_db):
+        """Teste de cancelamento de upload em blocos"""
+        mock_get_db.return_value = self.db
+        response = self.client.post('/api/images/uploads', json={
+            'exam_id': self.exame.id, 'image_name': 'scan', 'filename': 'scan.png', 'size': 3
+        })
+        url = response.json['upload_url']
+        self.client.put(f'{url}/chunks/0', data=b'abc')
+
+        self.assertEqual(self.client.delete(url).status_code, 200)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+        # Expirada, a sessão não recebe mais blocos mas ainda pode ser cancelada
+        response = self.client.post('/api/images/uploads', json={
+            'exam_id': self.exame.id, 'image_name': 'scan', 'filename': 'scan.png', 'size': 3
+        })
+        url = response.json['upload_url']
+        self.client.put(f'{url}/chunks/0', data=b'ab')
+        sessao = self.db.query(UploadSession).one()
+        sessao.expires_at = datetime.now() - timedelta(minutes=1)
+        self.db.commit()
+        self.assertEqual(self.client.get(url).status_code, 410)
+        self.assertEqual(self.client.delete(url).status_code, 200)
+        self.assertEqual(self.db.query(UploadSession).count(), 0)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_retomavel_finalizacao_com_falha(self, mock_get_db):
+        """Teste de finalização concorrente e de falha ao registrar a imagem: a sessão pode ser finalizada de novo"""
+        mock_get_db.return_value = self.db
+        response = self.client.post('/api/images/uploads', json={
+            'exam_id': self.exame.id, 'image_name': 'scan', 'filename': 'scan.png', 'size': 3
+        })
+        url = response.json['upload_url']
+        self.client.put(f'{url}/chunks/0', data=b'abc')
+        sessao = self.db.query(UploadSession).one()
+        parcial = os.path.join(self.test_upload_folder, '.tmp', f'{sessao.id}.part')
+
+        # Outra chamada já reservou a sessão
+        sessao.status = UploadStatus.FINALIZING
+        self.db.commit()
+        self.assertEqual(self.client.post(f'{url}/finalize').status_code, 409)
+        sessao.status = UploadStatus.OPEN
+        self.db.commit()
+
+        with patch('app.uploads.registrar_imagem', side_effect=RuntimeError('falha')):
+            self.assertEqual(self.client.post(f'{url}/finalize').status_code, 500)
+        self.db.expire_all()
+        self.assertEqual(self.db.query(UploadSession).one().status, UploadStatus.OPEN)
+        self.assertEqual(self.db.query(Blob).count(), 0)
+        self.assertEqual(self.arquivos_gravados(), [parcial])
+
+        response = self.client.post(f'{url}/finalize')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['upload']['status'], UploadStatus.COMPLETED)
+        self.assertEqual(self.db.query(Blob).one().refcount, 1)
+
+    def enviar(self, nomes, conteudos):
+        return self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={
+                'imagens': [(io.BytesIO(conteudo), 'arquivo.jpg') for conteudo in conteudos],
+                'image_names': nomes,
+                'exam_id': self.exame.id
+            }
+        )
+
+    @patch('app.routes.image_routes.get_db')
+    def test_upload_duplicado_compartilha_blob(self, mock_get_db):
+        """Teste de conteúdo repetido: um único arquivo em disco com contagem de referências"""
+        mock_get_db.return_value = self.db
+        self.assertEqual(self.enviar(['a_000', 'a_001'], [b'mesmo', b'mesmo']).status_code, 200)
+        # Reenvio com o mesmo nome não soma referência
+        self.assertEqual(self.enviar(['a_001'], [b'mesmo']).status_code, 200)
+
+        blob = self.db.query(Blob).one()
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(len(self.arquivos_gravados()), 1)
+        self.assertEqual(relatorio(self.db)["bytes_economizados"], 5)
+
+        # Conteúdo diferente no mesmo nome solta o blob antigo
+        self.assertEqual(self.enviar(['a_001'], [b'outro']).status_code, 200)
+        self.db.expire_all()
+        self.assertEqual(self.db.query(Blob).get(blob.checksum).refcount, 1)
+
+        response = self.client.delete(f'/api/images/delete_images/{self.exame.id}')
+        self.assertEqual(response.json['bytes_liberados'], 10)
+        self.assertEqual(self.db.query(Blob).count(), 0)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+    @patch('app.routes.image_routes.get_db')
+    def test_mesmo_nome_em_outro_exame_nao_substitui(self, mock_get_db):
+        """Teste do nome enviado pelo cliente: só substitui a imagem com esse nome no mesmo exame"""
+        mock_get_db.return_value = self.db
+        outro = Exam(user_id="u" * 26, company_id="d" * 26, description="Outro exame")
+        self.db.add(outro)
+        self.db.commit()
+        self.assertEqual(self.enviar(['laudo'], [b'do exame A']).status_code, 200)
+        response = self.client.post('/api/images/upload_images', content_type='multipart/form-data', data={
+            'imagens': [(io.BytesIO(b'do exame B'), 'arquivo.jpg')], 'image_names': ['laudo'], 'exam_id': outro.id})
+        self.assertEqual(response.status_code, 200)
+
+        imagem_a, imagem_b = (self.db.query(ExamImage).filter_by(exam_id=exam_id).one()
+                              for exam_id in (self.exame.id, outro.id))
+        self.assertEqual(imagem_a.checksum, hashlib.sha256(b'do exame A').hexdigest())
+        self.assertEqual(imagem_b.checksum, hashlib.sha256(b'do exame B').hexdigest())
+        self.assertEqual(self.db.query(Blob).count(), 2)
+        self.assertEqual(uso_do_exame(self.db, self.exame.id)["bytes"], 10)
+        with self.app.app_context():
+            self.assertEqual(uso(self.db, "d" * 26)["bytes"], 10)
+
+    @patch('app.routes.image_routes.get_db')
+    def test_blob_recriado_antes_da_remocao_mantem_arquivo(self, mock_get_db):
+        """Teste do reenvio do conteúdo entre o DELETE do último blob e a remoção do arquivo"""
+        mock_get_db.return_value = self.db
+        self.assertEqual(self.enviar(['a_000'], [b'conteudo']).status_code, 200)
+        blob = self.db.query(Blob).one()
+        checksum, caminho = blob.checksum, os.path.join(self.test_upload_folder, blob.path)
+
+        def reenviar(session):
+            # Outra transação registra o mesmo conteúdo logo depois do commit que apagou o blob
+            if session is self.db:
+                with session.get_bind().begin() as conexao:
+                    conexao.execute(Blob.__table__.insert().values(
+                        checksum=checksum, path=blob.path, size=blob.size, refcount=1))
+
+        event.listen(Session, 'after_commit', reenviar, insert=True)
+        try:
+            with self.app.app_context():
+                remover_imagem(self.db, self.db.query(ExamImage).one())
+                self.db.commit()
+        finally:
+            event.remove(Session, 'after_commit', reenviar)
+        self.assertTrue(os.path.exists(caminho))
+        self.assertEqual(self.db.query(Blob).get(checksum).refcount, 1)
+
+    def test_deduplicar_imagens_existentes(self):
+        """Teste da conversão das imagens antigas para blobs, apagando as cópias"""
+        checksum = hashlib.sha256(b'copia').hexdigest()
+        for posicao, nome in enumerate([f"{self.exame.id}_000.jpg", f"{self.exame.id}_001.jpg"]):
+            with open(os.path.join(self.test_upload_folder, nome), 'wb') as arquivo:
+                arquivo.write(b'copia')
+            self.db.add(ExamImage(exam_id=self.exame.id, name=nome, path=nome, size=5, mime_type='image/jpeg',
+                                  checksum=checksum, position=posicao))
+        self.db.commit()
+
+        with self.app.app_context():
+            resultado = deduplicar_existentes(self.db)
+            self.assertEqual(resultado, {"convertidas": 2, "duplicadas_removidas": 1, "bytes_recuperados": 5, "ausentes": 0})
+            self.assertEqual(deduplicar_existentes(self.db)["convertidas"], 0)
+
+        self.assertEqual(self.db.query(Blob).one().refcount, 2)
+        self.assertEqual(self.arquivos_gravados(), [os.path.join(self.test_upload_folder, caminho_blob(checksum))])
+    def gerar_arquivo(self, formato, tamanho=(800, 600)):
+        from PIL import Image
+        saida = io.BytesIO()
+        Image.new('RGB', tamanho, (200, 30, 30)).save(saida, formato)
+        return saida.getvalue()
+
+    @patch('app.routes.image_routes.get_db')
+    def test_derivados_gerados_no_upload(self, mock_get_db):
+        """Teste de miniaturas em várias larguras, WebP e primeira página de PDF"""
+        mock_get_db.return_value = self.db
+        self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={
+                'imagens': [(io.BytesIO(self.gerar_arquivo('PNG')), 'foto.png'),
+                            (io.BytesIO(self.gerar_arquivo('PDF')), 'laudo.pdf')],
+                'image_names': ['a_000', 'a_001'],
+                'exam_id': self.exame.id
+            }
+        )
+        foto, laudo = self.db.query(ExamImage).order_by(ExamImage.position).all()
+        for imagem in (foto, laudo):
+            for relativo in caminhos_dos_derivados(imagem.checksum, self.app.config['DERIVATIVE_WIDTHS']):
+                self.assertTrue(os.path.exists(os.path.join(self.test_upload_folder, relativo)), relativo)
+
+        response = self.client.get(f'/api/images/{foto.id}/derivado?largura=200', headers={'Accept': 'image/webp,*/*'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('private', response.headers['Cache-Control'])
+        self.assertIn('Accept', response.headers['Vary'])
+        from PIL import Image
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size[0], 480)
+
+        response = self.client.get(f'/api/images/{laudo.id}/derivado?largura=100', headers={'Accept': 'image/jpeg'})
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size[0], 160)
+
+        listagem = self.client.get(f'/api/images/exame/{self.exame.id}').json['imagens']
+        self.assertIn('previews', listagem[0])
+
+    @patch('app.routes.image_routes.get_db')
+    def test_derivado_ausente_regerado_sob_demanda(self, mock_get_db):
+        """Teste de prévia regenerada na primeira leitura e revalidação por ETag"""
+        mock_get_db.return_value = self.db
+        self.app.config['DERIVATIVES_SYNC'] = False
+        with patch('app.derivados._get_pool'):
+            self.enviar(['a_000'], [self.gerar_arquivo('JPEG')])
+        imagem = self.db.query(ExamImage).one()
+        derivado = os.path.join(self.test_upload_folder, caminho_derivado(imagem.checksum, 160, 'jpeg'))
+        self.assertFalse(os.path.exists(derivado))
+
+        response = self.client.get(f'/api/images/{imagem.id}/derivado')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(os.path.exists(derivado))
+
+        response = self.client.get(f'/api/images/{imagem.id}/derivado', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+    @patch('app.routes.image_routes.get_db')
+    def test_arquivo_com_range_e_offload(self, mock_get_db):
+        """Teste de Range no modo Flask e de cabeçalhos X-Accel-Redirect / X-Sendfile"""
+        mock_get_db.return_value = self.db
+        self.enviar(['a_000'], [b'%PDF-conteudo-do-laudo'])
+        imagem = self.db.query(ExamImage).one()
+        url = f'/api/images/{imagem.id}/arquivo'
+
+        response = self.client.get(url, headers={'Range': 'bytes=0-4'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b'%PDF-')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 0-4/22')
+        self.assertIn('private', response.headers['Cache-Control'])
+        response.close()
+
+        self.app.config['FILE_SERVING_MODE'] = 'x-accel'
+        response = self.client.get(url, headers={'Range': 'bytes=0-4'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Accel-Redirect'], f'/protegido/{imagem.path}')
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.data, b'')
+
+        # A revalidação é respondida pelo Flask, sem passar pelo nginx
+        etag, modificado = response.headers['ETag'], response.headers['Last-Modified']
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+        response = self.client.get(url, headers={'If-Modified-Since': modificado})
+        self.assertEqual(response.status_code, 304)
+
+        self.app.config['FILE_SERVING_MODE'] = 'x-sendfile'
+        response = self.client.get(url)
+        self.assertEqual(response.headers['X-Sendfile'], os.path.join(self.test_upload_folder, imagem.path))
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+    @patch('app.routes.image_routes.get_db')
+    def test_urls_assinadas(self, mock_get_db):
+        """Teste das URLs assinadas: verificadas sem banco, com prazo e cache até vencer"""
+        mock_get_db.return_value = self.db
+        self.enviar(['a_000'], [self.gerar_arquivo('JPEG')])
+        imagem = self.db.query(ExamImage).one()
+        listagem = self.client.get(f'/api/images/exame/{self.exame.id}').json['imagens'][0]
+        url = listagem['url'][listagem['url'].index('/api/'):]
+
+        mock_get_db.side_effect = AssertionError('A URL assinada não deve consultar o banco')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertGreater(response.cache_control.max_age, 23 * 3600)
+        response.close()
+
+        self.assertEqual(self.client.get(url.replace('s=', 's=x')).status_code, 403)
+        self.assertEqual(self.client.get(url.replace('image%2Fjpeg', 'text%2Fhtml')).status_code, 403)
+
+        # Derivado apagado é recriado a partir do blob com o mesmo hash
+        previa = listagem['previews']['160']['webp']
+        os.remove(os.path.join(self.test_upload_folder, caminho_derivado(imagem.checksum, 160, 'webp')))
+        response = self.client.get(previa[previa.index('/api/'):])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/webp')
+        response.close()
+
+        with self.app.test_request_context():
+            vencida = gerar_url_arquivo(imagem.path, imagem.mime_type, validade=-2 * 3600)
+        self.assertEqual(self.client.get(vencida[vencida.index('/api/'):]).status_code, 410)
+
+    def gravar(self, relativo, conteudo=b'x', idade=None):
+        caminho = os.path.join(self.test_upload_folder, relativo)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        with open(caminho, 'wb') as arquivo:
+            arquivo.write(conteudo)
+        if idade is not None:
+            os.utime(caminho, (time.time() - idade, time.time() - idade))
+        return caminho
+
+    @patch('app.routes.image_routes.get_db')
+    def test_coleta_de_orfaos(self, mock_get_db):
+        """Teste da coleta: simulação só relata; a execução apaga apenas o que nada referencia"""
+        mock_get_db.return_value = self.db
+        self.enviar(['a_000'], [self.gerar_arquivo('JPEG')])
+        imagem = self.db.query(ExamImage).one()
+        mantidos = set(self.arquivos_gravados())
+        orfaos = [
+            self.gravar(f"exame_{self.exame.id}_imagens.zip", idade=7200),
+            self.gravar("Fulano_123_2024-01-01_0.jpg", idade=7200),
+            self.gravar(caminho_relativo("antigo_000.jpg"), idade=7200),
+            self.gravar(".tmp/tmpabandonado.part", idade=7200),
+            self.gravar(caminho_blob('f' * 64), idade=7200),
+            self.gravar(caminho_derivado('e' * 64, 160, 'webp'), idade=7200),
+            self.gravar(f"{caminho_derivado(imagem.checksum, 160, 'jpeg')}.123.tmp", idade=7200),
+            self.gravar("exportacoes/antiga.zip", idade=30 * 24 * 3600),
+        ]
+        mantidos |= {
+            self.gravar("recente_000.jpg"),  # Dentro do período de carência
+            self.gravar("exportacoes/recente.zip", idade=7200),
+            self.gravar(".gitkeep", idade=7200),
+        }
+
+        with self.app.app_context():
+            simulacao = coletar_orfaos(self.db, simular=True, taxa=0)
+            self.assertEqual(sum(c["arquivos"] for c in simulacao["orfaos"].values()), len(orfaos))
+            self.assertEqual(simulacao["orfaos"]["imagens"]["arquivos"], 3)
+            self.assertEqual(simulacao["arquivos_removidos"], 0)
+            self.assertTrue(all(os.path.exists(caminho) for caminho in orfaos))
+
+            # Antes do backfill uma imagem antiga sem registro pode ser legítima: só as outras categorias saem
+            resultado = coletar_orfaos(self.db, taxa=0)
+            self.assertTrue(resultado["indexacao_pendente"])
+            self.assertEqual(resultado["arquivos_removidos"], len(orfaos) - 3)
+            self.assertEqual(set(self.arquivos_gravados()), mantidos | set(orfaos[:3]))
+
+            indexar_imagens_existentes(self.db, self.test_upload_folder)
+            resultado = coletar_orfaos(self.db, taxa=0)
+            self.assertFalse(resultado["indexacao_pendente"])
+            self.assertEqual(resultado["arquivos_removidos"], 3)
+
+        mantidos.add(os.path.join(self.test_upload_folder, MARCADOR_INDEXACAO))
+        self.assertEqual(set(self.arquivos_gravados()), mantidos)
+
+    @patch('app.routes.exam_routes.get_db')
+    @patch('app.routes.image_routes.get_db')
+    def test_exame_excluido_libera_arquivos(self, mock_get_db, mock_exam_get_db):
+        """Teste de exclusão do exame: as imagens saem com ele e a coleta recupera exclusões antigas"""
+        mock_get_db.return_value = self.db
+        mock_exam_get_db.return_value = self.db
+        self.enviar(['a_000'], [b'foto'])
+        self.assertEqual(self.client.delete(f'/api/exames/deletar/{self.exame.id}').status_code, 200)
+        self.assertEqual(self.db.query(Blob).count(), 0)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+        # Exclusão feita antes da correção: as imagens saíram em cascata e o blob ficou
+        outro = Exam(user_id="u" * 26, company_id="c" * 26, description="Outro")
+        self.db.add(outro)
+        self.db.commit()
+        self.exame = outro
+        self.enviar(['b_000'], [b'laudo'])
+        self.db.delete(outro)
+        self.db.commit()
+        self.db.query(Blob).update({"created_at": datetime.now() - timedelta(days=1)}, synchronize_session=False)
+        self.db.commit()
+
+        with self.app.app_context():
+            self.assertEqual(coletar_orfaos(self.db, simular=True)["registros"]["blobs_sem_referencia"], 1)
+            resultado = coletar_orfaos(self.db)
+        self.assertEqual(resultado["registros"]["blobs_sem_referencia"], 1)
+        self.assertEqual(self.db.query(Blob).count(), 0)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+    def foto_de_celular(self):
+        from PIL import Image
+        foto = Image.effect_noise((1200, 600), 64).convert('RGB')
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientação: girar 90°
+        exif[0x010F] = 'Fabricante'
+        exif[0x8825] = {1: 'S', 2: (23.0, 32.0, 10.0)}  # GPS
+        saida = io.BytesIO()
+        foto.save(saida, 'JPEG', exif=exif, quality=95)
+        return saida.getvalue()
+
+    def enviar_foto(self, exam_id, conteudo):
+        return self.client.post(
+            '/api/images/upload_images',
+            content_type='multipart/form-data',
+            data={'imagens': [(io.BytesIO(conteudo), 'foto.jpg')], 'image_names': ['foto_000'], 'exam_id': exam_id}
+        )
+
+    @patch('app.routes.image_routes.get_db')
+    def test_otimizacao_remove_metadados(self, mock_get_db):
+        """Teste da otimização: sem EXIF, orientação aplicada, menor e com os tamanhos registrados"""
+        from PIL import Image
+        mock_get_db.return_value = self.db
+        self.app.config.update(IMAGE_OPTIMIZE=True, IMAGE_OPTIMIZE_MAX_SIDE=800)
+        exam_id = self.exame.id
+        original = self.foto_de_celular()
+
+        response = self.enviar_foto(exam_id, original)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('otimizacao_job_id', response.json)
+
+        imagem = self.db.query(ExamImage).one()
+        self.assertEqual(imagem.original_size, len(original))
+        self.assertLess(imagem.size, len(original))
+        self.assertIsNone(imagem.original_checksum)
+        self.assertEqual(self.db.query(Blob).one().checksum, imagem.checksum)
+        with Image.open(os.path.join(self.test_upload_folder, imagem.path)) as foto:
+            self.assertEqual(foto.size, (400, 800))
+            self.assertEqual(len(foto.getexif()), 0)
+        # Prévias geradas a partir do conteúdo otimizado
+        self.assertTrue(os.path.exists(os.path.join(self.test_upload_folder,
+                                                    caminho_derivado(imagem.checksum, 160, 'webp'))))
+
+    @patch('app.routes.image_routes.get_db')
+    def test_otimizacao_mantem_original(self, mock_get_db):
+        """Teste da otimização mantendo o arquivo enviado: os dois blobs saem junto com a imagem"""
+        mock_get_db.return_value = self.db
+        self.app.config.update(IMAGE_OPTIMIZE=True, IMAGE_OPTIMIZE_KEEP_ORIGINALS=True)
+        exam_id = self.exame.id
+        original = self.foto_de_celular()
+        self.enviar_foto(exam_id, original)
+
+        imagem = self.db.query(ExamImage).one()
+        self.assertEqual(imagem.original_checksum, hashlib.sha256(original).hexdigest())
+        self.assertEqual(self.db.query(Blob).count(), 2)
+
+        with self.app.app_context():
+            self.assertEqual(uso(self.db, "c" * 26)["bytes"], imagem.size + len(original))
+
+        response = self.client.delete(f'/api/images/delete_images/{exam_id}')
+        self.assertEqual(response.json['bytes_liberados'], imagem.size + len(original))
+        self.assertEqual(self.db.query(Blob).count(), 0)
+        self.assertEqual(self.arquivos_gravados(), [])
+
+    def contadores(self):
+        return sorted((contador.scope, contador.owner_id, contador.bytes, contador.files)
+                      for contador in self.db.query(StorageUsage))
+
+    @patch('app.routes.exam_routes.get_db')
+    @patch('app.routes.image_routes.get_db')
+    def test_consumo_por_empresa(self, mock_get_db, mock_exam_get_db):
+        """Teste dos contadores: somados no upload, ajustados no reenvio e descontados na exclusão"""
+        mock_get_db.return_value = self.db
+        mock_exam_get_db.return_value = self.db
+        exam_id = self.exame.id
+        self.enviar(['a_000', 'a_001'], [b'foto', b'laudo'])
+        self.enviar(['a_001'], [b'laudo maior'])
+
+        with self.app.app_context():
+            empresa = uso(self.db, "c" * 26)
+            self.assertEqual((empresa["bytes"], empresa["arquivos"]), (15, 2))
+            self.assertEqual(empresa["exames"], [{"exam_id": exam_id, "bytes": 15, "arquivos": 2}])
+            self.assertEqual(uso_do_exame(self.db, exam_id)["bytes"], 15)
+        response = self.client.get(f'/api/exames/armazenamento/{exam_id}')
+        self.assertEqual(response.json['armazenamento']['arquivos'], 2)
+
+        # A reconstrução a partir das imagens chega aos mesmos valores
+        incrementais = self.contadores()
+        recalcular(self.db)
+        self.assertEqual(self.contadores(), incrementais)
+
+        # Exame movido para outra empresa leva o consumo junto
+        self.client.put(f'/api/exames/atualizar/{exam_id}', json={'company_id': "d" * 26})
+        with self.app.app_context():
+            self.assertEqual(uso(self.db, "c" * 26)["bytes"], 0)
+            self.assertEqual(uso(self.db, "d" * 26)["bytes"], 15)
+
+        self.assertEqual(self.client.delete(f'/api/exames/deletar/{exam_id}').status_code, 200)
+        self.assertEqual(self.contadores(), [('company', "c" * 26, 0, 0), ('company', "d" * 26, 0, 0)])
+
+    @patch('app.routes.image_routes.get_db')
+    def test_cota_de_armazenamento(self, mock_get_db):
+        """Teste das cotas: a rígida recusa antes de gravar e a suave só avisa"""
+        mock_get_db.return_value = self.db
+        self.app.config.update(STORAGE_SOFT_QUOTA_BYTES=10, STORAGE_HARD_QUOTA_BYTES=2000)
+
+        response = self.enviar(['a_000'], [b'x' * 100])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['aviso_cota']['cota'], 10)
+
+        response = self.enviar(['a_001'], [b'y' * 2000])
+        self.assertEqual(response.status_code, 507)
+        self.assertEqual(response.json['bytes_usados'], 100)
+        self.assertEqual(len(self.arquivos_gravados()), 1)
+        self.assertEqual(self.db.query(ExamImage).count(), 1)
+
+        response = self.client.post('/api/images/uploads', json={
+            'exam_id': self.exame.id, 'image_name': 'a_002', 'filename': 'b.pdf', 'size': 5000})
+        self.assertEqual(response.status_code, 507)
+
+        for tamanho in ('muito', -5):
+            response = self.client.post('/api/images/uploads', json={
+                'exam_id': self.exame.id, 'image_name': 'a_002', 'filename': 'b.pdf', 'size': tamanho})
+            self.assertEqual(response.status_code, 400)
+
+    @patch('app.routes.image_routes.get_db')
+    def test_cota_conferida_na_gravacao(self, mock_get_db):
+        """Teste de envios simultâneos: a cota rígida vale no UPDATE do contador, não só na verificação prévia"""
+        mock_get_db.return_value = self.db
+        self.app.config['STORAGE_HARD_QUOTA_BYTES'] = 2000
+        self.assertEqual(self.enviar(['a_000'], [b'x' * 500]).status_code, 200)
+
+        # Outro envio passou pela verificação prévia antes deste ser contado
+        with patch('app.consumo.verificar_cota', return_value=None):
+            response = self.enviar(['a_001'], [b'y' * 1600])
+        self.assertEqual(response.status_code, 507)
+        self.assertEqual(response.json['bytes_usados'], 500)
+        self.assertEqual(self.db.query(ExamImage).count(), 1)
+        self.assertEqual(self.db.query(Blob).count(), 1)
+        self.assertEqual(len(self.arquivos_gravados()), 1)
+        self.assertEqual(uso_do_exame(self.db, self.exame.id)["bytes"], 500)
+
+    @patch('app.routes.image_routes.get_db')
+    def test_cota_sem_content_length(self, mock_get_db):
+        """Teste de envio chunked: sem Content-Length a cota vale para os bytes recebidos"""
+        mock_get_db.return_value = self.db
+        self.app.config['STORAGE_HARD_QUOTA_BYTES'] = 1000
+        ambiente = EnvironBuilder(method='POST', data={
+            'imagens': [(io.BytesIO(b'x' * 1500), 'arquivo.jpg')], 'image_names': ['a_000'],
+            'exam_id': self.exame.id}).get_environ()
+        corpo = ambiente['wsgi.input'].read()
+
+        response = self.client.post('/api/images/upload_images', input_stream=io.BytesIO(corpo),
+                                    content_type=ambiente['CONTENT_TYPE'],
+                                    headers={'Transfer-Encoding': 'chunked'},
+                                    environ_overrides={'wsgi.input_terminated': True})
+        self.assertEqual(response.status_code, 507)
+        self.assertEqual(self.arquivos_gravados(), [])
+        self.assertEqual(self.db.query(ExamImage).count(), 0)
+
+    @patch('app.routes.image_routes.get_db')
+    def test_cota_com_uploads_retomaveis_simultaneos(self, mock_get_db):
+        """Teste de sessões abertas reservando a cota e da nova conferência ao finalizar"""
+        mock_get_db.return_value = self.db
+        self.app.config['STORAGE_HARD_QUOTA_BYTES'] = 10
+        urls = []
+        for nome, tamanho, status in (('a_000', 6, 201), ('a_001', 6, 507), ('a_001', 4, 201)):
+            response = self.client.post('/api/images/uploads', json={
+                'exam_id': self.exame.id, 'image_name': nome, 'filename': 'b.pdf', 'size': tamanho})
+            self.assertEqual(response.status_code, status)
+            if status == 201:
+                urls.append((response.json['upload_url'], b'z' * tamanho))
+        for url, conteudo in urls:
+            self.client.put(f'{url}/chunks/0', data=conteudo)
+        self.assertEqual(self.client.post(f'{urls[0][0]}/finalize').status_code, 200)
+
+        # A cota baixou depois da criação da sessão: a finalização confere de novo
+        self.app.config['STORAGE_HARD_QUOTA_BYTES'] = 8
+        response = self.client.post(f'{urls[1][0]}/finalize')
+        self.assertEqual(response.status_code, 507)
+        self.assertEqual(response.json['bytes_usados'], 6)
+        self.assertEqual(self.db.query(ExamImage).count(), 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
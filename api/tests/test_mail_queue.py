@@ -0,0 +1,165 @@
+import unittest
+import os
+import smtplib
+import socket
+import tempfile
+from datetime import datetime
+from unittest.mock import patch
+from aiosmtpd.controller import Controller
+from app import create_app, drop_test_db
+from app.database import Base
+from app.mail_queue import MailWorker, enfileirar_email, montar_mensagem
+from app.models.outbox import OutboxEmail, OutboxStatus
+from app import TestSession
+
+
+class ColetorSMTP:
+    """Handler do aiosmtpd que apenas guarda as mensagens recebidas"""
+    def __init__(self):
+        self.mensagens = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.mensagens.append(envelope)
+        return '250 OK'
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        """Configuração executada antes de cada teste"""
+        drop_test_db()
+        self.db = TestSession()
+        Base.metadata.create_all(bind=self.db.bind)
+
+        # Servidor SMTP local no lugar do provedor real
+        self.coletor = ColetorSMTP()
+        self.smtp = Controller(self.coletor, hostname='127.0.0.1', port=porta_livre())
+        self.smtp.start()
+
+        self.app = self.criar_app(self.smtp.port)
+        self.worker = MailWorker(self.app, lambda: self.db)
+
+    def criar_app(self, porta, **extras):
+        ambiente = {
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': str(porta),
+            'MAIL_USE_TLS': 'False',
+            'MAIL_USE_SSL': 'False',
+            'MAIL_USERNAME': 'clinica@teste.com',
+            'MAIL_PASSWORD': '',
+            **extras
+        }
+        with patch.dict(os.environ, ambiente):
+            app = create_app(testing=True)
+        # Em modo de teste o Flask-Mail suprime os envios; aqui queremos falar com o SMTP local
+        app.extensions['mail'].suppress = False
+        return app
+
+    def tearDown(self):
+        """Limpeza executada após cada teste"""
+        self.worker.pool.fechar_todas()
+        self.smtp.stop()
+        self.db.close()
+        drop_test_db()
+
+    def test_enfileirar_nao_envia(self):
+        """Enfileirar apenas grava a mensagem, sem falar com o servidor SMTP"""
+        with self.app.app_context():
+            enfileirar_email(self.db, "Assunto", ["usuario@teste.com"], "<b>Olá</b>")
+
+        self.assertEqual(self.coletor.mensagens, [])
+        item = self.db.query(OutboxEmail).one()
+        self.assertEqual(item.status, OutboxStatus.PENDING)
+
+    def test_worker_envia_pendentes(self):
+        """O worker entrega as mensagens pendentes e as marca como enviadas"""
+        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as arquivo:
+            arquivo.write(b'conteudo da imagem')
+        try:
+            with self.app.app_context():
+                enfileirar_email(self.db, "Exame pronto", ["usuario@teste.com"], "<b>Pronto</b>",
+                                 anexos=[{"path": arquivo.name, "filename": "exame.png", "content_type": "image/png"}])
+
+            self.assertEqual(self.worker.processar_lote(), 1)
+        finally:
+            os.remove(arquivo.name)
+
+        self.assertEqual(len(self.coletor.mensagens), 1)
+        self.assertEqual(self.coletor.mensagens[0].rcpt_tos, ["usuario@teste.com"])
+        self.assertIn(b'exame.png', self.coletor.mensagens[0].content)
+        item = self.db.query(OutboxEmail).one()
+        self.assertEqual(item.status, OutboxStatus.SENT)
+        self.assertIsNotNone(item.sent_at)
+
+    def test_falha_reagenda_com_backoff(self):
+        """Falhas de envio reagendam a mensagem e descartam após o limite de tentativas"""
+        # Nenhum servidor escutando nesta porta
+        self.app = self.criar_app(porta_livre())
+        self.app.config['MAIL_MAX_ATTEMPTS'] = 2
+        self.worker = MailWorker(self.app, lambda: self.db)
+        with self.app.app_context():
+            enfileirar_email(self.db, "Assunto", ["usuario@teste.com"], "<b>Olá</b>")
+
+        self.assertEqual(self.worker.processar_lote(), 0)
+        item = self.db.query(OutboxEmail).one()
+        self.assertEqual(item.status, OutboxStatus.PENDING)
+        self.assertEqual(item.attempts, 1)
+        self.assertGreater(item.next_attempt_at, datetime.now())
+
+        # Força a próxima tentativa, que esgota o limite
+        item.next_attempt_at = datetime.now()
+        self.db.commit()
+        self.worker.processar_lote()
+        item = self.db.query(OutboxEmail).one()
+        self.assertEqual(item.status, OutboxStatus.FAILED)
+        self.assertEqual(self.coletor.mensagens, [])
+
+    def test_lote_reutiliza_conexao(self):
+        """Um lote inteiro usa a mesma conexão, respeitando o limite de mensagens por conexão"""
+        self.app = self.criar_app(self.smtp.port, MAIL_MAX_EMAILS='3')
+        self.worker = MailWorker(self.app, lambda: self.db)
+        with self.app.app_context():
+            for i in range(4):
+                enfileirar_email(self.db, f"Mensagem {i}", ["usuario@teste.com"], "<b>Olá</b>")
+
+        with patch('flask_mail.smtplib.SMTP', wraps=smtplib.SMTP) as smtp_cls:
+            self.assertEqual(self.worker.processar_lote(), 4)
+            # Uma conexão para as três primeiras mensagens e outra após atingir o limite
+            self.assertEqual(smtp_cls.call_count, 2)
+
+            with self.app.app_context():
+                enfileirar_email(self.db, "Mais uma", ["usuario@teste.com"], "<b>Olá</b>")
+            self.assertEqual(self.worker.processar_lote(), 1)
+            # O lote seguinte aproveita a conexão mantida pelo pool
+            self.assertEqual(smtp_cls.call_count, 2)
+
+        self.worker.pool.fechar_todas()
+        self.assertEqual(len(self.coletor.mensagens), 5)
+        self.assertEqual(self.worker.estatisticas.enviados, 5)
+        self.assertGreater(self.worker.estatisticas.mensagens_por_segundo, 0)
+
+    def test_anexo_lido_uma_vez(self):
+        """Mensagens do mesmo lote compartilham os bytes dos anexos"""
+        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as arquivo:
+            arquivo.write(b'conteudo da imagem')
+        try:
+            with self.app.app_context():
+                anexos = [{"path": arquivo.name, "filename": "exame.png", "content_type": "image/png"}]
+                itens = [enfileirar_email(self.db, "Exame pronto", [destino], "<b>Pronto</b>", anexos=anexos)
+                         for destino in ("usuario@teste.com", "empresa@teste.com")]
+
+                conteudos = {}
+                with patch('builtins.open', wraps=open) as abrir:
+                    mensagens = [montar_mensagem(item, conteudos) for item in itens]
+                self.assertEqual(abrir.call_count, 1)
+                self.assertIs(mensagens[0].attachments[0].data, mensagens[1].attachments[0].data)
+        finally:
+            os.remove(arquivo.name)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from flask import abort, jsonify
+
+from app import Session, TestSession, create_app, drop_test_db
+from app.database import Base
+from app.mail_queue import enfileirar_email
+from app.metricas import Metricas, agregar, formatar
+
+
+class MetricasTestCase(unittest.TestCase):
+    """Séries expostas em /metrics, agregadas entre os processos de um servidor pre-fork"""
+
+    def setUp(self):
+        drop_test_db()
+        self.db = TestSession()
+        Base.metadata.create_all(bind=self.db.bind)
+        self.pasta = tempfile.mkdtemp()
+        self.app = create_app(testing=True)
+
+        @self.app.route('/teste/ok')
+        def ok():
+            return jsonify({"ok": True})
+
+        @self.app.route('/teste/proibido')
+        def proibido():
+            abort(403)
+
+    def tearDown(self):
+        self.db.close()
+        drop_test_db()
+        shutil.rmtree(self.pasta)
+
+    def coletar(self, client, **kwargs):
+        # A fila de e-mails é lida do banco de testes
+        with patch('app.get_db', return_value=TestSession()):
+            resposta = client.get('/metrics', **kwargs)
+        return resposta
+
+    def test_latencia_e_status_por_rota(self):
+        with self.app.test_client() as client:
+            for _ in range(3):
+                client.get('/teste/ok')
+            client.get('/teste/proibido')
+            client.get('/api/exames/armazenamento/inexistente')
+            resposta = self.coletar(client)
+
+        self.assertEqual(resposta.status_code, 200)
+        self.assertTrue(resposta.content_type.startswith('text/plain; version=0.0.4'))
+        texto = resposta.get_data(as_text=True)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', texto)
+        self.assertIn('http_requests_total{blueprint="",method="GET",route="/teste/ok",status="200"} 3', texto)
+        self.assertIn('http_requests_total{blueprint="",method="GET",route="/teste/proibido",status="403"} 1', texto)
+        self.assertIn('http_request_duration_seconds_count{blueprint="",method="GET",route="/teste/ok"} 3', texto)
+        self.assertIn('http_request_duration_seconds_bucket{blueprint="",method="GET",route="/teste/ok",le="+Inf"} 3',
+                      texto)
+        self.assertIn('blueprint="exam_blueprint",method="GET",route="/api/exames/armazenamento/<id>"', texto)
+        # SingletonThreadPool (sqlite em memória) não informa as conexões em uso
+        if hasattr(Session.session_factory.kw['bind'].pool, 'checkedout'):
+            self.assertIn('db_pool_checked_out', texto)
+
+    def test_fila_de_emails_e_caches(self):
+        with self.app.app_context():
+            enfileirar_email(self.db, "Assunto", ["a@teste.com"], "<p>Olá</p>")
+            enfileirar_email(self.db, "Assunto", ["b@teste.com"], "<p>Olá</p>")
+        cache = self.app.extensions['token_cache']
+        cache.hits, cache.misses = 3, 1
+        with self.app.test_client() as client:
+            texto = self.coletar(client).get_data(as_text=True)
+
+        self.assertIn('mail_queue_messages{status="pending"} 2', texto)
+        self.assertIn('mail_queue_messages{status="failed"} 0', texto)
+        self.assertIn('cache_hits_total{cache="token"} 3', texto)
+        self.assertIn('cache_hit_ratio{cache="token"} 0.75', texto)
+
+    def test_token_de_acesso(self):
+        self.app.config['METRICS_TOKEN'] = 'segredo'
+        with self.app.test_client() as client:
+            self.assertEqual(self.coletar(client).status_code, 401)
+            resposta = self.coletar(client, headers={'Authorization': 'Bearer segredo'})
+            self.assertEqual(resposta.status_code, 200)
+
+    def test_agregacao_entre_processos(self):
+        # Um processo vivo e um já encerrado gravaram seus retratos na pasta compartilhada
+        vivo = subprocess.Popen(['sleep', '30'])
+        encerrado = subprocess.Popen(['true'])
+        encerrado.wait()
+        try:
+            for pid, requisicoes, conexoes in ((vivo.pid, 5, 2), (encerrado.pid, 7, 4)):
+                with open(os.path.join(self.pasta, f"metricas_{pid}.json"), 'w') as arquivo:
+                    json.dump({
+                        "pid": pid,
+                        "buckets": [0.1, 1.0],
+                        "contadores": [["http_requests_total", {"route": "/x", "status": "200"}, requisicoes]],
+                        "histogramas": [["http_request_duration_seconds", {"route": "/x"},
+                                         [requisicoes - 1, requisicoes, 0.5, requisicoes]]],
+                        "medidores": [["db_pool_checked_out", {}, conexoes]],
+                    }, arquivo)
+
+            metricas = Metricas(self.pasta, buckets=[0.1, 1.0])
+            metricas.contar("http_requests_total", route="/x", status="200")
+            metricas.observar("http_request_duration_seconds", 2.0, route="/x")
+            contadores, histogramas, medidores, buckets = agregar(metricas.retratos())
+        finally:
+            vivo.kill()
+            vivo.wait()
+
+        self.assertEqual(contadores[("http_requests_total", (("route", "/x"), ("status", "200")))], 13)
+        self.assertEqual(histogramas[("http_request_duration_seconds", (("route", "/x"),))], [10, 12, 3.0, 13])
+        # Medidores só dos processos vivos
+        self.assertEqual(medidores[("db_pool_checked_out", ())], 2)
+        texto = formatar(contadores, histogramas, medidores, buckets)
+        self.assertIn('http_request_duration_seconds_bucket{route="/x",le="0.1"} 10', texto)
+        self.assertIn('http_request_duration_seconds_bucket{route="/x",le="+Inf"} 13', texto)
+        self.assertIn('http_request_duration_seconds_sum{route="/x"} 3.0', texto)
+
+
+if __name__ == '__main__':
+    unittest.main()
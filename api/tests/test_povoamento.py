@@ -0,0 +1,62 @@
+import unittest
+from datetime import date
+
+from app import create_app, drop_test_db, TestSession
+from app.database import Base
+from app.models.company import Company
+from app.models.exam import Exam
+from app.models.user import User, UserRole
+from app.povoamento import gerar_cnpj, gerar_cpf, povoar
+
+
+class PovoamentoTestCase(unittest.TestCase):
+    """Dados sintéticos do `flask seed`: volume, consistência e reprodutibilidade"""
+
+    def setUp(self):
+        drop_test_db()
+        self.db = TestSession()
+        Base.metadata.create_all(bind=self.db.bind)
+        self.app = create_app(testing=True)
+
+    def tearDown(self):
+        self.db.close()
+        drop_test_db()
+
+    def povoar(self):
+        return povoar(self.db, escala=0.01, semente=7, exames=500, lote=40, processos=0, ate=date(2025, 3, 14))
+
+    def test_povoamento_reprodutivel(self):
+        self.assertEqual(self.povoar(), {'users': 100, 'companies': 10, 'exams': 500})
+        exames = [(e.id, e.user_id, e.company_id, e.exam_date, e.image_uploaded)
+                  for e in self.db.query(Exam).order_by(Exam.id)]
+        usuarios = [(u.id, u.email, u.cpf) for u in self.db.query(User).order_by(User.id)]
+
+        # Todo exame aponta para um trabalhador e uma empresa que existem
+        ids_trabalhadores = {u.id for u in self.db.query(User).filter(User.role == UserRole.WORKER)}
+        ids_empresas = {c.id for c in self.db.query(Company)}
+        self.assertTrue(all(e[1] in ids_trabalhadores and e[2] in ids_empresas for e in exames))
+        self.assertFalse(any(e[4] for e in exames if e[3] > date(2025, 3, 14)))
+        self.assertEqual(len({u[2] for u in usuarios}), 100)
+
+        # Banco já povoado é recusado; vazio de novo, a mesma semente gera os mesmos dados
+        with self.assertRaises(ValueError):
+            self.povoar()
+        drop_test_db()
+        Base.metadata.create_all(bind=self.db.bind)
+        self.povoar()
+        self.assertEqual([(e.id, e.user_id, e.company_id, e.exam_date, e.image_uploaded)
+                          for e in self.db.query(Exam).order_by(Exam.id)], exames)
+        self.assertEqual([(u.id, u.email, u.cpf) for u in self.db.query(User).order_by(User.id)], usuarios)
+
+    def test_documentos_validos(self):
+        self.assertEqual(gerar_cpf(0, 0), '000.000.000-00')
+        cpf = gerar_cpf(42, 1234).replace('.', '').replace('-', '')
+        for posicao in (9, 10):
+            soma = sum(int(d) * p for d, p in zip(cpf[:posicao], range(posicao + 1, 1, -1)))
+            self.assertEqual(int(cpf[posicao]), 0 if soma % 11 < 2 else 11 - soma % 11)
+        self.assertEqual(gerar_cnpj(0, 0), '00000000000191')  # 00.000.000/0001-91
+        self.assertEqual(len({gerar_cnpj(42, i) for i in range(1000)}), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()